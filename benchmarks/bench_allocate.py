@@ -0,0 +1,46 @@
+import timeit
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = 'BENCH-LAMP'
+
+
+def product_with_allocated_lines(n_lines):
+    batch = Batch('full-batch', SKU, qty=n_lines * 2, eta=None)
+    for i in range(n_lines):
+        batch.allocate(OrderLine(f'order-{i}', SKU, 1))
+    return Product(SKU, batches=[batch])
+
+
+def product_with_batches(n_batches):
+    start = date(2020, 1, 1)
+    batches = [
+        Batch(f'batch-{i}', SKU, qty=10 ** 9, eta=start + timedelta(days=i))
+        for i in reversed(range(n_batches))
+    ]
+    return Product(SKU, batches=batches)
+
+
+def time_allocate(product, number=50):
+    counter = iter(range(10 ** 9))
+    seconds = timeit.timeit(
+        lambda: product.allocate(OrderLine(f'new-{next(counter)}', SKU, 1)),
+        number=number,
+    )
+    return seconds / number * 1e6
+
+
+def main():
+    print(f"{'lines':>8} {'allocate (us)':>14}")
+    for n_lines in (10_000, 25_000, 50_000, 100_000):
+        product = product_with_allocated_lines(n_lines)
+        print(f'{n_lines:>8} {time_allocate(product):>14.1f}')
+
+    print(f"{'batches':>8} {'allocate (us)':>14}")
+    for n_batches in (10, 100, 500, 1000):
+        product = product_with_batches(n_batches)
+        print(f'{n_batches:>8} {time_allocate(product, number=500):>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# usage: python benchmarks/bench_asgi.py [--uri postgresql://...] [--workers 4] [--clients 32]
+#                                        [--requests 2000] [--io-ms 5]
+#
+# drives the flask app and the asgi app in-process, each against a fresh
+# database (sqlite unless --uri is given), with --clients clients each
+# sending allocate and allocations requests in turn. flask gets --workers threads to serve them
+# on; the asgi app gets one event loop and --workers threads for the
+# blocking database calls. publishing each Allocated event takes --io-ms,
+# standing in for a slow redis (or smtp) round trip. reports requests/sec
+# and latency percentiles
+#
+# sqlite runs one transaction at a time, and an async unit of work keeps its
+# transaction open across awaits, so against sqlite the asgi app needs a
+# thread per client or the waiting transactions use up every thread. worker
+# counts are only equal against postgres
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.entrypoints import asgi_app, flask_app
+from allocation.service_layer import unit_of_work
+
+N_SKUS = 20
+
+
+def session_factory(uri):
+    if uri:
+        engine = create_engine(uri, pool_size=64)
+        orm.metadata.drop_all(engine)
+    else:
+        engine = create_engine(
+            'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'),
+            connect_args={'check_same_thread': False, 'timeout': 30},
+        )
+        # with many transactions open at once, sqlite's read locks deadlock
+        # writers, so each transaction takes the write lock when it begins
+        @event.listens_for(engine, 'connect')
+        def _no_implicit_begin(dbapi_connection, _):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def _begin_immediate(connection):
+            connection.execute('BEGIN IMMEDIATE')
+    orm.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def requests_for(client, count):
+    for i in range(count):
+        orderid = f'order-{client}-{i}'
+        if i % 2 == 0:
+            yield 'POST', '/allocate', dict(orderid=orderid, sku=f'SKU-{i % N_SKUS}', qty=1)
+        else:
+            yield 'GET', f'/allocations/order-{client}-{i - 1}', None
+
+
+def run_flask(args):
+    factory = session_factory(args.uri)
+    io_seconds = args.io_ms / 1e3
+    flask_app.bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(factory),
+        notifications=mock.Mock(),
+        publish=lambda *_: time.sleep(io_seconds),
+    )
+    flask_app.allocations_cache = None
+    for i in range(N_SKUS):
+        flask_app.bus.handle(commands.CreateBatch(f'batch-{i}', f'SKU-{i}', 10 ** 6, None))
+
+    workers = ThreadPoolExecutor(args.workers)
+    local = threading.local()
+    latencies = []
+    statuses = []
+
+    def serve(method, path, body):
+        if not hasattr(local, 'client'):
+            local.client = flask_app.app.test_client()
+        return local.client.open(path, method=method, json=body).status_code
+
+    def client(number):
+        for method, path, body in requests_for(number, args.requests // args.clients):
+            start = time.perf_counter()
+            status = workers.submit(serve, method, path, body).result()
+            latencies.append(time.perf_counter() - start)
+            statuses.append(status)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def run_asgi(args):
+    factory = session_factory(args.uri)
+    io_seconds = args.io_ms / 1e3
+
+    async def publish(*_):
+        await asyncio.sleep(io_seconds)
+
+    threads = args.workers if args.uri else max(args.workers, args.clients)
+    bus = bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyAsyncUnitOfWork(
+            factory, executor=ThreadPoolExecutor(threads),
+        ),
+        notifications=mock.AsyncMock(),
+        publish=publish,
+    )
+    app = asgi_app.AllocationApp(bus)
+    latencies = []
+    statuses = []
+
+    async def call(method, path, body):
+        incoming = [{
+            'type': 'http.request', 'more_body': False,
+            'body': json.dumps(body).encode() if body is not None else b'',
+        }]
+        sent = []
+
+        async def receive():
+            return incoming.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await app({'type': 'http', 'method': method, 'path': path}, receive, send)
+        return sent[0]['status']
+
+    async def client(number):
+        for method, path, body in requests_for(number, args.requests // args.clients):
+            start = time.perf_counter()
+            statuses.append(await call(method, path, body))
+            latencies.append(time.perf_counter() - start)
+
+    async def main():
+        for i in range(N_SKUS):
+            await bus.handle(commands.CreateBatch(f'batch-{i}', f'SKU-{i}', 10 ** 6, None))
+        start = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(args.clients)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(main())
+    return elapsed, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--io-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f'{"app":>6} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, run in [('flask', run_flask), ('asgi', run_asgi)]:
+        elapsed, latencies, statuses = run(args)
+        cuts = statistics.quantiles(latencies, n=100)
+        errors = sum(1 for status in statuses if status >= 300)
+        print(
+            f'{name:>6} {len(latencies) / elapsed:8.0f} {cuts[49] * 1e3:8.1f}'
+            f' {cuts[98] * 1e3:8.1f} {errors:7d}'
+        )
+
+
+if __name__ == '__main__':
+    main()
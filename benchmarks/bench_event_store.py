@@ -0,0 +1,61 @@
+# usage: python benchmarks/bench_event_store.py [--history 5000] [--allocations 200]
+#
+# allocates to a long-lived sku that already has --history allocations,
+# storing products in the mapped tables and then as event streams, and
+# reports the time and statements per allocate
+import argparse
+import os
+import tempfile
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+
+SKU = 'LONG-LIVED-LAMP'
+N_BATCHES = 50
+
+
+def run(uow_class, history, allocations):
+    engine = create_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    orm.metadata.create_all(engine)
+    uow = uow_class(sessionmaker(bind=engine))
+    per_batch = (history + allocations) // N_BATCHES + 1
+    for i in range(N_BATCHES):
+        handlers.add_batch(commands.CreateBatch(f'batch{i}', SKU, per_batch, None), uow)
+    for start in range(0, history, 500):
+        handlers.allocate_many(commands.AllocateMany(SKU, [
+            (f'old{i}', 1) for i in range(start, min(start + 500, history))
+        ]), uow)
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    start = time.perf_counter()
+    for i in range(allocations):
+        handlers.allocate(commands.Allocate(f'new{i}', SKU, 1), uow)
+    elapsed = time.perf_counter() - start
+    reads = sum(1 for s in statements if s.lstrip().upper().startswith('SELECT'))
+    return elapsed / allocations, reads / allocations, (len(statements) - reads) / allocations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=int, default=5000)
+    parser.add_argument('--allocations', type=int, default=200)
+    args = parser.parse_args()
+    print(f'{"storage":>14} {"ms/allocate":>12} {"reads":>6} {"writes":>7}')
+    # event-sourced products are plain objects, so this runs before the
+    # mappers instrument the model classes
+    for name, uow_class in [
+            ('event stream', unit_of_work.EventSourcedUnitOfWork),
+            ('tables', unit_of_work.SqlAlchemyUnitOfWork),
+    ]:
+        if uow_class is unit_of_work.SqlAlchemyUnitOfWork:
+            orm.start_mappers()
+        seconds, reads, writes = run(uow_class, args.history, args.allocations)
+        print(f'{name:>14} {seconds * 1e3:12.2f} {reads:6.1f} {writes:7.1f}')
+
+
+if __name__ == '__main__':
+    main()
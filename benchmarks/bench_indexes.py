@@ -0,0 +1,136 @@
+# usage: python benchmarks/bench_indexes.py [--uri postgresql://...] [--rows 1000000]
+#
+# loads --rows order lines (all allocated, and all in the read model) into a
+# fresh database, then times each access path and prints its plan, first
+# without the secondary indexes and then with them
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from sqlalchemy import create_engine
+from allocation.adapters import orm
+
+LINES_PER_BATCH = 10
+BATCHES_PER_PRODUCT = 10
+LOAD_CHUNK = 10000
+
+# the statements the repository, views and read model handlers run, keyed
+# by what they look up
+ACCESS_PATHS = [
+    ('product by sku', 'sku',
+     'SELECT sku, version_number FROM products WHERE sku = :sku'),
+    ('batches of a product', 'sku',
+     'SELECT id, reference, _purchased_quantity, eta FROM batches WHERE sku = :sku'),
+    ('allocations of a batch', 'batch_id',
+     'SELECT order_lines.id, order_lines.qty FROM allocations'
+     ' JOIN order_lines ON order_lines.id = allocations.orderline_id'
+     ' WHERE allocations.batch_id = :batch_id'),
+    ('product by batchref', 'batchref',
+     'SELECT products.sku FROM products JOIN batches ON products.sku = batches.sku'
+     ' WHERE batches.reference = :batchref'),
+    ('allocations view', 'orderid',
+     'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid'),
+    ('read model delete', 'orderid_sku',
+     'SELECT 1 FROM allocations_view WHERE orderid = :orderid AND sku = :sku'),
+    ('order line', 'orderid_sku',
+     'SELECT id FROM order_lines WHERE orderid = :orderid AND sku = :sku'),
+]
+
+
+def load(engine, n_lines):
+    n_batches = max(n_lines // LINES_PER_BATCH, 1)
+    n_products = max(n_batches // BATCHES_PER_PRODUCT, 1)
+    with engine.begin() as conn:
+        conn.execute(orm.products.insert(), [
+            dict(sku=f'sku{p}', version_number=1) for p in range(n_products)
+        ])
+        for start in range(0, n_batches, LOAD_CHUNK):
+            conn.execute(orm.batches.insert(), [
+                dict(id=b + 1, reference=f'batch{b}', sku=f'sku{b % n_products}',
+                     _purchased_quantity=LINES_PER_BATCH)
+                for b in range(start, min(start + LOAD_CHUNK, n_batches))
+            ])
+        for start in range(0, n_lines, LOAD_CHUNK):
+            lines = range(start, min(start + LOAD_CHUNK, n_lines))
+            sku = lambda l: f'sku{(l // LINES_PER_BATCH) % n_batches % n_products}'
+            conn.execute(orm.order_lines.insert(), [
+                dict(id=l + 1, orderid=f'order{l}', sku=sku(l), qty=1) for l in lines
+            ])
+            conn.execute(orm.allocations.insert(), [
+                dict(orderline_id=l + 1, batch_id=(l // LINES_PER_BATCH) % n_batches + 1)
+                for l in lines
+            ])
+            conn.execute(orm.allocations_view.insert(), [
+                dict(orderid=f'order{l}', sku=sku(l),
+                     batchref=f'batch{(l // LINES_PER_BATCH) % n_batches}')
+                for l in lines
+            ])
+    return n_products, n_batches
+
+
+def lookup_params(kind, n_lines, n_products, n_batches):
+    line = random.randrange(n_lines)
+    batch = (line // LINES_PER_BATCH) % n_batches
+    return {
+        'sku': dict(sku=f'sku{random.randrange(n_products)}'),
+        'batch_id': dict(batch_id=batch + 1),
+        'batchref': dict(batchref=f'batch{batch}'),
+        'orderid': dict(orderid=f'order{line}'),
+        'orderid_sku': dict(orderid=f'order{line}', sku=f'sku{batch % n_products}'),
+    }[kind]
+
+
+def explain(conn, statement, params):
+    if conn.engine.dialect.name == 'sqlite':
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + statement, params)
+        return [row[-1] for row in rows]
+    return [row[0] for row in conn.execute('EXPLAIN ' + statement, params)]
+
+
+def report(engine, n_lines, n_products, n_batches, lookups):
+    with engine.connect() as conn:
+        for name, kind, statement in ACCESS_PATHS:
+            timings = []
+            for _ in range(lookups):
+                params = lookup_params(kind, n_lines, n_products, n_batches)
+                start = time.perf_counter()
+                conn.execute(statement, params).fetchall()
+                timings.append(time.perf_counter() - start)
+            plan = explain(conn, statement, lookup_params(kind, n_lines, n_products, n_batches))
+            print(f'  {name:24} {statistics.median(timings) * 1e6:12.1f} us')
+            for step in plan:
+                print(f'    {step}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri')
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    parser.add_argument('--lookups', type=int, default=20)
+    args = parser.parse_args()
+    uri = args.uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = create_engine(uri)
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    for table in orm.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+    start = time.perf_counter()
+    n_products, n_batches = load(engine, args.rows)
+    print(f'loaded {args.rows} order lines, {n_batches} batches and {n_products} products'
+          f' in {time.perf_counter() - start:.1f}s')
+
+    print('without indexes:')
+    report(engine, args.rows, n_products, n_batches, args.lookups)
+    start = time.perf_counter()
+    orm.ensure_indexes(engine)
+    print(f'created indexes in {time.perf_counter() - start:.1f}s')
+    print('with indexes:')
+    report(engine, args.rows, n_products, n_batches, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
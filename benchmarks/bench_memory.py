@@ -0,0 +1,30 @@
+import gc
+import tracemalloc
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = 'BENCH-LAMP'
+N_LINES = 100_000
+
+
+def build_product(n_lines):
+    product = Product(SKU, batches=[Batch('batch', SKU, qty=n_lines, eta=None)])
+    for i in range(n_lines):
+        product.allocate(OrderLine(f'order-{i}', SKU, 1))
+    return product
+
+
+def main():
+    gc.collect()
+    tracemalloc.start()
+    product = build_product(N_LINES)
+    lines_and_events, _ = tracemalloc.get_traced_memory()
+    product.events.clear()
+    gc.collect()
+    lines_only, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{N_LINES} allocations, with Allocated events: {lines_and_events / 2**20:.1f} MiB')
+    print(f'{N_LINES} allocations, events collected:     {lines_only / 2**20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
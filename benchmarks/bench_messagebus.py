@@ -0,0 +1,78 @@
+import time
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus, unit_of_work
+
+SKU = 'BENCH-LAMP'
+
+
+class InMemoryRepository(repository.AbstractRepository):
+
+    def __init__(self):
+        super().__init__()
+        self._products = {}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        return next((
+            p for p in self._products.values()
+            for b in p.batches if b.reference == batchref
+        ), None)
+
+
+class InMemoryUnitOfWork(unit_of_work.AbstractUnitOfWork):
+
+    def __init__(self):
+        self.products = InMemoryRepository()
+
+    def _commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def make_bus():
+    uow = InMemoryUnitOfWork()
+    dependencies = {'uow': uow}
+    inject = lambda handler: bootstrap.inject_dependencies(handler, dependencies)
+    return messagebus.MessageBus(
+        uow=uow,
+        event_handlers={
+            events.Allocated: [lambda e: None],
+            events.Deallocated: [inject(handlers.reallocate)],
+            events.OutOfStock: [lambda e: None],
+        },
+        command_handlers={
+            commands.Allocate: inject(handlers.allocate),
+            commands.AllocateMany: inject(handlers.allocate_many),
+            commands.CreateBatch: inject(handlers.add_batch),
+            commands.ChangeBatchQuantity: inject(handlers.change_batch_quantity),
+        },
+    )
+
+
+def main():
+    print(f"{'cascade':>8} {'messages/sec':>14}")
+    for n_lines in (1_000, 10_000, 100_000):
+        bus = make_bus()
+        bus.handle(commands.CreateBatch('b1', SKU, n_lines, None))
+        bus.handle(commands.CreateBatch('b2', SKU, n_lines, None))
+        bus.handle(commands.AllocateMany(SKU, [(f'o{i}', 1) for i in range(n_lines)]))
+
+        start = time.perf_counter()
+        bus.handle(commands.ChangeBatchQuantity('b1', 0))
+        elapsed = time.perf_counter() - start
+        # the command, then a Deallocated and an Allocated per line
+        n_messages = 1 + 2 * n_lines
+        print(f'{n_lines:>8} {n_messages / elapsed:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
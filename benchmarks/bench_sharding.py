@@ -0,0 +1,90 @@
+# usage: python benchmarks/bench_sharding.py [--uri postgresql://...] [--processes]
+import argparse
+import functools
+import os
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters import notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import sharding, unit_of_work
+
+N_SKUS = 64
+N_ALLOCATIONS = 2000
+
+
+class NoNotifications(notifications.AbstractNotifications):
+
+    def send(self, destination, message):
+        pass
+
+
+def no_publish(*args):
+    pass
+
+
+def session_factory(uri):
+    connect_args = {'timeout': 30} if uri.startswith('sqlite') else {}
+    return sessionmaker(bind=create_engine(uri, connect_args=connect_args))
+
+
+def make_bus(uri):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory(uri)),
+        notifications=NoNotifications(),
+        publish=no_publish,
+    )
+
+
+def run(uri, n_workers, use_processes):
+    orm.metadata.drop_all(create_engine(uri))
+    orm.metadata.create_all(create_engine(uri))
+    setup_bus = make_bus(uri)
+    skus = [f'BENCH-SKU-{i}' for i in range(N_SKUS)]
+    for sku in skus:
+        setup_bus.handle(commands.CreateBatch(f'batch-{sku}', sku, 10 ** 6, None))
+
+    pool = sharding.ShardedWorkerPool(
+        bus_factory=functools.partial(make_bus, uri),
+        n_workers=n_workers,
+        sku_for_batchref=functools.partial(views.sku_for_batchref, uow=setup_bus.uow),
+        use_processes=use_processes,
+    )
+    with pool:
+        # warm the workers up before timing
+        for future in [pool.submit(commands.Allocate('warmup', sku, 1)) for sku in skus]:
+            future.result()
+        start = time.perf_counter()
+        futures = [
+            pool.submit(commands.Allocate(f'order-{i}', skus[i % N_SKUS], 1))
+            for i in range(N_ALLOCATIONS)
+        ]
+        failures = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception:  # pylint: disable=broad-except
+                failures += 1
+        elapsed = time.perf_counter() - start
+    return N_ALLOCATIONS / elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri')
+    parser.add_argument('--processes', action='store_true')
+    args = parser.parse_args()
+    uri = args.uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    orm.start_mappers()
+    print(f"{'workers':>8} {'allocations/sec':>16} {'failures':>9}")
+    for n_workers in (1, 2, 4, 8):
+        throughput, failures = run(uri, n_workers, args.processes)
+        print(f'{n_workers:>8} {throughput:>16.0f} {failures:>9}')
+
+
+if __name__ == '__main__':
+    main()
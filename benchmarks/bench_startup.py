@@ -0,0 +1,79 @@
+# usage: python benchmarks/bench_startup.py [--runs 5]
+#
+# how long a fresh worker process takes to import the app (from
+# `python -X importtime`, with the slowest imports), and to answer its first
+# request. the first request needs the database, so without one running it
+# measures how quickly the worker fails instead
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+ENTRYPOINTS = [
+    'allocation.bootstrap',
+    'allocation.entrypoints.flask_app',
+    'allocation.entrypoints.redis_eventconsumer',
+]
+
+FIRST_REQUEST = '''
+from allocation.entrypoints import flask_app
+response = flask_app.app.test_client().get('/allocations/startup-bench')
+print(response.status_code)
+'''
+
+
+def import_times(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        return None
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e3
+    return times
+
+
+def first_request():
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', FIRST_REQUEST], capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    status = result.stdout.strip() or f'exited with {result.returncode}'
+    return elapsed * 1e3, status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in ENTRYPOINTS:
+        runs = [import_times(module) for _ in range(args.runs)]
+        if None in runs:
+            print(f'import {module}: failed')
+            continue
+        total = statistics.median(run[module] for run in runs)
+        print(f'import {module}: {total:.1f} ms')
+        # the top-level packages that cost the most
+        packages = sorted(
+            ((name, ms) for name, ms in runs[-1].items() if '.' not in name),
+            key=lambda item: item[1], reverse=True,
+        )
+        for name, ms in packages[:args.top]:
+            print(f'    {name:40} {ms:8.1f} ms')
+
+    timings = [first_request() for _ in range(args.runs)]
+    median = statistics.median(ms for ms, _ in timings)
+    print(f'process start to first response: {median:.1f} ms (status {timings[-1][1]})')
+
+
+if __name__ == '__main__':
+    main()
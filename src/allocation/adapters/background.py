@@ -0,0 +1,64 @@
+import logging
+import queue
+import threading
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundQueue:
+    # a bounded queue, drained by a daemon thread that hands what it takes
+    # (up to batch_size items at a time) to handle. put() raises queue.Full
+    # when there's no room, for the caller to count or log what it drops.
+    # handle is expected to deal with its own errors; anything it lets
+    # through is logged, and the worker carries on
+
+    def __init__(
+        self, handle: Callable[[List], None], name: str,
+        max_size: int = 1000, batch_size: int = 1,
+    ):
+        self.handle = handle
+        self.name = name
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_size)  # type: queue.Queue
+        self._lock = threading.Lock()
+        self._worker = None  # type: Optional[threading.Thread]
+
+    def put(self, item, timeout: Optional[float] = None):
+        # without a timeout, doesn't wait for room at all
+        self._ensure_worker()
+        if timeout is None:
+            self._queue.put_nowait(item)
+        else:
+            self._queue.put(item, timeout=timeout)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def join(self):
+        # waits for everything queued so far to be handled
+        self._queue.join()
+
+    def _ensure_worker(self):
+        # started on first use, and again in a forked child, which doesn't
+        # inherit the thread
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.handle(items)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Exception in %s worker', self.name)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+import weakref
+from typing import Callable, List, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from allocation import config, metrics
+
+
+class InstrumentedQueuePool(QueuePool):
+    # records how long each checkout waits for a connection, and how much of
+    # the pool's capacity (size plus overflow) is checked out
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.counter('db_pool_timeouts').inc()
+            raise
+        finally:
+            metrics.summary('db_pool_checkout_wait_seconds').observe(
+                time.perf_counter() - start
+            )
+            self._record_usage()
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._record_usage()
+
+    def _record_usage(self):
+        checked_out = self.checkedout()
+        # a negative max_overflow means unlimited, so only the size counts
+        capacity = self.size() + max(self._max_overflow, 0)
+        metrics.gauge('db_pool_checked_out').set(checked_out)
+        metrics.gauge('db_pool_saturation').set(checked_out / capacity)
+
+
+def create_postgres_engine(isolation_level: str) -> Engine:
+    return create_engine(
+        config.get_postgres_uri(),
+        isolation_level=isolation_level,
+        # send executemany() parameter sets to postgres in pages, not one by one
+        executemany_mode='batch',
+        poolclass=InstrumentedQueuePool,
+        **config.get_db_pool_settings(),
+    )
+
+
+
+class ProcessLocalSessionFactory:
+    # a sessionmaker whose engine is created on first use, and created again
+    # in a forked child, so that processes never share pooled connections
+
+    def __init__(self, create: Callable[[], Engine]):
+        self.create = create
+        self._engine = None  # type: Optional[Engine]
+        self._lock = threading.Lock()
+        # a child leaves its parent's engine alone: closing the inherited
+        # connections would close the parent's, so they're kept from the
+        # garbage collector as well
+        self._inherited = []  # type: List[Engine]
+        self._sessionmaker = sessionmaker()
+        _factories.add(self)
+
+    @property
+    def engine(self) -> Engine:
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self.create()
+        return self._engine
+
+    def __call__(self, **kwargs):
+        return self._sessionmaker(bind=self.engine, **kwargs)
+
+    def _after_fork(self):
+        if self._engine is not None:
+            self._inherited.append(self._engine)
+        self._engine = None
+        # another thread may have held it when we forked
+        self._lock = threading.Lock()
+
+
+_factories = weakref.WeakSet()  # type: weakref.WeakSet[ProcessLocalSessionFactory]
+
+
+def _after_fork_in_child():
+    for factory in list(_factories):
+        factory._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,7 +1,18 @@
 #pylint: disable=too-few-public-methods
 import abc
+import asyncio
+import logging
+import queue
 import smtplib
-from allocation import config
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+from allocation import config, metrics
+from allocation.adapters.background import BackgroundQueue
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractNotifications(abc.ABC):
@@ -11,21 +22,133 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()['host']
-DEFAULT_PORT = config.get_email_host_and_port()['port']
-
-
-
 class EmailNotifications(AbstractNotifications):
+    # connects on the first send, so that creating one never blocks on (or
+    # fails because of) the mail server, and reconnects (once per send) if
+    # the server has dropped the connection since
 
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host = smtp_host or config.get_email_host_and_port()['host']
+        self.port = port or config.get_email_host_and_port()['port']
+        self._server = None  # type: Optional[smtplib.SMTP]
+
+    @property
+    def server(self) -> smtplib.SMTP:
+        if self._server is None:
+            self._server = smtplib.SMTP(self.smtp_host, port=self.port)
+        return self._server
 
     def send(self, destination, message):
         msg = f'Subject: allocation service notification\n{message}'
+        try:
+            self._sendmail(destination, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            logger.info('reconnecting to %s:%s', self.smtp_host, self.port)
+            self.close()
+            self._sendmail(destination, msg)
+
+    def _sendmail(self, destination, msg):
         self.server.sendmail(
             from_addr='allocations@example.com',
             to_addrs=[destination],
             msg=msg
         )
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.close()
+            except OSError:
+                pass
+
+
+class CoalescingNotifications(AbstractNotifications):
+    # sends through another notifications adapter from a worker thread, so
+    # send() never waits on the mail server, and drops any notification
+    # that's the same as one sent to the same destination in the last
+    # window seconds (eg repeated out of stock emails for a sku). at most
+    # max_queue notifications wait to be sent; past that they're dropped
+
+    def __init__(
+        self, sender: AbstractNotifications, window: float = 300.0,
+        max_queue: int = 1000, clock: Callable[[], float] = time.monotonic,
+    ):
+        self.sender = sender
+        self.window = window
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (destination, message) -> when it was last queued, oldest first
+        self._recent = OrderedDict()  # type: OrderedDict[Tuple[str, str], float]
+        self._queue = BackgroundQueue(self._send_queued, name='notifications', max_size=max_queue)
+
+    def send(self, destination, message):
+        key = (destination, message)
+        now = self.clock()
+        with self._lock:
+            self._forget_before(now - self.window)
+            if key in self._recent:
+                metrics.counter('notifications_coalesced').inc()
+                return
+            try:
+                self._queue.put(key)
+            except queue.Full:
+                metrics.counter('notifications_dropped').inc()
+                logger.warning('notification queue full, dropped %s', key)
+                return
+            # only once it's queued, so a dropped notification can be sent again
+            self._recent[key] = now
+
+    def _forget_before(self, cutoff: float):
+        while self._recent:
+            key, queued_at = next(iter(self._recent.items()))
+            if queued_at > cutoff:
+                return
+            del self._recent[key]
+
+    def _send_queued(self, keys: List[Tuple[str, str]]):
+        # on the worker thread, one at a time
+        [(destination, message)] = keys
+        try:
+            self.sender.send(destination, message)
+            metrics.counter('notifications_sent').inc()
+        except Exception:  # pylint: disable=broad-except
+            metrics.counter('notifications_failed').inc()
+            logger.exception('Exception sending notification to %s', destination)
+            # nothing was sent, so don't hold back the next one like it
+            with self._lock:
+                self._recent.pop((destination, message), None)
+
+    def join(self):
+        # waits for everything queued so far to be sent (or to fail)
+        self._queue.join()
+
+
+def from_config() -> AbstractNotifications:
+    # a window of 0 sends every notification, on the caller's thread
+    window = config.get_notification_coalesce_window()
+    if not window:
+        return EmailNotifications()
+    return CoalescingNotifications(EmailNotifications(), window=window)
+
+
+class AbstractAsyncNotifications(abc.ABC):
+
+    @abc.abstractmethod
+    async def send(self, destination, message):
+        raise NotImplementedError
+
+
+class AsyncEmailNotifications(AbstractAsyncNotifications):
+    # smtplib connections aren't safe to share between threads, so sends are
+    # funnelled through a single worker thread
+
+    def __init__(self, smtp_host=None, port=None):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._email = EmailNotifications(smtp_host, port)
+
+    async def send(self, destination, message):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._executor, self._email.send, destination, message,
+        )
@@ -1,7 +1,8 @@
 import logging
+from typing import List
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, ForeignKey,
-    event,
+    Table, MetaData, Column, Integer, String, Date, ForeignKey, Index, Text,
+    event, inspect,
 )
 from sqlalchemy.orm import mapper, relationship
 
@@ -17,6 +18,7 @@ order_lines = Table(
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
     Column('orderid', String(255)),
+    Index('ix_order_lines_orderid_sku', 'orderid', 'sku'),
 )
 
 products = Table(
@@ -32,6 +34,8 @@ batches = Table(
     Column('sku', ForeignKey('products.sku')),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
+    Index('ix_batches_reference', 'reference', unique=True),
+    Index('ix_batches_sku', 'sku'),
 )
 
 allocations = Table(
@@ -39,6 +43,8 @@ allocations = Table(
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('orderline_id', ForeignKey('order_lines.id')),
     Column('batch_id', ForeignKey('batches.id')),
+    Index('ix_allocations_batch_id', 'batch_id'),
+    Index('ix_allocations_orderline_id', 'orderline_id'),
 )
 
 allocations_view = Table(
@@ -46,10 +52,71 @@ allocations_view = Table(
     Column('orderid', String(255)),
     Column('sku', String(255)),
     Column('batchref', String(255)),
+    Index('ix_allocations_view_orderid_sku', 'orderid', 'sku'),
+    # for streaming by sku or batch in keyset order
+    Index('ix_allocations_view_sku_keyset', 'sku', 'orderid', 'batchref'),
+    Index('ix_allocations_view_batchref_keyset', 'batchref', 'orderid', 'sku'),
 )
 
+# event-sourced storage for products (see repository.EventSourcedRepository),
+# used instead of products, batches, order_lines and allocations. the
+# primary key on (sku, seq) is what stops two writers appending the same
+# change to a product's stream
 
-def start_mappers():
+product_events = Table(
+    'product_events', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('seq', Integer, primary_key=True, autoincrement=False),
+    Column('changes', Text, nullable=False),
+)
+
+product_snapshots = Table(
+    'product_snapshots', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('seq', Integer, primary_key=True, autoincrement=False),
+    Column('state', Text, nullable=False),
+)
+
+batch_refs = Table(
+    'batch_refs', metadata,
+    Column('reference', String(255), primary_key=True),
+    Column('sku', String(255), nullable=False),
+)
+
+# the sequence of the latest ChangeBatchQuantity applied to each batch
+batch_quantity_changes = Table(
+    'batch_quantity_changes', metadata,
+    Column('reference', String(255), primary_key=True),
+    Column('sequence', String(64), nullable=False),
+)
+
+
+def ensure_indexes(engine) -> List[str]:
+    # create_all() skips tables that already exist, so databases created
+    # before an index was declared get it from here. fails if there are
+    # rows that break a unique index, eg duplicate batch references
+    created = []
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                logger.info('creating index %s', index.name)
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+# how Product.batches and Batch._allocations are loaded: 'select' loads each
+# collection lazily on first access (1 + N + N queries for a product with N
+# batches), 'selectin' loads every collection at one level with one IN query
+# (3 queries in all), and 'joined' loads the whole product in one query
+LOADING_STRATEGIES = ('select', 'selectin', 'joined')
+
+
+def start_mappers(loading: str = 'selectin'):
+    if loading not in LOADING_STRATEGIES:
+        raise ValueError(f'unknown loading strategy {loading!r}')
     logger.info("Starting mappers")
     lines_mapper = mapper(model.OrderLine, order_lines)
     batches_mapper = mapper(model.Batch, batches, properties={
@@ -57,12 +124,25 @@ def start_mappers():
             lines_mapper,
             secondary=allocations,
             collection_class=set,
+            lazy=loading,
         )
     })
     mapper(model.Product, products, properties={
-        'batches': relationship(batches_mapper)
+        'batches': relationship(batches_mapper, lazy=loading)
     })
 
 @event.listens_for(model.Product, 'load')
 def receive_load(product, _):
     product.events = []
+    product._batches_by_eta = None  # pylint: disable=protected-access
+
+@event.listens_for(model.Batch, 'load')
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None  # pylint: disable=protected-access
+
+@event.listens_for(model.Batch, 'expire')
+def receive_batch_expire(batch, attrs):
+    if batch is None:  # already garbage collected
+        return
+    if attrs is None or '_allocations' in attrs:
+        batch._allocated_quantity = None  # pylint: disable=protected-access
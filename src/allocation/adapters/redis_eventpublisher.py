@@ -1,16 +1,141 @@
+# pylint: disable=import-outside-toplevel
 import json
 import logging
+import queue
+import threading
+import time
 from dataclasses import asdict
-import redis
+from functools import lru_cache
+from typing import Callable, List, Tuple
 
-from allocation import config
+from allocation import config, metrics
+from allocation.adapters.background import BackgroundQueue
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+
+# clients (and the redis package, which is slow to import) are only set up
+# when something is first published
+
+@lru_cache(maxsize=None)
+def get_client():
+    import redis
+    return redis.Redis(**config.get_redis_host_and_port())
+
+
+@lru_cache(maxsize=None)
+def get_async_client():
+    import redis.asyncio
+    return redis.asyncio.Redis(**config.get_redis_host_and_port())
 
 
 def publish(channel, event: events.Event):
     logging.info('publishing: channel=%s, event=%s', channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, json.dumps(asdict(event)))
+
+
+async def publish_async(channel, event: events.Event):
+    logging.info('publishing: channel=%s, event=%s', channel, event)
+    await get_async_client().publish(channel, json.dumps(asdict(event)))
+
+
+def add_to_stream(stream, message: dict) -> bytes:
+    # the producer side of entrypoints/redis_stream_consumer.py: the same
+    # json as on a pubsub channel, in the data field of a stream entry
+    logging.info('adding to stream: stream=%s, message=%s', stream, message)
+    return get_client().xadd(stream, {'data': json.dumps(message)})
+
+
+BLOCK = 'block'
+DROP = 'drop'
+
+
+class BufferedPublisher:
+    # called like publish(), but only buffers the message. flush() (which
+    # bootstrap runs once the bus has handled a message) sends everything
+    # buffered since the last flush in one pipeline, so a handle() cycle
+    # that raises hundreds of events pays one redis round trip.
+    #
+    # in background mode, flush() hands the messages to a bounded queue
+    # instead, and a worker thread sends whatever is queued, a pipeline at
+    # a time. when the queue is full, BLOCK makes flush() wait (for up to
+    # block_timeout seconds) for room, and DROP discards the message; both
+    # count what they drop in events_dropped
+
+    def __init__(
+        self, get_redis: Callable = get_client,
+        background: bool = False, max_queue: int = 10000,
+        when_full: str = BLOCK, block_timeout: float = 1.0,
+    ):
+        if when_full not in (BLOCK, DROP):
+            raise ValueError(f'unknown policy for a full queue: {when_full!r}')
+        self.get_redis = get_redis
+        self.background = background
+        self.when_full = when_full
+        self.block_timeout = block_timeout
+        self._lock = threading.Lock()  # parallel-safe handlers share it
+        self._buffer = []  # type: List[Tuple[str, str]]
+        self._queue = BackgroundQueue(
+            self._send_queued, name='event-publisher', max_size=max_queue, batch_size=1000,
+        )
+
+    def __call__(self, channel, event: events.Event):
+        logging.info('publishing: channel=%s, event=%s', channel, event)
+        with self._lock:
+            self._buffer.append((channel, json.dumps(asdict(event))))
+
+    def flush(self):
+        with self._lock:
+            messages, self._buffer = self._buffer, []
+        if not messages:
+            return
+        if self.background:
+            self._enqueue(messages)
+        else:
+            self._send(messages)
+
+    def _send(self, messages: List[Tuple[str, str]]):
+        start = time.perf_counter()
+        pipe = self.get_redis().pipeline(transaction=False)
+        for channel, data in messages:
+            pipe.publish(channel, data)
+        pipe.execute()
+        metrics.summary('event_publish_flush_seconds').observe(time.perf_counter() - start)
+        metrics.summary('event_publish_flush_size').observe(len(messages))
+
+    def _enqueue(self, messages: List[Tuple[str, str]]):
+        timeout = self.block_timeout if self.when_full == BLOCK else None
+        for i, message in enumerate(messages):
+            try:
+                self._queue.put(message, timeout=timeout)
+            except queue.Full:
+                metrics.counter('events_dropped').inc(len(messages) - i)
+                logger.warning('publish queue full, dropped %d events', len(messages) - i)
+                break
+        metrics.gauge('event_publish_queue_depth').set(self._queue.qsize())
+
+    def _send_queued(self, messages: List[Tuple[str, str]]):
+        # on the worker thread
+        try:
+            self._send(messages)
+        except Exception:  # pylint: disable=broad-except
+            metrics.counter('events_dropped').inc(len(messages))
+            logger.exception('Exception publishing %d events', len(messages))
+        finally:
+            metrics.gauge('event_publish_queue_depth').set(self._queue.qsize())
+
+    def join(self):
+        # waits for the worker to send everything queued so far
+        self._queue.join()
+
+
+def from_config() -> Callable:
+    settings = config.get_event_publishing()
+    if settings['mode'] == 'immediate':
+        return publish
+    return BufferedPublisher(
+        background=settings['mode'] == 'background',
+        max_queue=settings['max_queue'],
+        when_full=settings['when_full'],
+    )
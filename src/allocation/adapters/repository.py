@@ -1,5 +1,13 @@
 import abc
-from typing import Set
+import json
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, lazyload, selectinload
+from sqlalchemy.orm.util import identity_key
+from allocation import metrics
 from allocation.adapters import orm
 from allocation.domain import model
 
@@ -41,19 +49,370 @@ class AbstractRepository(abc.ABC):
 
 
 
+def load_options(loading: str):
+    # per-query equivalent of the mappers' loading strategies (see orm.py)
+    batch_allocations = model.Batch._allocations  # pylint: disable=protected-access
+    if loading == 'select':
+        return lazyload(model.Product.batches).lazyload(batch_allocations)
+    if loading == 'selectin':
+        return selectinload(model.Product.batches).selectinload(batch_allocations)
+    if loading == 'joined':
+        return joinedload(model.Product.batches).joinedload(batch_allocations)
+    raise ValueError(f'unknown loading strategy {loading!r}')
+
+
+
+class ProductCache:
+    # a process-wide LRU of committed Product aggregates, detached from any
+    # session. an entry is only used while its version_number matches the
+    # database's, and callers get a copy merged into their own session, so
+    # entries are never modified once cached
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sku: str, version_number: int) -> Optional[model.Product]:
+        with self._lock:
+            product = self._products.get(sku)
+            if product is not None and product.version_number == version_number:
+                self._products.move_to_end(sku)
+                self.hits += 1
+            else:
+                if product is not None:  # stale
+                    del self._products[sku]
+                product = None
+                self.misses += 1
+            size = len(self._products)
+        metrics.gauge('product_cache_size').set(size)
+        metrics.counter('product_cache_hits' if product else 'product_cache_misses').inc()
+        return product
+
+    def put(self, product: model.Product):
+        evicted = 0
+        with self._lock:
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.max_size:
+                self._products.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+            size = len(self._products)
+        metrics.gauge('product_cache_size').set(size)
+        if evicted:
+            metrics.counter('product_cache_evictions').inc(evicted)
+
+    def discard(self, sku: str):
+        with self._lock:
+            self._products.pop(sku, None)
+            size = len(self._products)
+        metrics.gauge('product_cache_size').set(size)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+                size=len(self._products),
+            )
+
+
+
 class SqlAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+    def __init__(self, session, for_update=False, loading=None, cache=None):
         super().__init__()
         self.session = session
+        self.for_update = for_update
+        # None uses the strategy the mappers were started with
+        self.loading = loading
+        self.cache = cache  # type: Optional[ProductCache]
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        if self.cache is not None:
+            version = self.session.execute(
+                'SELECT version_number FROM products WHERE sku = :sku',
+                dict(sku=sku),
+            ).scalar()
+            if version is not None:
+                return self._from_cache(sku, version) or self._load(sku)
+        return self._load(sku)
 
     def _get_by_batchref(self, batchref):
-        return self.session.query(model.Product).join(model.Batch).filter(
+        if self.cache is not None:
+            row = self.session.execute(
+                'SELECT p.sku, p.version_number FROM batches AS b'
+                ' JOIN products AS p ON p.sku = b.sku'
+                ' WHERE b.reference = :batchref',
+                dict(batchref=batchref),
+            ).first()
+            if row is not None:
+                sku, version = row
+                return self._from_cache(sku, version) or self._load(sku)
+        return self._products().join(model.Batch).filter(
             orm.batches.c.reference == batchref,
         ).first()
+
+    def _load(self, sku):
+        return self._products().filter_by(sku=sku).first()
+
+    def _from_cache(self, sku, version):
+        # a product this session already holds may have changes of its own
+        in_session = self.session.identity_map.get(identity_key(model.Product, sku))
+        if in_session is not None:
+            return in_session
+        cached = self.cache.get(sku, version)
+        if cached is None:
+            return None
+        # copies the cached aggregate into this session without any queries
+        return self.session.merge(cached, load=False)
+
+    def _products(self):
+        query = self.session.query(model.Product)
+        if self.loading:
+            query = query.options(load_options(self.loading))
+        if self.for_update:
+            query = query.with_for_update(of=model.Product)
+        return query
+
+
+
+class EventStreamConflict(Exception):
+    pass
+
+
+# a product's state, as the event-sourced repository sees it: its version,
+# and for each batch reference, [purchased quantity, eta, {(orderid, qty)}]
+ProductState = Dict[str, Any]
+# one change: [kind, batch reference, *arguments]
+Change = List[Any]
+
+
+class EventSourcedRepository(AbstractRepository):
+    # keeps each product as a stream of change records, one row per commit
+    # that changed it, plus a snapshot every `snapshot_every` records. loading
+    # reads the newest snapshot and the records after it, and saving appends
+    # one row, rather than rewriting the product's rows in the mapped tables.
+    # the uow must call save_changes() before committing
+
+    def __init__(self, session, snapshot_every: int = 100):
+        super().__init__()
+        self.session = session
+        self.snapshot_every = snapshot_every
+        self._products = {}  # type: Dict[str, model.Product]
+        # stream position and state of each product when it was loaded
+        self._loaded = {}  # type: Dict[str, Tuple[int, ProductState]]
+
+    def _add(self, product):
+        self._products[product.sku] = product
+        self._loaded[product.sku] = (0, empty_state())
+
+    def _get(self, sku):
+        if sku in self._products:
+            return self._products[sku]
+        snapshot = self.session.execute(
+            'SELECT seq, state FROM product_snapshots WHERE sku = :sku'
+            ' ORDER BY seq DESC LIMIT 1',
+            dict(sku=sku),
+        ).first()
+        seq, state = (snapshot[0], load_state(snapshot[1])) if snapshot else (0, None)
+        records = self.session.execute(
+            'SELECT seq, changes FROM product_events WHERE sku = :sku AND seq > :seq'
+            ' ORDER BY seq',
+            dict(sku=sku, seq=seq),
+        )
+        for seq, changes in records:
+            state = apply_changes(state or empty_state(), json.loads(changes))
+        if state is None:
+            return None
+        product = product_from_state(sku, state)
+        self._products[sku] = product
+        self._loaded[sku] = (seq, state)
+        return product
+
+    def _get_by_batchref(self, batchref):
+        sku = self.session.execute(
+            'SELECT sku FROM batch_refs WHERE reference = :batchref',
+            dict(batchref=batchref),
+        ).scalar()
+        return self._get(sku) if sku is not None else None
+
+    def save_changes(self):
+        for product in self.seen:
+            seq, before = self._loaded[product.sku]
+            after = product_state(product)
+            changes = diff_states(before, after)
+            if not changes:
+                continue
+            seq += 1
+            try:
+                self.session.execute(
+                    'INSERT INTO product_events (sku, seq, changes)'
+                    ' VALUES (:sku, :seq, :changes)',
+                    dict(sku=product.sku, seq=seq, changes=json.dumps(changes)),
+                )
+            except IntegrityError as e:
+                raise EventStreamConflict(
+                    f'{product.sku} was changed by someone else since record {seq - 1}'
+                ) from e
+            new_refs = [c[1] for c in changes if c[0] == 'add_batch']
+            if new_refs:
+                self.session.execute(
+                    'INSERT INTO batch_refs (reference, sku) VALUES (:reference, :sku)',
+                    [dict(reference=ref, sku=product.sku) for ref in new_refs],
+                )
+            if seq % self.snapshot_every == 0:
+                self.session.execute(
+                    'INSERT INTO product_snapshots (sku, seq, state)'
+                    ' VALUES (:sku, :seq, :state)',
+                    dict(sku=product.sku, seq=seq, state=dump_state(after)),
+                )
+            self._loaded[product.sku] = (seq, after)
+
+
+def empty_state() -> ProductState:
+    return {'version': 0, 'batches': {}}
+
+
+def product_state(product: model.Product) -> ProductState:
+    return {'version': product.version_number, 'batches': {
+        b.reference: [
+            b._purchased_quantity,  # pylint: disable=protected-access
+            b.eta.isoformat() if b.eta else None,
+            {(l.orderid, l.qty) for l in b._allocations},  # pylint: disable=protected-access
+        ]
+        for b in product.batches
+    }}
+
+
+def product_from_state(sku: str, state: ProductState) -> model.Product:
+    batches = []
+    for ref, (qty, eta, lines) in state['batches'].items():
+        batch = model.Batch(ref, sku, qty, date.fromisoformat(eta) if eta else None)
+        batch._allocations = {  # pylint: disable=protected-access
+            model.OrderLine(orderid, sku, line_qty) for orderid, line_qty in lines
+        }
+        batch._allocated_quantity = None  # pylint: disable=protected-access
+        batches.append(batch)
+    return model.Product(sku, batches=batches, version_number=state['version'])
+
+
+def diff_states(before: ProductState, after: ProductState) -> List[Change]:
+    changes = []  # type: List[Change]
+    for ref, (qty, eta, lines) in after['batches'].items():
+        if ref not in before['batches']:
+            changes.append(['add_batch', ref, qty, eta])
+            old_qty, old_lines = qty, set()
+        else:
+            old_qty, _, old_lines = before['batches'][ref]
+        if qty != old_qty:
+            changes.append(['change_quantity', ref, qty])
+        changes.extend(['deallocate', ref, *line] for line in sorted(old_lines - lines))
+        changes.extend(['allocate', ref, *line] for line in sorted(lines - old_lines))
+    if changes or after['version'] != before['version']:
+        changes.append(['version', None, after['version']])
+    return changes
+
+
+def apply_changes(state: ProductState, changes: List[Change]) -> ProductState:
+    batches = state['batches']
+    for kind, ref, *args in changes:
+        if kind == 'add_batch':
+            batches[ref] = [args[0], args[1], set()]
+        elif kind == 'change_quantity':
+            batches[ref][0] = args[0]
+        elif kind == 'allocate':
+            batches[ref][2].add(tuple(args))
+        elif kind == 'deallocate':
+            batches[ref][2].discard(tuple(args))
+        elif kind == 'version':
+            state['version'] = args[0]
+    return state
+
+
+def dump_state(state: ProductState) -> str:
+    return json.dumps({'version': state['version'], 'batches': {
+        ref: [qty, eta, sorted(lines)] for ref, (qty, eta, lines) in state['batches'].items()
+    }})
+
+
+def load_state(data: str) -> ProductState:
+    state = json.loads(data)
+    for batch in state['batches'].values():
+        batch[2] = {tuple(line) for line in batch[2]}
+    return state
+
+
+
+class AbstractAsyncRepository(abc.ABC):
+
+    def __init__(self):
+        self.seen = set()  # type: Set[model.Product]
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> model.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, batchref) -> model.Product:
+        product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    @abc.abstractmethod
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get(self, sku) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_by_batchref(self, batchref) -> model.Product:
+        raise NotImplementedError
+
+
+
+
+class SqlAlchemyAsyncRepository(AbstractAsyncRepository):
+    # queries run on run_sync's executor, and load the whole aggregate up
+    # front so that domain code never lazy-loads on the event loop
+
+    def __init__(self, session, run_sync: Callable[..., Awaitable], for_update=False):
+        super().__init__()
+        self.session = session
+        self.run_sync = run_sync
+        self.for_update = for_update
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        return await self.run_sync(
+            lambda: self._products().filter_by(sku=sku).first()
+        )
+
+    async def _get_by_batchref(self, batchref):
+        return await self.run_sync(
+            lambda: self._products().join(model.Batch).filter(
+                orm.batches.c.reference == batchref,
+            ).first()
+        )
+
+    def _products(self):
+        query = self.session.query(model.Product).options(load_options('selectin'))
+        if self.for_update:
+            query = query.with_for_update(of=model.Product)
+        return query
@@ -0,0 +1,137 @@
+import abc
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from allocation import config
+
+Rows = List[dict]
+
+
+# entries are versioned per orderid. get() hands out the current version
+# along with a miss, and set() only stores rows read under that version, so
+# a read that overlaps an invalidation can't put stale rows back in the cache
+
+class AbstractViewCache(abc.ABC):
+
+    @abc.abstractmethod
+    def get(self, orderid: str) -> Tuple[Optional[Rows], int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, orderid: str, rows: Rows, version: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def invalidate(self, orderids: Iterable[str]):
+        raise NotImplementedError
+
+
+class InMemoryViewCache(AbstractViewCache):
+
+    def __init__(
+        self, max_size: int = 10000, ttl: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, int, Rows]]
+        # versions of recently invalidated orderids. once one is forgotten,
+        # every orderid without a version of its own gets the newest
+        # forgotten one, so versions never go backwards
+        self._versions = OrderedDict()  # type: OrderedDict[str, int]
+        self._forgotten = 0
+        self._counter = itertools.count(1)
+
+    def get(self, orderid):
+        with self._lock:
+            version = self._versions.get(orderid, self._forgotten)
+            entry = self._entries.get(orderid)
+            if entry is None:
+                return None, version
+            expires, entry_version, rows = entry
+            if expires <= self.clock() or entry_version != version:
+                del self._entries[orderid]
+                return None, version
+            self._entries.move_to_end(orderid)
+            return rows, version
+
+    def set(self, orderid, rows, version):
+        with self._lock:
+            if version != self._versions.get(orderid, self._forgotten):
+                return
+            self._entries[orderid] = (self.clock() + self.ttl, version, rows)
+            self._entries.move_to_end(orderid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, orderids):
+        with self._lock:
+            for orderid in orderids:
+                self._entries.pop(orderid, None)
+                self._versions[orderid] = next(self._counter)
+                self._versions.move_to_end(orderid)
+            while len(self._versions) > self.max_size:
+                _, version = self._versions.popitem(last=False)
+                self._forgotten = max(self._forgotten, version)
+
+
+class RedisViewCache(AbstractViewCache):
+    # rows live under <prefix><orderid>, with the version they were read at,
+    # and the current version under <prefix><orderid>:version. both are
+    # fetched with one MGET
+
+    def __init__(self, client, ttl: int = 60, prefix: str = 'allocations:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, orderid):
+        entry, version = self.client.mget(
+            self.prefix + orderid, self.prefix + orderid + ':version',
+        )
+        version = int(version or 0)
+        if entry is None:
+            return None, version
+        entry = json.loads(entry)
+        if entry['version'] != version:
+            return None, version
+        return entry['rows'], version
+
+    def set(self, orderid, rows, version):
+        self.client.set(
+            self.prefix + orderid, json.dumps(dict(version=version, rows=rows)),
+            ex=self.ttl,
+        )
+
+    def invalidate(self, orderids):
+        pipe = self.client.pipeline(transaction=False)
+        for orderid in orderids:
+            pipe.incr(self.prefix + orderid + ':version')
+            # an expired version reads as 0, which only turns entries into misses
+            pipe.expire(self.prefix + orderid + ':version', self.ttl)
+            pipe.delete(self.prefix + orderid)
+        pipe.execute()
+
+
+def from_config(shared: bool = False) -> Optional[AbstractViewCache]:
+    # shared: the caller is one of several processes writing the read model.
+    # an in-memory cache would only ever see its own process's invalidations
+    settings = config.get_view_cache_settings()  # type: Dict
+    if settings['backend'] == 'memory':
+        if shared:
+            raise ValueError(
+                'VIEW_CACHE=memory cannot be invalidated by other processes, use VIEW_CACHE=redis'
+            )
+        return InMemoryViewCache(max_size=settings['max_size'], ttl=settings['ttl'])
+    if settings['backend'] == 'redis':
+        import redis  # pylint: disable=import-outside-toplevel
+        return RedisViewCache(
+            redis.Redis(**config.get_redis_host_and_port()), ttl=settings['ttl'],
+        )
+    return None
@@ -1,42 +1,119 @@
 import inspect
+from concurrent.futures import Executor
 from typing import Callable
-from allocation.adapters import orm, redis_eventpublisher
+from allocation import config
+from allocation.adapters import orm, redis_eventpublisher, repository
+from allocation.domain import model
+from allocation.adapters.view_cache import AbstractViewCache
 from allocation.adapters.notifications import (
-    AbstractNotifications, EmailNotifications
+    AbstractNotifications, AbstractAsyncNotifications, AsyncEmailNotifications,
+    from_config as notifications_from_config,
+)
+from allocation.service_layer import (
+    async_handlers, handlers, messagebus, read_model, unit_of_work,
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
+    publish: Callable = None,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+    executor: Executor = None,
+    retry_policy: messagebus.RetryPolicy = None,
+    allocations_view: read_model.AllocationsViewWriter = None,
+    view_cache: AbstractViewCache = None,
 ) -> messagebus.MessageBus:
 
+    if uow is None:
+        uow = default_uow()
+
     if notifications is None:
-        notifications = EmailNotifications()
+        notifications = notifications_from_config()
 
-    if start_orm:
-        orm.start_mappers()
-
-    dependencies = {'uow': uow, 'notifications': notifications, 'publish': publish}
-    injected_event_handlers = {
-        event_type: [
-            inject_dependencies(handler, dependencies)
-            for handler in event_handlers
-        ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
-    }
-    injected_command_handlers = {
-        command_type: inject_dependencies(handler, dependencies)
-        for command_type, handler in handlers.COMMAND_HANDLERS.items()
-    }
+    if publish is None:
+        publish = redis_eventpublisher.from_config()
+
+    if allocations_view is None:
+        allocations_view = read_model.AllocationsViewWriter(uow, cache=view_cache)
 
+    # event-sourced products are plain objects, and instrumenting the model
+    # classes would only slow down rebuilding them
+    if start_orm and not isinstance(uow, unit_of_work.EventSourcedUnitOfWork):
+        orm.start_mappers(loading=config.get_orm_loading())
+
+    dependencies = {
+        'uow': uow, 'notifications': notifications, 'publish': publish,
+        'deallocation_policy': deallocation_policy, 'allocations_view': allocations_view,
+    }
     return messagebus.MessageBus(
+        uow=uow, executor=executor,
+        retry_policy=retry_policy or messagebus.RetryPolicy(**config.get_retry_policy()),
+        # the read model is written before the events go out, so a
+        # subscriber that reads it sees what the events describe
+        after_handle=[allocations_view.flush] + (
+            [publish.flush] if hasattr(publish, 'flush') else []
+        ),
+        **inject_all(handlers, dependencies)
+    )
+
+
+def bootstrap_async(
+    start_orm: bool = True,
+    uow: unit_of_work.AbstractAsyncUnitOfWork = None,
+    notifications: AbstractAsyncNotifications = None,
+    publish: Callable = redis_eventpublisher.publish_async,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+    retry_policy: messagebus.RetryPolicy = None,
+    view_cache: AbstractViewCache = None,
+) -> messagebus.AsyncMessageBus:
+
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyAsyncUnitOfWork()
+
+    if notifications is None:
+        notifications = AsyncEmailNotifications()
+
+    if start_orm:
+        orm.start_mappers(loading=config.get_orm_loading())
+
+    dependencies = {
+        'uow': uow, 'notifications': notifications, 'publish': publish,
+        'deallocation_policy': deallocation_policy, 'view_cache': view_cache,
+    }
+    return messagebus.AsyncMessageBus(
         uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers,
+        retry_policy=retry_policy or messagebus.RetryPolicy(**config.get_retry_policy()),
+        **inject_all(async_handlers, dependencies)
+    )
+
+
+def default_uow() -> unit_of_work.AbstractUnitOfWork:
+    persistence = config.get_persistence()
+    if persistence['mode'] == 'event_sourced':
+        return unit_of_work.EventSourcedUnitOfWork(
+            snapshot_every=persistence['snapshot_every'],
+        )
+    return unit_of_work.SqlAlchemyUnitOfWork(product_cache=(
+        repository.ProductCache(config.get_product_cache_size())
+        if config.get_product_cache_size() else None
+    ))
+
+
+def inject_all(handlers_module, dependencies):
+    return dict(
+        event_handlers={
+            event_type: [
+                inject_dependencies(handler, dependencies)
+                for handler in event_handlers
+            ]
+            for event_type, event_handlers in handlers_module.EVENT_HANDLERS.items()
+        },
+        command_handlers={
+            command_type: inject_dependencies(handler, dependencies)
+            for command_type, handler in handlers_module.COMMAND_HANDLERS.items()
+        },
     )
 
 
@@ -47,4 +124,6 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    injected = lambda message: handler(message, **deps)
+    injected.parallel_safe = getattr(handler, 'parallel_safe', False)
+    return injected
@@ -24,3 +24,71 @@ def get_email_host_and_port():
     port = 11025 if host == 'localhost' else 1025
     http_port = 18025 if host == 'localhost' else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+def get_concurrency_control():
+    # one of 'repeatable_read', 'optimistic' or 'select_for_update'
+    return os.environ.get('CONCURRENCY_CONTROL', 'repeatable_read')
+
+def get_retry_policy():
+    return dict(
+        max_attempts=int(os.environ.get('COMMAND_MAX_ATTEMPTS', 3)),
+        base_delay=float(os.environ.get('COMMAND_RETRY_BASE_DELAY', 0.05)),
+    )
+
+def get_orm_loading():
+    # one of 'select', 'selectin' or 'joined'; see adapters/orm.py
+    return os.environ.get('ORM_LOADING', 'selectin')
+
+def get_product_cache_size():
+    # 0 turns the product cache off
+    return int(os.environ.get('PRODUCT_CACHE_SIZE', 0))
+
+def get_view_cache_settings():
+    # backend is '' (no cache), 'memory' or 'redis'. 'memory' is only right
+    # for a single process that is the only one writing the read model
+    return dict(
+        backend=os.environ.get('VIEW_CACHE', ''),
+        max_size=int(os.environ.get('VIEW_CACHE_SIZE', 10000)),
+        ttl=int(os.environ.get('VIEW_CACHE_TTL', 60)),
+    )
+
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', '') == 'true',
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', -1)),
+    )
+
+def get_persistence():
+    # 'orm' stores products in the mapped tables, 'event_sourced' as event
+    # streams with snapshots
+    return dict(
+        mode=os.environ.get('PERSISTENCE', 'orm'),
+        snapshot_every=int(os.environ.get('SNAPSHOT_EVERY', 100)),
+    )
+
+def get_stream_consumer_settings():
+    return dict(
+        stream=os.environ.get('STREAM_NAME', 'change_batch_quantity'),
+        group=os.environ.get('STREAM_GROUP', 'allocation'),
+        count=int(os.environ.get('STREAM_READ_COUNT', 100)),
+        block_ms=int(os.environ.get('STREAM_BLOCK_MS', 5000)),
+        claim_idle_ms=int(os.environ.get('STREAM_CLAIM_IDLE_MS', 60000)),
+        max_deliveries=int(os.environ.get('STREAM_MAX_DELIVERIES', 5)),
+    )
+
+def get_event_publishing():
+    # mode is 'immediate' (a round trip per event), 'buffered' (one pipeline
+    # per message bus cycle) or 'background' (pipelines sent from a thread);
+    # when_full is 'block' or 'drop'
+    return dict(
+        mode=os.environ.get('EVENT_PUBLISHING', 'buffered'),
+        max_queue=int(os.environ.get('EVENT_PUBLISH_QUEUE_SIZE', 10000)),
+        when_full=os.environ.get('EVENT_PUBLISH_WHEN_FULL', 'block'),
+    )
+
+def get_notification_coalesce_window():
+    # seconds, 0 to send every notification as it happens
+    return float(os.environ.get('NOTIFICATION_COALESCE_WINDOW', 300))
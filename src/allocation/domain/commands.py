@@ -1,17 +1,25 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
 
 class Command:
-    pass
+    __slots__ = ()
 
 @dataclass
 class Allocate(Command):
+    __slots__ = ('orderid', 'sku', 'qty')
     orderid: str
     sku: str
     qty: int
 
+@dataclass
+class AllocateMany(Command):
+    __slots__ = ('sku', 'lines')
+    sku: str
+    lines: List[Tuple[str, int]]  # (orderid, qty) pairs
+
+# no __slots__: they can't coexist with a field default before python 3.10
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -19,7 +27,15 @@ class CreateBatch(Command):
     qty: int
     eta: Optional[date] = None
 
+@dataclass
+class CreateBatches(Command):
+    __slots__ = ('batches',)
+    batches: List[CreateBatch]
+
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+    # the redis stream id of the message it came from, if any. a change
+    # older than one already applied to the batch is ignored
+    sequence: Optional[str] = None
@@ -2,10 +2,11 @@
 from dataclasses import dataclass
 
 class Event:
-    pass
+    __slots__ = ()
 
 @dataclass
 class Allocated(Event):
+    __slots__ = ('orderid', 'sku', 'qty', 'batchref')
     orderid: str
     sku: str
     qty: int
@@ -13,10 +14,12 @@ class Allocated(Event):
 
 @dataclass
 class Deallocated(Event):
+    __slots__ = ('orderid', 'sku', 'qty')
     orderid: str
     sku: str
     qty: int
 
 @dataclass
 class OutOfStock(Event):
+    __slots__ = ('sku',)
     sku: str
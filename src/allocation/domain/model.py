@@ -1,7 +1,8 @@
 from __future__ import annotations
+import bisect
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Callable, Dict, Optional, List, Set, Tuple
 from . import commands, events
 
 
@@ -12,31 +13,141 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._batches_by_eta = None  # type: Optional[List[Batch]]
+        self._eta_keys = []  # type: List[Tuple[bool, date]]
+        self._batches_by_ref = {}  # type: Dict[str, Batch]
+
+    def add_batch(self, batch: Batch):
+        if self._index_is_current():
+            key = eta_order(batch)
+            position = bisect.bisect_right(self._eta_keys, key)
+            self._eta_keys.insert(position, key)
+            self._batches_by_eta.insert(position, batch)
+            self._batches_by_ref[batch.reference] = batch
+        self.batches.append(batch)
+        self.version_number += 1
+
+    def get_batch(self, ref: str) -> Batch:
+        self._refresh_index()
+        return self._batches_by_ref[ref]
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(events.Allocated(
-                orderid=line.orderid, sku=line.sku, qty=line.qty,
-                batchref=batch.reference,
-            ))
-            return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
-            return None
-
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        self._refresh_index()
+        batch = next(
+            (b for b in self._batches_by_eta if b.can_allocate(line)), None
+        )
+        return self._allocate_to(batch, line)
+
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        self._refresh_index()
+        batches = self._batches_by_eta
+        # work off a local array of remaining quantities, refreshing a
+        # batch's entry only when we allocate to it, and skip over the
+        # prefix of batches that have been used up
+        available = [b.available_quantity for b in batches]
+        first_open = 0
+        results = []
+        for line in lines:
+            while first_open < len(batches) and available[first_open] <= 0:
+                first_open += 1
+            start = first_open if line.qty > 0 else 0
+            position = next((
+                i for i in range(start, len(batches))
+                if available[i] >= line.qty and batches[i].sku == line.sku
+            ), None)
+            if position is None:
+                results.append(self._allocate_to(None, line))
+            else:
+                results.append(self._allocate_to(batches[position], line))
+                available[position] = batches[position].available_quantity
+        return results
+
+    def change_batch_quantity(
+        self, ref: str, qty: int, policy: Optional[DeallocationPolicy] = None,
+    ) -> List[OrderLine]:
+        policy = policy or fewest_lines
+        batch = self.get_batch(ref)
         batch._purchased_quantity = qty
+        self.version_number += 1
+        evicted = []  # type: List[OrderLine]
+        if batch.available_quantity < 0:
+            for line in policy(batch._allocations, -batch.available_quantity):
+                if line in batch._allocations:
+                    batch.deallocate(line)
+                    evicted.append(line)
         while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+            evicted.append(batch.deallocate_one())
+        for line in evicted:
             self.events.append(
                 events.Deallocated(line.orderid, line.sku, line.qty)
             )
+        return evicted
+
+    def _allocate_to(self, batch: Optional[Batch], line: OrderLine) -> Optional[str]:
+        if batch is None:
+            self.events.append(events.OutOfStock(line.sku))
+            return None
+        batch.allocate(line)
+        self.version_number += 1
+        self.events.append(events.Allocated(
+            orderid=line.orderid, sku=line.sku, qty=line.qty,
+            batchref=batch.reference,
+        ))
+        return batch.reference
+
+    def _index_is_current(self) -> bool:
+        # the index is built lazily (the ORM doesn't call __init__), and
+        # batches appended directly rather than via add_batch invalidate it
+        return (
+            self._batches_by_eta is not None
+            and len(self._batches_by_eta) == len(self.batches)
+        )
+
+    def _refresh_index(self):
+        if not self._index_is_current():
+            self._batches_by_eta = sorted(self.batches, key=eta_order)
+            self._eta_keys = [eta_order(b) for b in self._batches_by_eta]
+            self._batches_by_ref = {b.reference: b for b in self.batches}
+
+
+DeallocationPolicy = Callable[[Set['OrderLine'], int], List['OrderLine']]
+
+
+def arbitrary_lines(lines: Set[OrderLine], excess: int) -> List[OrderLine]:
+    chosen, freed = [], 0
+    for line in lines:
+        if freed >= excess:
+            break
+        chosen.append(line)
+        freed += line.qty
+    return chosen
+
+
+def fewest_lines(lines: Set[OrderLine], excess: int) -> List[OrderLine]:
+    # the k largest lines free the most stock that any k lines can, so taking
+    # them greedily gives the fewest Deallocated events. the last pick is then
+    # swapped for the smallest line that still covers the shortfall, so we
+    # don't throw out more stock than we have to.
+    by_size = sorted(lines, key=lambda l: l.qty, reverse=True)
+    chosen, freed = [], 0
+    for line in by_size:
+        if freed >= excess:
+            break
+        chosen.append(line)
+        freed += line.qty
+    if chosen and freed >= excess:
+        shortfall = excess - (freed - chosen[-1].qty)
+        chosen[-1] = min(
+            (l for l in by_size[len(chosen) - 1:] if l.qty >= shortfall),
+            key=lambda l: l.qty,
+        )
+    return chosen
+
+
+def eta_order(batch: Batch) -> Tuple[bool, date]:
+    # warehouse stock (no eta) first, then shipments by eta
+    return (batch.eta is not None, batch.eta or date.min)
+
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
@@ -54,6 +165,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f'<Batch {self.reference}>'
@@ -74,15 +186,27 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
+    def deallocate(self, line: OrderLine):
+        if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
+            self._allocations.remove(line)
+
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None means "unknown", eg after the ORM has (re)loaded _allocations
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
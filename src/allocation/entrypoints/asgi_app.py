@@ -0,0 +1,135 @@
+# a plain ASGI application with the same routes as flask_app, on the async
+# message bus, so a slow database, redis or smtp call holds up a coroutine
+# rather than a worker thread. run it with any ASGI server, eg
+#   uvicorn allocation.entrypoints.asgi_app:app
+import json
+import re
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from allocation import bootstrap, metrics, views
+from allocation.adapters import view_cache
+from allocation.adapters.view_cache import AbstractViewCache
+from allocation.domain import commands
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.messagebus import AsyncMessageBus
+from allocation.service_layer.unit_of_work import ConcurrencyConflict
+
+# (status, content type, body)
+Response = Tuple[int, str, bytes]
+
+
+def text(body: str, status: int) -> Response:
+    return status, 'text/plain; charset=utf-8', body.encode()
+
+
+def json_response(body, status: int) -> Response:
+    return status, 'application/json', json.dumps(body).encode()
+
+
+class AllocationApp:
+    # the bus (and the orm mappers it starts) is only set up when the server
+    # starts the app, or on the first request, so importing this is cheap
+
+    def __init__(
+        self,
+        bus: Optional[AsyncMessageBus] = None,
+        cache: Optional[AbstractViewCache] = None,
+    ):
+        self.bus = bus
+        self.cache = cache
+        self.routes = [
+            ('POST', re.compile(r'/add_batch'), self.add_batch),
+            ('POST', re.compile(r'/allocate'), self.allocate),
+            ('GET', re.compile(r'/allocations/(?P<orderid>[^/]+)'), self.allocations),
+            ('GET', re.compile(r'/metrics'), self.metrics),
+        ]  # type: List[Tuple[str, re.Pattern, Callable[..., Awaitable[Response]]]]
+
+    def setup(self):
+        if self.bus is None:
+            self.cache = view_cache.from_config()
+            self.bus = bootstrap.bootstrap_async(view_cache=self.cache)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f'unsupported scope type {scope["type"]!r}')
+        self.setup()
+        status, content_type, body = await self.dispatch(scope, receive)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', content_type.encode()),
+                (b'content-length', str(len(body)).encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.setup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, scope, receive) -> Response:
+        path_matched = False
+        for method, pattern, endpoint in self.routes:
+            match = pattern.fullmatch(scope['path'])
+            if match is None:
+                continue
+            path_matched = True
+            if method == scope['method']:
+                return await endpoint(receive, **match.groupdict())
+        if path_matched:
+            return text('method not allowed', 405)
+        return text('not found', 404)
+
+    async def add_batch(self, receive) -> Response:
+        body = await read_json(receive)
+        eta = body['eta']
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        cmd = commands.CreateBatch(body['ref'], body['sku'], body['qty'], eta)
+        await self.bus.handle(cmd)
+        return text('OK', 201)
+
+    async def allocate(self, receive) -> Response:
+        body = await read_json(receive)
+        try:
+            cmd = commands.Allocate(body['orderid'], body['sku'], body['qty'])
+            await self.bus.handle(cmd)
+        except InvalidSku as e:
+            return json_response({'message': str(e)}, 400)
+        except ConcurrencyConflict as e:
+            return json_response({'message': str(e)}, 409)
+        return text('OK', 202)
+
+    async def allocations(self, receive, orderid) -> Response:
+        # pylint: disable=unused-argument
+        result = await views.allocations_async(orderid, self.bus.uow, cache=self.cache)
+        if not result:
+            return text('not found', 404)
+        return json_response(result, 200)
+
+    async def metrics(self, receive) -> Response:
+        # pylint: disable=unused-argument
+        return json_response(metrics.snapshot(), 200)
+
+
+async def read_json(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return json.loads(b''.join(chunks))
+
+
+app = AllocationApp()
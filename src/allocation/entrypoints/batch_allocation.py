@@ -0,0 +1,87 @@
+import json
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from allocation.domain import commands
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.unit_of_work import ConcurrencyConflict
+from .batch_importer import chunked
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# a numbered order line, as read from a request
+Line = Tuple[int, dict]
+
+
+def read_json_lines(lines: Iterable[bytes]) -> Iterator[Line]:
+    # lines are numbered before blank ones are skipped, so the numbers are
+    # positions in the body. a line that isn't JSON comes through as None,
+    # to be answered with an error like any other malformed line
+    for number, line in enumerate(lines):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+
+
+def allocate_lines(
+        numbered: Iterable[Line], bus, chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[dict]:
+    # lines are read lazily, a chunk at a time, and each chunk's lines are
+    # allocated with one AllocateMany (one transaction) per sku, in the order
+    # they arrived. results come out as each sku's lines are committed, each
+    # with the number of its line in the request
+    for chunk in chunked(numbered, chunk_size):
+        for sku, sku_lines in group_by_sku(chunk):
+            yield from _allocate_sku(sku, sku_lines, bus)
+
+
+def group_by_sku(chunk: List[Line]) -> Iterator[Tuple[Optional[str], List[Line]]]:
+    # malformed lines are grouped under None
+    by_sku = {}  # type: Dict[Optional[str], List[Line]]
+    for number, line in chunk:
+        sku = line['sku'] if _is_valid(line) else None
+        by_sku.setdefault(sku, []).append((number, line))
+    return iter(by_sku.items())
+
+
+def _is_valid(line) -> bool:
+    return (
+        isinstance(line, dict)
+        and isinstance(line.get('orderid'), str)
+        and isinstance(line.get('sku'), str)
+        and isinstance(line.get('qty'), int)
+    )
+
+
+def _allocate_sku(sku, lines: List[Line], bus) -> Iterator[dict]:
+    if sku is None:
+        for number, _ in lines:
+            yield dict(line=number, error='expected orderid, sku and an integer qty')
+        return
+    try:
+        batchrefs = bus.handle(commands.AllocateMany(
+            sku, [(line['orderid'], line['qty']) for _, line in lines],
+        ))
+    except (InvalidSku, ConcurrencyConflict) as e:
+        batchrefs = [e] * len(lines)
+    except Exception:  # pylint: disable=broad-except
+        # the other skus' lines can still be allocated
+        logger.exception('Exception allocating %d lines of %s', len(lines), sku)
+        batchrefs = [Exception('could not allocate')] * len(lines)
+    for (number, line), batchref in zip(lines, batchrefs):
+        yield _result(number, line, batchref)
+
+
+def _result(number: int, line: dict, batchref) -> dict:
+    outcome = dict(line=number, orderid=line['orderid'], sku=line['sku'])
+    if isinstance(batchref, Exception):
+        outcome['error'] = str(batchref)
+    elif batchref is None:
+        outcome['error'] = 'out of stock'
+    else:
+        outcome['batchref'] = batchref
+    return outcome
@@ -0,0 +1,65 @@
+import argparse
+import csv
+import json
+import logging
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import IO, Iterable, Iterator, List
+
+from allocation import bootstrap
+from allocation.adapters import view_cache
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import batches from CSV or JSON lines')
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+    bus = bootstrap.bootstrap(view_cache=view_cache.from_config(shared=True))
+    imported = import_batches(args.path, bus, chunk_size=args.chunk_size)
+    logger.info('imported %d batches from %s', imported, args.path)
+
+
+def import_batches(path: Path, bus, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    # rows are read lazily and handled a chunk (one transaction) at a time,
+    # so memory use doesn't depend on the size of the file
+    imported = 0
+    with open(path, newline='') as f:
+        for chunk in chunked(read_batches(f, path.suffix), chunk_size):
+            bus.handle(commands.CreateBatches(chunk))
+            imported += len(chunk)
+            logger.debug('imported %d batches', imported)
+    return imported
+
+
+def read_batches(f: IO[str], suffix: str) -> Iterator[commands.CreateBatch]:
+    if suffix == '.csv':
+        rows = csv.DictReader(f)  # type: Iterable[dict]
+    elif suffix in ('.jsonl', '.ndjson'):
+        rows = (json.loads(line) for line in f if line.strip())
+    else:
+        raise ValueError(f'unsupported file type {suffix!r}')
+    for row in rows:
+        eta = row.get('eta') or None
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        yield commands.CreateBatch(row['ref'], row['sku'], int(row['qty']), eta)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+if __name__ == '__main__':
+    main()
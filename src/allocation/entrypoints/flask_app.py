@@ -1,11 +1,16 @@
+import json
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from allocation.domain import commands
 from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation.service_layer.unit_of_work import ConcurrencyConflict
+from allocation import bootstrap, metrics, views
+from allocation.adapters import view_cache
+from allocation.entrypoints import batch_allocation
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+allocations_cache = view_cache.from_config()
+bus = bootstrap.bootstrap(view_cache=allocations_cache)
 
 
 @app.route("/add_batch", methods=['POST'])
@@ -29,13 +34,89 @@ def allocate_endpoint():
         bus.handle(cmd)
     except InvalidSku as e:
         return jsonify({'message': str(e)}), 400
+    except ConcurrencyConflict as e:
+        return jsonify({'message': str(e)}), 409
 
     return 'OK', 202
 
 
+@app.route("/allocate/batch", methods=['POST'])
+def allocate_batch_endpoint():
+    # takes a JSON array of {orderid, sku, qty}, or the same as NDJSON, which
+    # is read as it streams in. answers with one NDJSON result per line
+    if request.mimetype == 'application/x-ndjson':
+        numbered = batch_allocation.read_json_lines(request.stream)
+    else:
+        lines = request.get_json()
+        if not isinstance(lines, list):
+            return jsonify({'message': 'expected a list of order lines'}), 400
+        numbered = enumerate(lines)
+    results = batch_allocation.allocate_lines(numbered, bus)
+    return _ndjson(stream_with_context(results))
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    # every counter, summary and gauge this process has recorded
+    return jsonify(metrics.snapshot()), 200
+
+
 @app.route("/allocations/<orderid>", methods=['GET'])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, bus.uow, cache=allocations_cache)
     if not result:
         return 'not found', 404
     return jsonify(result), 200
+
+
+# these stream NDJSON, one allocation per line, in (orderid, sku, batchref)
+# order. a client that gets cut off can resume from the last line it read
+# with ?after_orderid=...&after_sku=...&after_batchref=...
+
+@app.route("/allocations/sku/<sku>", methods=['GET'])
+def allocations_for_sku_endpoint(sku):
+    try:
+        page_args = _page_args()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return _ndjson(views.allocations_for_sku(sku, bus.uow, **page_args))
+
+
+@app.route("/allocations/batch/<batchref>", methods=['GET'])
+def allocations_for_batch_endpoint(batchref):
+    try:
+        page_args = _page_args()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return _ndjson(views.allocations_for_batch(batchref, bus.uow, **page_args))
+
+
+@app.route("/allocations", methods=['GET'])
+def all_allocations_endpoint():
+    try:
+        page_args = _page_args()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return _ndjson(views.all_allocations(bus.uow, **page_args))
+
+
+AFTER_ARGS = ('after_orderid', 'after_sku', 'after_batchref')
+
+
+def _page_args():
+    args = {}
+    given = [name for name in AFTER_ARGS if name in request.args]
+    if given and len(given) != len(AFTER_ARGS):
+        raise ValueError(f'after needs all of {", ".join(AFTER_ARGS)}')
+    if given:
+        args['after'] = tuple(request.args[name] for name in AFTER_ARGS)
+    if 'page_size' in request.args:
+        page_size = request.args['page_size']
+        if not page_size.isdigit() or int(page_size) < 1:
+            raise ValueError('page_size must be an integer of at least 1')
+        args['page_size'] = int(page_size)
+    return args
+
+
+def _ndjson(rows):
+    return Response((json.dumps(row) + '\n' for row in rows), mimetype='application/x-ndjson')
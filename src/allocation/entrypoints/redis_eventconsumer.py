@@ -3,17 +3,16 @@ import logging
 import redis
 
 from allocation import bootstrap, config
+from allocation.adapters import view_cache
 from allocation.domain import commands
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
-
-
 
 def main():
     logger.info('Redis pubsub starting')
-    bus = bootstrap.bootstrap()
+    r = redis.Redis(**config.get_redis_host_and_port())
+    bus = bootstrap.bootstrap(view_cache=view_cache.from_config(shared=True))
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe('change_batch_quantity')
 
@@ -0,0 +1,185 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from allocation import bootstrap, config
+from allocation.adapters import view_cache
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+# (message id, fields)
+Message = Tuple[bytes, Dict[bytes, bytes]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consume change_batch_quantity from a redis stream')
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+    if args.processes == 1:
+        consume()
+        return
+    workers = [
+        multiprocessing.Process(target=consume, name=f'stream-consumer-{i}')
+        for i in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def consume():
+    # each process is its own consumer in the group, named after its host
+    # and pid, and sets up its own redis client and bus
+    import redis  # pylint: disable=import-outside-toplevel
+    client = redis.Redis(**config.get_redis_host_and_port())
+    bus = bootstrap.bootstrap(view_cache=view_cache.from_config(shared=True))
+    consumer = StreamConsumer(
+        client, bus, f'{socket.gethostname()}-{os.getpid()}',
+        **config.get_stream_consumer_settings(),
+    )
+    logger.info('redis stream consumer %s starting', consumer.consumer)
+    consumer.run()
+
+
+class StreamConsumer:
+    # reads change_batch_quantity commands from a stream as one of a consumer
+    # group, so that several consumers share the work and a message is only
+    # acked once it has been handled. a consumer that dies leaves its
+    # messages pending, and once they have been idle for claim_idle_ms
+    # another consumer claims and handles them. a message that has been
+    # delivered max_deliveries times without being handled is moved to the
+    # <stream>:dead stream rather than being retried for ever. so messages
+    # for one batch can be handled out of order, and each command carries
+    # its message id for the handler to ignore a change older than one it
+    # has already applied
+
+    def __init__(
+        self, client, bus, consumer: str,
+        stream: str = 'change_batch_quantity', group: str = 'allocation',
+        count: int = 100, block_ms: int = 5000,
+        claim_idle_ms: int = 60000, max_deliveries: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.client = client
+        self.bus = bus
+        self.consumer = consumer
+        self.stream = stream
+        self.group = group
+        self.count = count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.clock = clock
+        self._claim_from = b'0-0'
+        self._next_claim = 0.0
+        self._group_created = False
+
+    def run(self):
+        while True:
+            self.run_once()
+
+    def run_once(self) -> int:
+        self.ensure_group()
+        messages = []  # type: List[Message]
+        if self.clock() >= self._next_claim:
+            messages = self.claim_stale()
+        if not messages:
+            messages = self.read_new()
+        self.handle_batch(messages)
+        return len(messages)
+
+    def ensure_group(self):
+        if self._group_created:
+            return
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except Exception as e:  # pylint: disable=broad-except
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_created = True
+
+    def read_new(self) -> List[Message]:
+        response = self.client.xreadgroup(
+            self.group, self.consumer, {self.stream: '>'},
+            count=self.count, block=self.block_ms,
+        )
+        if isinstance(response, dict):
+            response = response.items()
+        return [message for _, messages in response or [] for message in messages]
+
+    def claim_stale(self) -> List[Message]:
+        # XAUTOCLAIM walks the pending list a page at a time; the cursor
+        # wraps back to 0-0 once it reaches the end, and then there's no
+        # need to look again for a while
+        response = self.client.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=self.claim_idle_ms, start_id=self._claim_from, count=self.count,
+        )
+        self._claim_from, claimed = response[0], response[1]
+        if self._claim_from in (b'0-0', '0-0'):
+            self._next_claim = self.clock() + self.claim_idle_ms / 2000
+        claimed = [(message_id, fields) for message_id, fields in claimed if fields]
+        if not claimed:
+            return []
+        deliveries = {
+            entry['message_id']: entry['times_delivered']
+            for entry in self.client.xpending_range(
+                self.stream, self.group, min=claimed[0][0], max=claimed[-1][0],
+                count=len(claimed), consumername=self.consumer,
+            )
+        }
+        live, dead = [], []
+        for message in claimed:
+            if deliveries.get(message[0], 0) > self.max_deliveries:
+                dead.append(message)
+            else:
+                live.append(message)
+        if dead:
+            logger.error('giving up on %d messages from %s', len(dead), self.stream)
+            self.acknowledge([], dead=dead)
+        return live
+
+    def handle_batch(self, messages: List[Message]):
+        handled = []
+        for message_id, fields in messages:
+            try:
+                self.bus.handle(parse_command(message_id, fields))
+            except Exception:  # pylint: disable=broad-except
+                # left pending, to be claimed again once it's been idle
+                logger.exception('Exception handling message %s', message_id)
+                continue
+            handled.append(message_id)
+        self.acknowledge(handled)
+
+    def acknowledge(self, message_ids: List[bytes], dead: Iterable[Message] = ()):
+        # the dead letters and all the acks go in one round trip
+        dead = list(dead)
+        if not message_ids and not dead:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for _, fields in dead:
+            pipe.xadd(f'{self.stream}:dead', fields)
+        pipe.xack(self.stream, self.group, *message_ids, *(i for i, _ in dead))
+        pipe.execute()
+
+
+def parse_command(message_id: bytes, fields: Dict[bytes, bytes]) -> commands.ChangeBatchQuantity:
+    # messages carry the same json as the pubsub channel, in a data field.
+    # consumers can handle messages out of order, so the message id goes
+    # with the command for the handler to spot a stale one
+    data = json.loads(fields[b'data'])
+    return commands.ChangeBatchQuantity(
+        ref=data['batchref'], qty=data['qty'],
+        sequence=message_id.decode() if isinstance(message_id, bytes) else message_id,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import threading
+from typing import Dict, Union
+
+_lock = threading.Lock()
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        with _lock:
+            self.value += amount
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+class Summary:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        with _lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max}
+
+
+class Gauge:
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        with _lock:
+            self.value = value
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+_registry = {}  # type: Dict[str, Union[Counter, Summary, Gauge]]
+
+
+def _get_or_create(name, metric_class):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = metric_class()
+        metric = _registry[name]
+    if not isinstance(metric, metric_class):
+        raise TypeError(f'metric {name} is a {type(metric).__name__}')
+    return metric
+
+
+def counter(name: str) -> Counter:
+    return _get_or_create(name, Counter)
+
+
+def summary(name: str) -> Summary:
+    return _get_or_create(name, Summary)
+
+
+def gauge(name: str) -> Gauge:
+    return _get_or_create(name, Gauge)
+
+
+def snapshot() -> Dict[str, dict]:
+    with _lock:
+        return {name: metric.as_dict() for name, metric in _registry.items()}
+
+
+def reset():
+    with _lock:
+        _registry.clear()
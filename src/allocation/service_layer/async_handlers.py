@@ -0,0 +1,135 @@
+#pylint: disable=unused-argument
+from __future__ import annotations
+from dataclasses import asdict
+from typing import List, Dict, Callable, Optional, Type, TYPE_CHECKING
+from allocation.domain import commands, events, model
+from allocation.service_layer import read_model
+from allocation.service_layer.handlers import (
+    add_to_product, allocate_many_to_product, allocate_to_product,
+    bulk_insert_batches, is_latest_change, observe_evicted, out_of_stock_notification,
+)
+if TYPE_CHECKING:
+    from allocation.adapters import notifications
+    from allocation.adapters.view_cache import AbstractViewCache
+    from . import unit_of_work
+
+
+# the same handlers as in handlers.py, sharing their bodies, with the unit
+# of work and any other IO awaited
+
+async def add_batch(
+        cmd: commands.CreateBatch, uow: unit_of_work.AbstractAsyncUnitOfWork
+):
+    async with uow:
+        add_to_product(cmd, await uow.products.get(sku=cmd.sku), uow.products)
+        await uow.commit()
+
+
+async def add_batches(
+        cmd: commands.CreateBatches, uow: unit_of_work.SqlAlchemyAsyncUnitOfWork
+):
+    async with uow:
+        await uow.run_sync(bulk_insert_batches, uow.session, cmd.batches)
+        await uow.commit()
+
+
+async def allocate(
+        cmd: commands.Allocate, uow: unit_of_work.AbstractAsyncUnitOfWork
+):
+    async with uow:
+        allocate_to_product(cmd, await uow.products.get(sku=cmd.sku))
+        await uow.commit()
+
+
+async def allocate_many(
+        cmd: commands.AllocateMany, uow: unit_of_work.AbstractAsyncUnitOfWork
+):
+    async with uow:
+        results = allocate_many_to_product(cmd, await uow.products.get(sku=cmd.sku))
+        await uow.commit()
+    return results
+
+
+async def reallocate(
+        event: events.Deallocated, uow: unit_of_work.AbstractAsyncUnitOfWork
+):
+    await allocate(commands.Allocate(**asdict(event)), uow=uow)
+
+
+async def change_batch_quantity(
+        cmd: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractAsyncUnitOfWork,
+        deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        if cmd.sequence is not None and not await uow.run_sync(
+                is_latest_change, uow.session, cmd):
+            return
+        evicted = product.change_batch_quantity(
+            ref=cmd.ref, qty=cmd.qty, policy=deallocation_policy,
+        )
+        await uow.commit()
+    observe_evicted(evicted)
+
+
+async def send_out_of_stock_notification(
+        event: events.OutOfStock,
+        notifications: notifications.AbstractAsyncNotifications,
+):
+    await notifications.send(*out_of_stock_notification(event))
+
+
+async def publish_allocated_event(
+        event: events.Allocated, publish: Callable,
+):
+    await publish('line_allocated', event)
+
+
+async def add_allocation_to_read_model(
+        event: events.Allocated, uow: unit_of_work.SqlAlchemyAsyncUnitOfWork,
+        view_cache: Optional[AbstractViewCache] = None,
+):
+    async with uow:
+        await uow.run_sync(
+            uow.session.execute, read_model.INSERT_ALLOCATIONS,
+            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+        )
+        await uow.commit()
+    await _invalidate(view_cache, event.orderid, uow)
+
+
+async def remove_allocation_from_read_model(
+        event: events.Deallocated, uow: unit_of_work.SqlAlchemyAsyncUnitOfWork,
+        view_cache: Optional[AbstractViewCache] = None,
+):
+    async with uow:
+        await uow.run_sync(
+            uow.session.execute, read_model.DELETE_ALLOCATIONS,
+            dict(orderid=event.orderid, sku=event.sku),
+        )
+        await uow.commit()
+    await _invalidate(view_cache, event.orderid, uow)
+
+
+async def _invalidate(
+        view_cache: Optional[AbstractViewCache], orderid: str,
+        uow: unit_of_work.SqlAlchemyAsyncUnitOfWork,
+):
+    # once committed, as with read_model.AllocationsViewWriter.flush
+    if view_cache is not None:
+        await uow.run_sync(view_cache.invalidate, [orderid])
+
+
+EVENT_HANDLERS = {
+    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
+    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.CreateBatches: add_batches,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+}  # type: Dict[Type[commands.Command], Callable]
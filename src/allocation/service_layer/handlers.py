@@ -1,45 +1,127 @@
 #pylint: disable=unused-argument
 from __future__ import annotations
 from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from typing import List, Dict, Callable, Optional, Tuple, Type, TYPE_CHECKING
+from allocation import metrics
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from allocation.service_layer.unit_of_work import conflicts_retried
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
-    from . import unit_of_work
+    from allocation.adapters import notifications, repository
+    from . import read_model, unit_of_work
 
 
 class InvalidSku(Exception):
     pass
 
 
+def parallel_safe(handler: Callable) -> Callable:
+    # marks an event handler as independent of the handlers declared next to
+    # it, so a MessageBus with an executor may run them concurrently
+    handler.parallel_safe = True  # type: ignore
+    return handler
+
+
+# the bodies of the command handlers, given the product they work on, are
+# shared with async_handlers, which differ only in how they fetch and save it
 
 def add_batch(
         cmd: commands.CreateBatch, uow: unit_of_work.AbstractUnitOfWork
 ):
     with uow:
-        product = uow.products.get(sku=cmd.sku)
-        if product is None:
-            product = model.Product(cmd.sku, batches=[])
-            uow.products.add(product)
-        product.batches.append(model.Batch(
-            cmd.ref, cmd.sku, cmd.qty, cmd.eta
-        ))
+        _add_to_product(cmd, uow)
+        uow.commit()
+
+
+def add_batches(
+        cmd: commands.CreateBatches, uow: unit_of_work.AbstractUnitOfWork
+):
+    with uow:
+        if uow.mapped_tables:
+            bulk_insert_batches(uow.session, cmd.batches)
+        else:
+            # eg event-sourced products, which are only stored through
+            # uow.products; still one transaction for the lot
+            for batch in cmd.batches:
+                _add_to_product(batch, uow)
         uow.commit()
 
 
+def _add_to_product(cmd: commands.CreateBatch, uow: unit_of_work.AbstractUnitOfWork):
+    add_to_product(cmd, uow.products.get(sku=cmd.sku), uow.products)
+
+
+def add_to_product(
+        cmd: commands.CreateBatch, product: Optional[model.Product],
+        products: repository.AbstractRepository,
+):
+    if product is None:
+        product = model.Product(cmd.sku, batches=[])
+        products.add(product)
+    product.add_batch(model.Batch(
+        cmd.ref, cmd.sku, cmd.qty, cmd.eta
+    ))
+
+
+def bulk_insert_batches(session, batches: List[commands.CreateBatch]):
+    # bypasses the Product aggregate: a new batch can't invalidate anything
+    # already allocated, so there's nothing to check, just rows to write.
+    # skus are taken in order, so concurrent imports lock products in the
+    # same order
+    skus = sorted({b.sku for b in batches})
+    session.execute(
+        'INSERT INTO products (sku, version_number)'
+        ' SELECT :sku, 0 WHERE NOT EXISTS (SELECT 1 FROM products WHERE sku = :sku)',
+        [dict(sku=sku) for sku in skus],
+    )
+    session.execute(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+        ' VALUES (:ref, :sku, :qty, :eta)',
+        [
+            dict(ref=b.ref, sku=b.sku, qty=b.qty, eta=b.eta)
+            for b in sorted(batches, key=lambda b: b.sku)
+        ],
+    )
+    # a product's batches changed, so its version does too
+    session.execute(
+        'UPDATE products SET version_number = version_number + 1 WHERE sku = :sku',
+        [dict(sku=sku) for sku in skus],
+    )
+
+
 def allocate(
         cmd: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
 ):
-    line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
     with uow:
-        product = uow.products.get(sku=line.sku)
-        if product is None:
-            raise InvalidSku(f'Invalid sku {line.sku}')
-        product.allocate(line)
+        allocate_to_product(cmd, uow.products.get(sku=cmd.sku))
         uow.commit()
 
 
+def allocate_to_product(cmd: commands.Allocate, product: Optional[model.Product]):
+    if product is None:
+        raise InvalidSku(f'Invalid sku {cmd.sku}')
+    product.allocate(OrderLine(cmd.orderid, cmd.sku, cmd.qty))
+
+
+def allocate_many(
+        cmd: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork
+):
+    with uow:
+        results = allocate_many_to_product(cmd, uow.products.get(sku=cmd.sku))
+        uow.commit()
+    return results
+
+
+def allocate_many_to_product(
+        cmd: commands.AllocateMany, product: Optional[model.Product],
+) -> List[Optional[str]]:
+    if product is None:
+        raise InvalidSku(f'Invalid sku {cmd.sku}')
+    return product.allocate_many([
+        OrderLine(orderid, cmd.sku, qty) for orderid, qty in cmd.lines
+    ])
+
+
 def reallocate(
         event: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
 ):
@@ -47,12 +129,53 @@ def reallocate(
 
 
 def change_batch_quantity(
-        cmd: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractUnitOfWork
+        cmd: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractUnitOfWork,
+        deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
 ):
     with uow:
         product = uow.products.get_by_batchref(batchref=cmd.ref)
-        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        if cmd.sequence is not None and not is_latest_change(uow.session, cmd):
+            return
+        evicted = product.change_batch_quantity(
+            ref=cmd.ref, qty=cmd.qty, policy=deallocation_policy,
+        )
         uow.commit()
+    observe_evicted(evicted)
+
+
+def observe_evicted(evicted: List[OrderLine]):
+    # once committed, so that a retried change isn't counted twice
+    metrics.summary('lines_evicted_per_batch_quantity_change').observe(len(evicted))
+
+
+def is_latest_change(session, cmd: commands.ChangeBatchQuantity) -> bool:
+    # quantities are absolute, so a change that arrives after a later one
+    # (eg redelivered from a stream after another consumer has moved on)
+    # would undo it. two changes to the same batch can both read the old
+    # sequence; the second to write it then fails on the primary key (or,
+    # under repeatable read, with a serialization failure), which is raised
+    # as a ConcurrencyConflict so that the bus retries it and it reads the
+    # sequence afresh
+    with conflicts_retried(integrity_errors=True):
+        applied = session.execute(
+            'SELECT sequence FROM batch_quantity_changes WHERE reference = :ref',
+            dict(ref=cmd.ref),
+        ).scalar()
+        if applied is not None and _sequence_key(applied) >= _sequence_key(cmd.sequence):
+            metrics.counter('stale_batch_quantity_changes').inc()
+            return False
+        session.execute(
+            'UPDATE batch_quantity_changes SET sequence = :sequence WHERE reference = :ref'
+            if applied is not None else
+            'INSERT INTO batch_quantity_changes (reference, sequence) VALUES (:ref, :sequence)',
+            dict(ref=cmd.ref, sequence=cmd.sequence),
+        )
+    return True
+
+
+def _sequence_key(sequence: str):
+    # stream ids are <milliseconds>-<sequence number>
+    return tuple(int(part) for part in sequence.split('-'))
 
 
 #pylint: disable=unused-argument
@@ -60,40 +183,32 @@ def change_batch_quantity(
 def send_out_of_stock_notification(
         event: events.OutOfStock, notifications: notifications.AbstractNotifications,
 ):
-    notifications.send(
-        'stock@made.com',
-        f'Out of stock for {event.sku}',
-    )
+    notifications.send(*out_of_stock_notification(event))
+
+
+def out_of_stock_notification(event: events.OutOfStock) -> Tuple[str, str]:
+    # (destination, message)
+    return 'stock@made.com', f'Out of stock for {event.sku}'
 
 
+@parallel_safe
 def publish_allocated_event(
         event: events.Allocated, publish: Callable,
 ):
     publish('line_allocated', event)
 
 
+@parallel_safe
 def add_allocation_to_read_model(
-        event: events.Allocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        event: events.Allocated, allocations_view: read_model.AllocationsViewWriter,
 ):
-    with uow:
-        uow.session.execute(
-            'INSERT INTO allocations_view (orderid, sku, batchref)'
-            ' VALUES (:orderid, :sku, :batchref)',
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
-        )
-        uow.commit()
+    allocations_view.add(event.orderid, event.sku, event.batchref)
 
 
 def remove_allocation_from_read_model(
-        event: events.Deallocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        event: events.Deallocated, allocations_view: read_model.AllocationsViewWriter,
 ):
-    with uow:
-        uow.session.execute(
-            'DELETE FROM allocations_view '
-            ' WHERE orderid = :orderid AND sku = :sku',
-            dict(orderid=event.orderid, sku=event.sku)
-        )
-        uow.commit()
+    allocations_view.remove(event.orderid, event.sku)
 
 
 EVENT_HANDLERS = {
@@ -104,6 +219,8 @@ EVENT_HANDLERS = {
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
+    commands.CreateBatches: add_batches,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
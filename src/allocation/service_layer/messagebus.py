@@ -1,8 +1,19 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
+import asyncio
+import inspect
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import random
+import time
+from collections import deque
+from concurrent.futures import Executor
+from functools import partial
+from typing import (
+    Any, Awaitable, Callable, Deque, Dict, List, Optional, Union, Type, TYPE_CHECKING,
+)
+from allocation import metrics
 from allocation.domain import commands, events
+from .unit_of_work import ConcurrencyConflict
 
 if TYPE_CHECKING:
     from . import unit_of_work
@@ -12,6 +23,51 @@ logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]
 
 
+class RetryPolicy:
+    # a handler that loses an optimistic-concurrency race is re-run from
+    # scratch, after a "full jitter" exponential backoff, so that competing
+    # writers don't retry in lockstep
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.05, max_delay: float = 1.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def should_retry(self, attempt: int) -> bool:
+        metrics.counter('concurrency_conflicts').inc()
+        if attempt >= self.max_attempts:
+            return False
+        metrics.counter('command_retries').inc()
+        return True
+
+    def run(self, handler: Callable, message: Message):
+        attempt = 1
+        while True:
+            try:
+                return handler(message)
+            except ConcurrencyConflict:
+                if not self.should_retry(attempt):
+                    raise
+                logger.info('retrying %s after a concurrency conflict', message)
+                time.sleep(self.delay(attempt))
+                attempt += 1
+
+    async def run_async(self, handler: Callable, message: Message):
+        attempt = 1
+        while True:
+            try:
+                return await _call(handler, message)
+            except ConcurrencyConflict:
+                if not self.should_retry(attempt):
+                    raise
+                logger.info('retrying %s after a concurrency conflict', message)
+                await asyncio.sleep(self.delay(attempt))
+                attempt += 1
+
+
 class MessageBus:
 
     def __init__(
@@ -19,40 +75,198 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        executor: Optional[Executor] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        after_handle: Optional[List[Callable[[], None]]] = None,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.retry_policy = retry_policy or RetryPolicy()
+        # run once handle() has worked through the whole queue, eg to flush
+        # writes that handlers have buffered
+        self.after_handle = after_handle or []
+        # with an executor, consecutive parallel-safe handlers for an event
+        # run concurrently on it; any other handler runs on its own, in order
+        self.executor = executor
+        # resolve message type -> handler(s) once, so the dispatch loop is a
+        # single dict lookup per message
+        self._routes = {}  # type: Dict[type, Callable[[Message], Any]]
+        for event_type, handlers in event_handlers.items():
+            steps = group_parallel_safe(handlers) if executor else handlers
+            self._routes[event_type] = partial(self._run_event_handlers, steps)
+        for command_type, handler in command_handlers.items():
+            self._routes[command_type] = partial(self._run_command_handler, handler)
 
     def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f'{message} was not an Event or Command')
+        # returns what the handler for the message itself returned (for a
+        # command), not anything from the events that follow from it
+        first = message
+        result = None
+        self.queue = deque([message])  # type: Deque[Message]
+        try:
+            while self.queue:
+                message = self.queue.popleft()
+                route = self._routes.get(type(message))
+                if route is None:
+                    route = self._unrouted(message)
+                outcome = route(message)
+                if message is first:
+                    result = outcome
+        finally:
+            self._run_after_handle_hooks()
+        return result
+
+    def _run_after_handle_hooks(self):
+        for hook in self.after_handle:
+            try:
+                hook()
+            except Exception:
+                logger.exception('Exception in after-handle hook %s', hook)
+
+    def _unrouted(self, message: Message) -> Callable[[Message], Any]:
+        if isinstance(message, events.Event):
+            return self.handle_event
+        if isinstance(message, commands.Command):
+            return self.handle_command
+        raise Exception(f'{message} was not an Event or Command')
 
 
     def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+        self._run_event_handlers(self.event_handlers[type(event)], event)
+
+    def _run_event_handlers(self, steps: List, event: events.Event):
+        for step in steps:
+            if isinstance(step, list):
+                self._run_concurrently(step, event)
+                continue
             try:
-                logger.debug('handling event %s with handler %s', event, handler)
-                handler(event)
+                logger.debug('handling event %s with handler %s', event, step)
+                self.retry_policy.run(step, event)
                 self.queue.extend(self.uow.collect_new_events())
             except Exception:
                 logger.exception('Exception handling event %s', event)
                 continue
 
+    def _run_concurrently(self, handlers: List[Callable], event: events.Event):
+        futures = [
+            self.executor.submit(self._run_isolated, handler, event)
+            for handler in handlers
+        ]
+        for future in futures:
+            self.queue.extend(future.result())
+
+    def _run_isolated(self, handler: Callable, event: events.Event) -> List[Message]:
+        # runs on an executor thread, so events raised by the handler are
+        # collected there, from that thread's view of the uow
+        try:
+            logger.debug('handling event %s with handler %s', event, handler)
+            self.retry_policy.run(handler, event)
+            return list(self.uow.collect_new_events())
+        except Exception:
+            logger.exception('Exception handling event %s', event)
+            return []
+
 
     def handle_command(self, command: commands.Command):
-        logger.debug('handling command %s', command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
+        except KeyError:
+            logger.exception('Exception handling command %s', command)
+            raise
+        return self._run_command_handler(handler, command)
+
+    def _run_command_handler(self, handler: Callable, command: commands.Command):
+        logger.debug('handling command %s', command)
+        try:
+            result = self.retry_policy.run(handler, command)
             self.queue.extend(self.uow.collect_new_events())
+            return result
         except Exception:
             logger.exception('Exception handling command %s', command)
             raise
+
+
+
+def group_parallel_safe(handlers: List[Callable]) -> List:
+    steps = []  # type: List
+    for handler in handlers:
+        if not getattr(handler, 'parallel_safe', False):
+            steps.append(handler)
+        elif steps and isinstance(steps[-1], list):
+            steps[-1].append(handler)
+        else:
+            steps.append([handler])
+    return [s[0] if isinstance(s, list) and len(s) == 1 else s for s in steps]
+
+
+
+class AsyncMessageBus:
+    # handlers may be coroutine functions or plain callables. queues are
+    # per-handle() call, so one bus can have many messages in flight at once
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractAsyncUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._routes = {}  # type: Dict[type, Callable[..., Awaitable]]
+        for event_type, handlers in event_handlers.items():
+            self._routes[event_type] = partial(self._run_event_handlers, handlers)
+        for command_type, handler in command_handlers.items():
+            self._routes[command_type] = partial(self._run_command_handler, handler)
+
+    async def handle(self, message: Message):
+        first = message
+        result = None
+        queue = deque([message])  # type: Deque[Message]
+        while queue:
+            message = queue.popleft()
+            route = self._routes.get(type(message))
+            if route is None:
+                if isinstance(message, (events.Event, commands.Command)):
+                    raise KeyError(type(message))
+                raise Exception(f'{message} was not an Event or Command')
+            outcome = await route(message, queue)
+            if message is first:
+                result = outcome
+        return result
+
+
+    async def _run_event_handlers(
+        self, handlers: List[Callable], event: events.Event, queue: Deque[Message],
+    ):
+        for handler in handlers:
+            try:
+                logger.debug('handling event %s with handler %s', event, handler)
+                await self.retry_policy.run_async(handler, event)
+                queue.extend(self.uow.collect_new_events())
+            except Exception:
+                logger.exception('Exception handling event %s', event)
+                continue
+
+
+    async def _run_command_handler(
+        self, handler: Callable, command: commands.Command, queue: Deque[Message],
+    ):
+        logger.debug('handling command %s', command)
+        try:
+            result = await self.retry_policy.run_async(handler, command)
+            queue.extend(self.uow.collect_new_events())
+            return result
+        except Exception:
+            logger.exception('Exception handling command %s', command)
+            raise
+
+
+async def _call(handler: Callable, message: Message):
+    result = handler(message)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
@@ -0,0 +1,80 @@
+from __future__ import annotations
+import threading
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from allocation import metrics
+if TYPE_CHECKING:
+    from allocation.adapters.view_cache import AbstractViewCache
+    from . import unit_of_work
+
+
+INSERT_ALLOCATIONS = (
+    'INSERT INTO allocations_view (orderid, sku, batchref)'
+    ' VALUES (:orderid, :sku, :batchref)'
+)
+DELETE_ALLOCATIONS = (
+    'DELETE FROM allocations_view'
+    ' WHERE orderid = :orderid AND sku = :sku'
+)
+
+
+class _PendingRows:
+    __slots__ = ('delete', 'inserts')
+
+    def __init__(self):
+        self.delete = False
+        self.inserts = []  # type: List[str]
+
+
+class AllocationsViewWriter:
+    # buffers allocations_view changes, to be written in one transaction when
+    # the message bus has finished handling a message. changes are kept per
+    # (orderid, sku): a delete supersedes any inserts buffered before it
+
+    def __init__(
+        self, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        cache: Optional[AbstractViewCache] = None,
+    ):
+        self.uow = uow
+        self.cache = cache
+        self._lock = threading.Lock()  # parallel-safe handlers share it
+        self._pending = {}  # type: Dict[Tuple[str, str], _PendingRows]
+
+    def add(self, orderid: str, sku: str, batchref: str):
+        with self._lock:
+            self._rows(orderid, sku).inserts.append(batchref)
+
+    def remove(self, orderid: str, sku: str):
+        with self._lock:
+            rows = self._rows(orderid, sku)
+            rows.delete = True
+            rows.inserts.clear()
+
+    def _rows(self, orderid, sku) -> _PendingRows:
+        key = (orderid, sku)
+        if key not in self._pending:
+            self._pending[key] = _PendingRows()
+        return self._pending[key]
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        deletes = [
+            dict(orderid=orderid, sku=sku)
+            for (orderid, sku), rows in pending.items() if rows.delete
+        ]
+        inserts = [
+            dict(orderid=orderid, sku=sku, batchref=batchref)
+            for (orderid, sku), rows in pending.items() for batchref in rows.inserts
+        ]
+        if not deletes and not inserts:
+            return
+        with self.uow:
+            if deletes:
+                self.uow.session.execute(DELETE_ALLOCATIONS, deletes)
+            if inserts:
+                self.uow.session.execute(INSERT_ALLOCATIONS, inserts)
+            self.uow.commit()
+        if self.cache is not None:
+            # only once committed, so a reader can't cache what's being replaced
+            self.cache.invalidate({orderid for orderid, _ in pending})
+        metrics.summary('read_model_rows_per_flush').observe(len(deletes) + len(inserts))
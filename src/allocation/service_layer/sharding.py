@@ -0,0 +1,126 @@
+import threading
+import zlib
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor,
+)
+from typing import Callable, Dict, List, Optional
+from allocation.domain import commands
+from . import messagebus
+
+_worker = threading.local()
+
+
+def _start_worker(bus_factory: Callable[[], messagebus.MessageBus]):
+    _worker.bus = bus_factory()
+
+
+def _handle(message: messagebus.Message):
+    return _worker.bus.handle(message)
+
+
+def shard_for(key: str, n_shards: int) -> int:
+    # hash() on strings is randomised per process, crc32 is stable
+    return zlib.crc32(key.encode()) % n_shards
+
+
+class ShardedWorkerPool:
+    # runs commands on n single-threaded workers, each with its own bus (and
+    # so its own unit of work), choosing the worker by sku. commands for one
+    # sku are handled one at a time, in submission order, so they never race
+    # each other on products.version_number.
+    #
+    # bus_factory is called once in each worker. with use_processes it must be
+    # picklable; in either mode it shouldn't start the mappers if they have
+    # already been started in this process (threads) or the parent (fork).
+
+    def __init__(
+        self,
+        bus_factory: Callable[[], messagebus.MessageBus],
+        n_workers: int,
+        sku_for_batchref: Callable[[str], Optional[str]],
+        use_processes: bool = False,
+        max_cached_batchrefs: int = 100_000,
+    ):
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._shards = [
+            executor_class(
+                max_workers=1, initializer=_start_worker, initargs=(bus_factory,),
+            )
+            for _ in range(n_workers)
+        ]  # type: List[Executor]
+        # a batch never changes sku, so a sku once found can be cached
+        # indefinitely. a batchref that isn't found isn't cached, since the
+        # batch may yet be created
+        self.sku_for_batchref = sku_for_batchref
+        self.max_cached_batchrefs = max_cached_batchrefs
+        self._lock = threading.Lock()
+        self._skus = {}  # type: Dict[str, str]
+
+    def submit(self, command: commands.Command) -> Future:
+        if isinstance(command, commands.CreateBatches):
+            return self._submit_by_shard(command)
+        shard = shard_for(self.routing_key(command), len(self._shards))
+        return self._shards[shard].submit(_handle, command)
+
+    def _submit_by_shard(self, command: commands.CreateBatches) -> Future:
+        # its batches can be for many skus, so each shard gets (and commits,
+        # as its own transaction) a CreateBatches of the batches for its skus
+        by_shard = {}  # type: Dict[int, List[commands.CreateBatch]]
+        for batch in command.batches:
+            by_shard.setdefault(shard_for(batch.sku, len(self._shards)), []).append(batch)
+        return _all_done([
+            self._shards[shard].submit(_handle, commands.CreateBatches(batches))
+            for shard, batches in by_shard.items()
+        ])
+
+    def routing_key(self, command: commands.Command) -> str:
+        if isinstance(command, commands.ChangeBatchQuantity):
+            return self._cached_sku_for_batchref(command.ref) or ''
+        return command.sku
+
+    def _cached_sku_for_batchref(self, batchref: str) -> Optional[str]:
+        sku = self._skus.get(batchref)
+        if sku is not None:
+            return sku
+        sku = self.sku_for_batchref(batchref)
+        if sku is not None:
+            with self._lock:
+                self._skus[batchref] = sku
+                if len(self._skus) > self.max_cached_batchrefs:
+                    # oldest first
+                    del self._skus[next(iter(self._skus))]
+        return sku
+
+    def shutdown(self, wait: bool = True):
+        for shard in self._shards:
+            shard.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def _all_done(futures: List[Future]) -> Future:
+    # done once all of futures are, with the first of their exceptions if any
+    combined = Future()  # type: Future
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def part_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result(None)
+
+    if not futures:
+        combined.set_result(None)
+    for future in futures:
+        future.add_done_callback(part_done)
+    return combined
@@ -1,17 +1,31 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import Executor
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.orm.session import Session
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import database, repository
+from allocation.domain import model
+
+
+class ConcurrencyConflict(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    # whether products live in the mapped tables, so that handlers may
+    # write those with plain SQL rather than going through uow.products
+    mapped_tables = False
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -23,9 +37,12 @@ class AbstractUnitOfWork(abc.ABC):
         self._commit()
 
     def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        # a thread that hasn't entered this uow yet has nothing to collect
+        products = getattr(self, 'products', None)
+        for product in products.seen if products else ():
+            if product.events:
+                new_events, product.events = product.events, []
+                yield from new_events
 
     @abc.abstractmethod
     def _commit(self):
@@ -37,27 +54,261 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(),
-    isolation_level="REPEATABLE READ",
+REPEATABLE_READ = 'repeatable_read'
+OPTIMISTIC = 'optimistic'
+SELECT_FOR_UPDATE = 'select_for_update'
+
+# with an explicit version check or row lock, the database doesn't need to
+# detect conflicts for us
+ISOLATION_LEVELS = {
+    REPEATABLE_READ: 'REPEATABLE READ',
+    OPTIMISTIC: 'READ COMMITTED',
+    SELECT_FOR_UPDATE: 'READ COMMITTED',
+}
+
+DEFAULT_SESSION_FACTORY = database.ProcessLocalSessionFactory(partial(
+    database.create_postgres_engine,
+    isolation_level=ISOLATION_LEVELS[config.get_concurrency_control()],
 ))
 
-class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+def commit_session(
+        session: Session, products: Iterable[model.Product], concurrency_control: str,
+):
+    with conflicts_retried():
+        if concurrency_control == OPTIMISTIC:
+            compare_and_swap_versions(session, products)
+        session.commit()
+
+
+@contextmanager
+def conflicts_retried(integrity_errors: bool = False):
+    # raises database errors that mean another transaction got there first
+    # as ConcurrencyConflict, for the message bus to retry: postgres
+    # serialization failures and deadlocks, and integrity errors when the
+    # caller's statements can only violate a constraint by racing someone
+    try:
+        yield
+    except IntegrityError as e:
+        if integrity_errors:
+            raise ConcurrencyConflict(str(e)) from e
+        raise
+    except DBAPIError as e:
+        if getattr(e.orig, 'pgcode', None) in ('40001', '40P01'):
+            raise ConcurrencyConflict(str(e)) from e
+        raise
+
+
+def compare_and_swap_versions(session: Session, products: Iterable[model.Product]):
+    for product in products:
+        history = get_history(product, 'version_number')
+        if not history.deleted:  # a new product, or its version didn't change
+            continue
+        [old_version], [new_version] = history.deleted, history.added
+        result = session.execute(
+            'UPDATE products SET version_number = :new_version'
+            ' WHERE sku = :sku AND version_number = :old_version',
+            dict(sku=product.sku, old_version=old_version, new_version=new_version),
+        )
+        if result.rowcount != 1:
+            raise ConcurrencyConflict(
+                f'{product.sku} was changed by someone else since version {old_version}'
+            )
+        # already written, so the flush doesn't need to write it again
+        set_committed_value(product, 'version_number', new_version)
+
+
+
+class _ContextLocalState:
+    # session and repository live in a context variable, so that threads (or
+    # asyncio tasks) sharing a uow each get their own
+
+    def __init__(self, concurrency_control=None):
+        self._state = contextvars.ContextVar(f'uow_{id(self)}', default=None)
+        self.concurrency_control = (
+            concurrency_control or config.get_concurrency_control()
+        )
+
+    @property
+    def session(self) -> Session:
+        return self._current()[0]
+
+    @property
+    def products(self):
+        return self._current()[1]
+
+    def _current(self):
+        state = self._state.get()
+        if state is None:
+            raise AttributeError('unit of work has not been entered')
+        return state
+
+
+
+class SqlAlchemyUnitOfWork(_ContextLocalState, AbstractUnitOfWork):
+    mapped_tables = True
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        concurrency_control=None,
+        product_cache: Optional[repository.ProductCache] = None,
+    ):
+        super().__init__(concurrency_control)
         self.session_factory = session_factory
+        # cached products aren't locked when they're read, so row locking
+        # can't use the cache
+        self.product_cache = (
+            product_cache if self.concurrency_control != SELECT_FOR_UPDATE else None
+        )
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        session = self.session_factory()  # type: Session
+        if self.product_cache is not None:
+            # committed products are cached as they are, so they mustn't
+            # be expired
+            session.expire_on_commit = False
+        self._state.set((session, repository.SqlAlchemyRepository(
+            session, for_update=self.concurrency_control == SELECT_FOR_UPDATE,
+            cache=self.product_cache,
+        ), {}))
         return super().__enter__()
 
+    @property
+    def _committed(self) -> Dict[str, Tuple[model.Product, int]]:
+        # sku -> (product, the version it was committed at)
+        return self._current()[2]
+
     def __exit__(self, *args):
+        if self.product_cache is not None:
+            self._cache_committed_products()
         super().__exit__(*args)
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        commit_session(self.session, self.products.seen, self.concurrency_control)
+        if self.product_cache is not None:
+            # products stay in the session until exit, so changes made after
+            # a commit are tracked like any others
+            for product in self.products.seen:
+                self._committed[product.sku] = (product, product.version_number)
+
+    def _cache_committed_products(self):
+        if not self._committed:
+            return
+        # anything changed since the last commit is about to be rolled back,
+        # so the products no longer match what's in the database
+        changed_since = bool(self.session.new or self.session.dirty or self.session.deleted)
+        # detach them first, or the rollback would expire them
+        self.session.expunge_all()
+        for product, version in self._committed.values():
+            if changed_since or product.version_number != version:
+                self.product_cache.discard(product.sku)
+            else:
+                self.product_cache.put(product)
 
     def rollback(self):
         self.session.rollback()
+
+
+
+class EventSourcedUnitOfWork(_ContextLocalState, AbstractUnitOfWork):
+    # products are stored by repository.EventSourcedRepository. appending to
+    # a product's event stream is its own conflict check, so the version
+    # compare-and-swap and row locks don't apply
+
+    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY, snapshot_every: int = 100):
+        super().__init__()
+        self.session_factory = session_factory
+        self.snapshot_every = snapshot_every
+
+    def __enter__(self):
+        session = self.session_factory()  # type: Session
+        self._state.set((session, repository.EventSourcedRepository(
+            session, snapshot_every=self.snapshot_every,
+        )))
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.session.close()
+
+    def _commit(self):
+        try:
+            self.products.save_changes()
+        except repository.EventStreamConflict as e:
+            raise ConcurrencyConflict(str(e)) from e
+        commit_session(self.session, (), self.concurrency_control)
+
+    def rollback(self):
+        self.session.rollback()
+
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AbstractAsyncRepository
+
+    async def __aenter__(self) -> AbstractAsyncUnitOfWork:
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    async def commit(self):
+        await self._commit()
+
+    def collect_new_events(self):
+        products = getattr(self, 'products', None)
+        for product in products.seen if products else ():
+            if product.events:
+                new_events, product.events = product.events, []
+                yield from new_events
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+
+class SqlAlchemyAsyncUnitOfWork(_ContextLocalState, AbstractAsyncUnitOfWork):
+    # blocking session work happens on an executor
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        executor: Optional[Executor] = None,
+        concurrency_control=None,
+    ):
+        super().__init__(concurrency_control)
+        self.session_factory = session_factory
+        self.executor = executor
+
+    async def run_sync(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(fn, *args, **kwargs)
+        )
+
+    async def __aenter__(self):
+        session = self.session_factory()
+        self._state.set((session, repository.SqlAlchemyAsyncRepository(
+            session, self.run_sync,
+            for_update=self.concurrency_control == SELECT_FOR_UPDATE,
+        )))
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.run_sync(self.session.close)
+
+    async def _commit(self):
+        await self.run_sync(
+            commit_session, self.session, self.products.seen, self.concurrency_control,
+        )
+
+    async def rollback(self):
+        await self.run_sync(self.session.rollback)
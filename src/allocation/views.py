@@ -1,9 +1,124 @@
+from typing import Dict, Iterator, Optional, Tuple
+from sqlalchemy import text
+from allocation import metrics
+from allocation.adapters.view_cache import AbstractViewCache
 from allocation.service_layer import unit_of_work
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+        orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        cache: Optional[AbstractViewCache] = None,
+):
+    if cache is not None:
+        rows, version = cache.get(orderid)
+        if rows is not None:
+            metrics.counter('view_cache_hits').inc()
+            return rows
+        metrics.counter('view_cache_misses').inc()
     with uow:
         results = list(uow.session.execute(
             'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid',
             dict(orderid=orderid)
         ))
-    return [dict(r) for r in results]
+    rows = [dict(r) for r in results]
+    if cache is not None:
+        cache.set(orderid, rows, version)
+    return rows
+
+
+async def allocations_async(
+        orderid: str, uow: unit_of_work.SqlAlchemyAsyncUnitOfWork,
+        cache: Optional[AbstractViewCache] = None,
+):
+    # as allocations(), with anything that blocks run on the uow's executor
+    if cache is not None:
+        rows, version = await uow.run_sync(cache.get, orderid)
+        if rows is not None:
+            metrics.counter('view_cache_hits').inc()
+            return rows
+        metrics.counter('view_cache_misses').inc()
+    async with uow:
+        results = await uow.run_sync(
+            lambda session: list(session.execute(
+                'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid',
+                dict(orderid=orderid)
+            )),
+            uow.session,
+        )
+    rows = [dict(r) for r in results]
+    if cache is not None:
+        await uow.run_sync(cache.set, orderid, rows, version)
+    return rows
+
+
+def sku_for_batchref(batchref: str, uow: unit_of_work.AbstractUnitOfWork):
+    # event-sourced products don't have rows in batches, only in batch_refs
+    table = 'batches' if uow.mapped_tables else 'batch_refs'
+    with uow:
+        return uow.session.execute(
+            f'SELECT sku FROM {table} WHERE reference = :batchref',
+            dict(batchref=batchref)
+        ).scalar()
+
+
+DEFAULT_PAGE_SIZE = 1000
+
+# (orderid, sku, batchref) of the last row already seen
+Keyset = Tuple[str, str, str]
+
+
+def allocations_for_sku(
+        sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        after: Optional[Keyset] = None, page_size: int = DEFAULT_PAGE_SIZE,
+) -> Iterator[dict]:
+    return _stream_allocations(uow, 'sku = :sku', dict(sku=sku), after, page_size)
+
+
+def allocations_for_batch(
+        batchref: str, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        after: Optional[Keyset] = None, page_size: int = DEFAULT_PAGE_SIZE,
+) -> Iterator[dict]:
+    return _stream_allocations(
+        uow, 'batchref = :batchref', dict(batchref=batchref), after, page_size,
+    )
+
+
+def all_allocations(
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        after: Optional[Keyset] = None, page_size: int = DEFAULT_PAGE_SIZE,
+) -> Iterator[dict]:
+    return _stream_allocations(uow, None, {}, after, page_size)
+
+
+def _stream_allocations(
+        uow: unit_of_work.SqlAlchemyUnitOfWork, condition: Optional[str],
+        params: Dict[str, str], after: Optional[Keyset], page_size: int,
+) -> Iterator[dict]:
+    # rows come a page at a time, each page in its own short transaction,
+    # starting after the last row of the one before (so no OFFSET scans),
+    # and each page is read through a server-side cursor where the
+    # database has them. nothing is held onto, however many rows there are
+    if page_size < 1:
+        raise ValueError(f'page_size must be at least 1, not {page_size}')
+    while True:
+        conditions = [condition] if condition else []
+        if after is not None:
+            conditions.append(
+                '(orderid, sku, batchref) > (:after_orderid, :after_sku, :after_batchref)'
+            )
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        statement = text(
+            f'SELECT orderid, sku, batchref FROM allocations_view{where}'
+            ' ORDER BY orderid, sku, batchref LIMIT :page_size'
+        )
+        page_params = dict(params, page_size=page_size)
+        if after is not None:
+            page_params.update(zip(('after_orderid', 'after_sku', 'after_batchref'), after))
+        rows_in_page = 0
+        with uow:
+            connection = uow.session.connection(execution_options={'stream_results': True})
+            for orderid, sku, batchref in connection.execute(statement, page_params):
+                rows_in_page += 1
+                after = (orderid, sku, batchref)
+                yield dict(orderid=orderid, sku=sku, batchref=batchref)
+        if rows_in_page == 0 or rows_in_page < page_size:
+            return
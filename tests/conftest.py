@@ -11,7 +11,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
-from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters.orm import ensure_indexes, metadata, start_mappers
 from allocation import config
 
 pytest.register_assert_rewrite('tests.e2e.api_client')
@@ -26,6 +26,17 @@ def in_memory_sqlite_db():
 def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
+@pytest.fixture
+def file_sqlite_session_factory(tmp_path):
+    # a file rather than :memory:, so that sessions on other threads (eg
+    # executor threads) see the same database
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "allocation.db"}',
+        connect_args={'check_same_thread': False},
+    )
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+
 @pytest.fixture
 def mappers():
     start_mappers()
@@ -55,6 +66,7 @@ def postgres_db():
     engine = create_engine(config.get_postgres_uri(), isolation_level='SERIALIZABLE')
     wait_for_postgres_to_come_up(engine)
     metadata.create_all(engine)
+    ensure_indexes(engine)
     return engine
 
 @pytest.fixture
@@ -82,3 +94,14 @@ def restart_redis_pubsub():
         ['docker-compose', 'restart', '-t', '0', 'redis_pubsub'],
         check=True,
     )
+
+@pytest.fixture
+def restart_redis_streams():
+    wait_for_redis_to_come_up()
+    if not shutil.which('docker-compose'):
+        print('skipping restart, assumes running in container')
+        return
+    subprocess.run(
+        ['docker-compose', 'restart', '-t', '0', 'redis_streams'],
+        check=True,
+    )
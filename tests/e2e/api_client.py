@@ -1,3 +1,4 @@
+import json
 import requests
 from allocation import config
 
@@ -23,3 +24,30 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f'{url}/allocations/{orderid}')
+
+
+def get_metrics():
+    url = config.get_api_url()
+    r = requests.get(f'{url}/metrics')
+    assert r.status_code == 200
+    return r.json()
+
+
+def get_allocations_for_sku(sku, expect_success=True, **params):
+    url = config.get_api_url()
+    r = requests.get(f'{url}/allocations/sku/{sku}', params=params, stream=True)
+    if not expect_success:
+        return r
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
+
+
+def post_to_allocate_batch(lines):
+    url = config.get_api_url()
+    body = ''.join(json.dumps(line) + '\n' for line in lines)
+    r = requests.post(
+        f'{url}/allocate/batch', data=body,
+        headers={'Content-Type': 'application/x-ndjson'}, stream=True,
+    )
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
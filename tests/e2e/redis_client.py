@@ -2,6 +2,7 @@ import json
 import redis
 
 from allocation import config
+from allocation.adapters import redis_eventpublisher
 
 r = redis.Redis(**config.get_redis_host_and_port())
 
@@ -16,3 +17,7 @@ def subscribe_to(channel):
 
 def publish_message(channel, message):
     r.publish(channel, json.dumps(message))
+
+
+def add_to_stream(stream, message):
+    return redis_eventpublisher.add_to_stream(stream, message)
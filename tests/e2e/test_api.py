@@ -36,3 +36,61 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_allocations_for_a_sku_stream_as_ndjson():
+    sku, batch = random_sku(), random_batchref()
+    orderids = sorted(random_orderid(str(i)) for i in range(3))
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    for orderid in orderids:
+        api_client.post_to_allocate(orderid, sku, qty=1)
+
+    rows = api_client.get_allocations_for_sku(sku, page_size=2)
+    assert rows == [dict(orderid=o, sku=sku, batchref=batch) for o in orderids]
+
+    rows = api_client.get_allocations_for_sku(
+        sku, after_orderid=orderids[0], after_sku=sku, after_batchref=batch,
+    )
+    assert [row['orderid'] for row in rows] == orderids[1:]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+@pytest.mark.parametrize('params', [
+    {'page_size': '0'}, {'page_size': 'abc'}, {'page_size': '-1'},
+    {'after_orderid': 'o1'},
+])
+def test_streaming_allocations_reject_bad_paging_arguments(params):
+    r = api_client.get_allocations_for_sku(random_sku(), expect_success=False, **params)
+    assert r.status_code == 400
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_batch_allocate_streams_a_result_per_line():
+    sku, batch = random_sku(), random_batchref()
+    o1, o2 = random_orderid(1), random_orderid(2)
+    api_client.post_to_add_batch(batch, sku, 10, None)
+
+    results = api_client.post_to_allocate_batch([
+        {'orderid': o1, 'sku': sku, 'qty': 6},
+        {'orderid': o2, 'sku': sku, 'qty': 6},
+    ])
+    assert results == [
+        {'line': 0, 'orderid': o1, 'sku': sku, 'batchref': batch},
+        {'line': 1, 'orderid': o2, 'sku': sku, 'error': 'out of stock'},
+    ]
+    assert api_client.get_allocation(o1).json() == [{'sku': sku, 'batchref': batch}]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_metrics_are_served_as_json():
+    sku, batch = random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(random_orderid(), sku, qty=3)
+
+    counters = api_client.get_metrics()
+    assert counters['read_model_rows_per_flush']['count'] >= 1
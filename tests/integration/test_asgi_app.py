@@ -0,0 +1,129 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import json
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap, metrics
+from allocation.adapters.view_cache import InMemoryViewCache
+from allocation.entrypoints.asgi_app import AllocationApp
+from allocation.service_layer import unit_of_work
+
+
+async def noop_publish(*args):
+    pass
+
+
+@pytest.fixture
+def app(file_sqlite_session_factory):
+    cache = InMemoryViewCache()
+    bus = bootstrap.bootstrap_async(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyAsyncUnitOfWork(file_sqlite_session_factory),
+        notifications=mock.AsyncMock(),
+        publish=noop_publish,
+        view_cache=cache,
+    )
+    yield AllocationApp(bus, cache=cache)
+    clear_mappers()
+
+
+async def request(app, method, path, body=None):
+    # calls the app the way an ASGI server would, with the body in two parts
+    data = json.dumps(body).encode() if body is not None else b''
+    incoming = [
+        {'type': 'http.request', 'body': data[:5], 'more_body': True},
+        {'type': 'http.request', 'body': data[5:], 'more_body': False},
+    ]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({'type': 'http', 'method': method, 'path': path}, receive, send)
+    start, response_body = sent
+    return start['status'], response_body['body']
+
+
+def test_allocates_and_reads_back_the_allocation(app):
+    async def scenario():
+        status, _ = await request(app, 'POST', '/add_batch', {
+            'ref': 'b1', 'sku': 'ASYNC-ARMCHAIR', 'qty': 10, 'eta': '2011-01-02',
+        })
+        assert status == 201
+        status, _ = await request(app, 'POST', '/allocate', {
+            'orderid': 'o1', 'sku': 'ASYNC-ARMCHAIR', 'qty': 3,
+        })
+        assert status == 202
+        return await request(app, 'GET', '/allocations/o1')
+
+    status, body = asyncio.run(scenario())
+    assert status == 200
+    assert json.loads(body) == [{'sku': 'ASYNC-ARMCHAIR', 'batchref': 'b1'}]
+
+
+def test_cached_allocations_are_invalidated_by_new_allocations(app):
+    async def scenario():
+        await request(app, 'POST', '/add_batch', {
+            'ref': 'b1', 'sku': 'CACHED-CHAIR', 'qty': 10, 'eta': None,
+        })
+        await request(app, 'POST', '/add_batch', {
+            'ref': 'b2', 'sku': 'CACHED-TABLE', 'qty': 10, 'eta': None,
+        })
+        await request(app, 'POST', '/allocate', {'orderid': 'o1', 'sku': 'CACHED-CHAIR', 'qty': 1})
+        first = await request(app, 'GET', '/allocations/o1')
+        await request(app, 'POST', '/allocate', {'orderid': 'o1', 'sku': 'CACHED-TABLE', 'qty': 1})
+        second = await request(app, 'GET', '/allocations/o1')
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert len(json.loads(first[1])) == 1
+    assert len(json.loads(second[1])) == 2
+
+
+def test_unhappy_paths(app):
+    async def scenario():
+        return [
+            await request(app, 'POST', '/allocate', {
+                'orderid': 'o1', 'sku': 'NOSUCHSKU', 'qty': 3,
+            }),
+            await request(app, 'GET', '/allocations/o1'),
+            await request(app, 'GET', '/allocate'),
+            await request(app, 'GET', '/nowhere'),
+        ]
+
+    invalid_sku, no_allocations, wrong_method, no_route = asyncio.run(scenario())
+    assert invalid_sku == (400, b'{"message": "Invalid sku NOSUCHSKU"}')
+    assert no_allocations[0] == 404
+    assert wrong_method[0] == 405
+    assert no_route[0] == 404
+
+
+def test_serves_the_metrics_recorded_so_far(app):
+    metrics.reset()
+    metrics.counter('concurrency_conflicts').inc(2)
+    metrics.summary('db_pool_checkout_wait_seconds').observe(0.5)
+
+    status, body = asyncio.run(request(app, 'GET', '/metrics'))
+    assert status == 200
+    assert json.loads(body) == {
+        'concurrency_conflicts': {'value': 2},
+        'db_pool_checkout_wait_seconds': {'count': 1, 'total': 0.5, 'max': 0.5},
+    }
+
+
+def test_handles_lifespan_events(app):
+    incoming = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(app({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
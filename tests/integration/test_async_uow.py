@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from .test_uow import insert_batch, get_allocated_batch_ref
+
+pytestmark = pytest.mark.usefixtures('mappers')
+
+
+def test_async_uow_can_retrieve_a_batch_and_allocate_to_it(file_sqlite_session_factory):
+    session = file_sqlite_session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyAsyncUnitOfWork(file_sqlite_session_factory)
+
+    async def allocate():
+        async with uow:
+            product = await uow.products.get(sku='HIPSTER-WORKBENCH')
+            product.allocate(model.OrderLine('o1', 'HIPSTER-WORKBENCH', 10))
+            await uow.commit()
+
+    asyncio.run(allocate())
+
+    batchref = get_allocated_batch_ref(session, 'o1', 'HIPSTER-WORKBENCH')
+    assert batchref == 'batch1'
+
+
+def test_async_uow_rolls_back_uncommitted_work_by_default(file_sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyAsyncUnitOfWork(file_sqlite_session_factory)
+
+    async def add_without_committing():
+        async with uow:
+            await uow.run_sync(
+                insert_batch, uow.session, 'batch1', 'MEDIUM-PLINTH', 100, None,
+            )
+
+    asyncio.run(add_without_committing())
+
+    new_session = file_sqlite_session_factory()
+    rows = list(new_session.execute('SELECT * FROM "batches"'))
+    assert rows == []
+
+
+def test_concurrent_tasks_get_their_own_sessions(file_sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyAsyncUnitOfWork(file_sqlite_session_factory)
+    sessions = []
+
+    async def use_uow():
+        async with uow:
+            my_session = uow.session
+            sessions.append(my_session)
+            await asyncio.sleep(0.01)
+            assert uow.session is my_session
+
+    async def main():
+        await asyncio.gather(use_uow(), use_uow())
+
+    asyncio.run(main())
+    assert sessions[0] is not sessions[1]
@@ -0,0 +1,94 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap, views
+from allocation.domain import commands
+from allocation.entrypoints import batch_allocation
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_allocates_lines_with_one_transaction_per_sku_per_chunk(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('lamps', 'LAMP', 10, None))
+    sqlite_bus.handle(commands.CreateBatch('rugs', 'RUG', 1, None))
+    lines = [
+        dict(orderid='o1', sku='LAMP', qty=4),
+        dict(orderid='o1', sku='RUG', qty=1),
+        dict(orderid='o2', sku='LAMP', qty=4),
+        dict(orderid='o2', sku='RUG', qty=1),
+        dict(orderid='o3', sku='LAMP', qty=4),
+    ]
+    handle = mock.Mock(wraps=sqlite_bus.handle)
+    with mock.patch.object(sqlite_bus, 'handle', handle):
+        results = list(batch_allocation.allocate_lines(
+            enumerate(lines), sqlite_bus, chunk_size=4,
+        ))
+
+    assert results == [
+        dict(line=0, orderid='o1', sku='LAMP', batchref='lamps'),
+        dict(line=2, orderid='o2', sku='LAMP', batchref='lamps'),
+        dict(line=1, orderid='o1', sku='RUG', batchref='rugs'),
+        dict(line=3, orderid='o2', sku='RUG', error='out of stock'),
+        dict(line=4, orderid='o3', sku='LAMP', error='out of stock'),
+    ]
+    assert [c.args[0] for c in handle.call_args_list] == [
+        commands.AllocateMany('LAMP', [('o1', 4), ('o2', 4)]),
+        commands.AllocateMany('RUG', [('o1', 1), ('o2', 1)]),
+        commands.AllocateMany('LAMP', [('o3', 4)]),
+    ]
+    assert views.allocations('o2', sqlite_bus.uow) == [{'sku': 'LAMP', 'batchref': 'lamps'}]
+
+
+def test_reports_invalid_skus_and_malformed_lines_per_line(sqlite_bus):
+    body = [
+        b'{"orderid": "o1", "sku": "NOSUCHSKU", "qty": 1}\n',
+        b'\n',
+        b'{"orderid": "o2", "sku": "NOSUCHSKU", "qty": "lots"}\n',
+        b'not json\n',
+    ]
+    lines = batch_allocation.read_json_lines(body)
+    results = list(batch_allocation.allocate_lines(lines, sqlite_bus))
+
+    # numbered by position in the body, the blank line included
+    assert results == [
+        dict(line=0, orderid='o1', sku='NOSUCHSKU', error='Invalid sku NOSUCHSKU'),
+        dict(line=2, error='expected orderid, sku and an integer qty'),
+        dict(line=3, error='expected orderid, sku and an integer qty'),
+    ]
+
+
+def test_an_unexpected_error_fails_only_its_skus_lines(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('lamps', 'LAMP', 10, None))
+    sqlite_bus.handle(commands.CreateBatch('rugs', 'RUG', 10, None))
+    lines = [
+        dict(orderid='o1', sku='RUG', qty=1),
+        dict(orderid='o2', sku='LAMP', qty=1),
+        dict(orderid='o3', sku='RUG', qty=1),
+    ]
+    handle = sqlite_bus.handle
+
+    def handle_or_fail(cmd):
+        if cmd.sku == 'RUG':
+            raise RuntimeError('database went away')
+        return handle(cmd)
+
+    with mock.patch.object(sqlite_bus, 'handle', handle_or_fail):
+        results = list(batch_allocation.allocate_lines(enumerate(lines), sqlite_bus))
+
+    assert results == [
+        dict(line=0, orderid='o1', sku='RUG', error='could not allocate'),
+        dict(line=2, orderid='o3', sku='RUG', error='could not allocate'),
+        dict(line=1, orderid='o2', sku='LAMP', batchref='lamps'),
+    ]
@@ -0,0 +1,68 @@
+# pylint: disable=redefined-outer-name
+import json
+from datetime import date
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import batch_importer
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_create_batches_adds_products_and_batches(sqlite_bus, sqlite_session_factory):
+    sqlite_bus.handle(commands.CreateBatch('existing', 'OLD-OTTOMAN', 10, None))
+    sqlite_bus.handle(commands.CreateBatches([
+        commands.CreateBatch('b1', 'OLD-OTTOMAN', 20, date(2011, 1, 2)),
+        commands.CreateBatch('b2', 'NEW-NIGHTLIGHT', 30, None),
+        commands.CreateBatch('b3', 'NEW-NIGHTLIGHT', 40, date(2011, 1, 3)),
+    ]))
+
+    session = sqlite_session_factory()
+    assert sorted(session.execute('SELECT sku, version_number FROM products')) == [
+        ('NEW-NIGHTLIGHT', 1), ('OLD-OTTOMAN', 2),
+    ]
+    assert sorted(session.execute('SELECT reference, sku FROM batches')) == [
+        ('b1', 'OLD-OTTOMAN'), ('b2', 'NEW-NIGHTLIGHT'), ('b3', 'NEW-NIGHTLIGHT'),
+        ('existing', 'OLD-OTTOMAN'),
+    ]
+    sqlite_bus.handle(commands.AllocateMany('NEW-NIGHTLIGHT', [('o1', 30), ('o2', 40)]))
+    assert sorted(session.execute('SELECT orderid, batchref FROM allocations_view')) == [
+        ('o1', 'b2'), ('o2', 'b3'),
+    ]
+
+
+@pytest.mark.parametrize('filename, content', [
+    ('batches.csv', 'ref,sku,qty,eta\nb1,CSV-CHAIR,10,\nb2,CSV-CHAIR,20,2011-01-02\nb3,CSV-TABLE,30,\n'),
+    ('batches.jsonl', ''.join(json.dumps(row) + '\n' for row in [
+        dict(ref='b1', sku='CSV-CHAIR', qty=10, eta=None),
+        dict(ref='b2', sku='CSV-CHAIR', qty=20, eta='2011-01-02'),
+        dict(ref='b3', sku='CSV-TABLE', qty=30),
+    ])),
+])
+def test_imports_files_in_chunks(sqlite_bus, sqlite_session_factory, tmp_path, filename, content):
+    path = tmp_path / filename
+    path.write_text(content)
+    handled = []
+    handle = sqlite_bus.handle
+    sqlite_bus.handle = lambda message: handled.append(message) or handle(message)
+
+    assert batch_importer.import_batches(path, sqlite_bus, chunk_size=2) == 3
+
+    assert [len(cmd.batches) for cmd in handled] == [2, 1]
+    session = sqlite_session_factory()
+    assert sorted(session.execute('SELECT reference, _purchased_quantity, eta FROM batches')) == [
+        ('b1', 10, None), ('b2', 20, '2011-01-02'), ('b3', 30, None),
+    ]
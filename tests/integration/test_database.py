@@ -0,0 +1,65 @@
+import os
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from allocation import metrics
+from allocation.adapters import database
+
+
+def test_pool_records_checkout_waits_and_saturation(tmp_path):
+    metrics.reset()
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "pool.db"}',
+        poolclass=database.InstrumentedQueuePool,
+        pool_size=1, max_overflow=1, pool_timeout=0.01,
+    )
+    first = engine.connect()
+    second = engine.connect()
+    assert metrics.gauge('db_pool_checked_out').value == 2
+    assert metrics.gauge('db_pool_saturation').value == 1.0
+
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+    assert metrics.counter('db_pool_timeouts').value == 1
+    assert metrics.summary('db_pool_checkout_wait_seconds').count == 3
+    assert metrics.summary('db_pool_checkout_wait_seconds').max >= 0.01
+
+    first.close()
+    second.close()
+    assert metrics.gauge('db_pool_saturation').value == 0.0
+
+
+def test_session_factory_creates_its_engine_lazily_and_again_after_fork(tmp_path):
+    created = []
+
+    def create():
+        created.append(create_engine(f'sqlite:///{tmp_path / "lazy.db"}'))
+        return created[-1]
+
+    factory = database.ProcessLocalSessionFactory(create)
+    assert created == []
+    factory().execute('SELECT 1')
+    factory().execute('SELECT 1')
+    assert len(created) == 1
+
+    database._after_fork_in_child()  # pylint: disable=protected-access
+
+    assert factory.engine is not created[0]
+    assert len(created) == 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_children_do_not_reuse_the_parents_engine(tmp_path):
+    factory = database.ProcessLocalSessionFactory(
+        lambda: create_engine(f'sqlite:///{tmp_path / "fork.db"}')
+    )
+    parent_engine_id = id(factory.engine)
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # child
+        os.close(read)
+        os.write(write, b'reused' if id(factory.engine) == parent_engine_id else b'new')
+        os._exit(0)  # pylint: disable=protected-access
+    os.close(write)
+    os.waitpid(pid, 0)
+    assert os.read(read, 16) == b'new'
@@ -0,0 +1,98 @@
+# pylint: disable=redefined-outer-name
+from datetime import date
+from unittest import mock
+import pytest
+from allocation import bootstrap, views
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+
+@pytest.fixture
+def uow(sqlite_session_factory):
+    return unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory, snapshot_every=3)
+
+
+def test_products_are_rebuilt_from_their_events(uow):
+    handlers.add_batch(commands.CreateBatch('batch1', 'STREAMED-STOOL', 100, None), uow)
+    handlers.add_batch(commands.CreateBatch('batch2', 'STREAMED-STOOL', 100, date(2011, 1, 2)), uow)
+    handlers.allocate_many(commands.AllocateMany(
+        'STREAMED-STOOL', [('o1', 60), ('o2', 50)],
+    ), uow)
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 55), uow)
+
+    with uow:
+        product = uow.products.get(sku='STREAMED-STOOL')
+        batch1, batch2 = sorted(product.batches, key=lambda b: b.reference)
+        assert batch1.eta is None and batch2.eta == date(2011, 1, 2)
+        assert batch1.available_quantity == 55
+        assert batch2._allocations == {model.OrderLine('o2', 'STREAMED-STOOL', 50)}
+        assert product.version_number == 5
+
+
+def test_only_the_tail_after_the_latest_snapshot_is_read(uow, sqlite_session_factory):
+    handlers.add_batch(commands.CreateBatch('batch1', 'SNAPPY-SOFA', 100, None), uow)
+    for i in range(4):
+        handlers.allocate(commands.Allocate(f'o{i}', 'SNAPPY-SOFA', 1), uow)
+
+    session = sqlite_session_factory()
+    assert list(session.execute('SELECT seq FROM product_snapshots')) == [(3,)]
+    # tamper with the records the snapshot replaces, to prove they're not read
+    session.execute("UPDATE product_events SET changes = 'not json' WHERE seq <= 3")
+    session.commit()
+
+    with uow:
+        product = uow.products.get_by_batchref('batch1')
+        assert product.batches[0].available_quantity == 96
+
+
+def test_appending_to_a_stale_stream_is_a_concurrency_conflict(sqlite_session_factory):
+    setup = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch('batch1', 'RACY-RUG', 100, None), setup)
+    slow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    fast = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+
+    with slow:
+        slow_product = slow.products.get(sku='RACY-RUG')
+        handlers.allocate(commands.Allocate('o1', 'RACY-RUG', 10), fast)
+        slow_product.allocate(model.OrderLine('o2', 'RACY-RUG', 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict, match='RACY-RUG'):
+            slow.commit()
+
+
+def test_message_bus_with_event_sourced_products(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    bus.handle(commands.CreateBatch('batch1', 'BUSY-BED', 10, None))
+    bus.handle(commands.CreateBatch('batch2', 'BUSY-BED', 10, date(2011, 1, 2)))
+    bus.handle(commands.Allocate('o1', 'BUSY-BED', 10))
+
+    bus.handle(commands.ChangeBatchQuantity('batch1', 5))
+
+    assert views.allocations('o1', bus.uow) == [{'sku': 'BUSY-BED', 'batchref': 'batch2'}]
+
+
+def test_create_batches_goes_through_the_event_streams(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    bus.handle(commands.CreateBatch('existing', 'IMPORTED-IGLOO', 5, None))
+    bus.handle(commands.CreateBatches([
+        commands.CreateBatch('b1', 'IMPORTED-IGLOO', 10, date(2011, 1, 2)),
+        commands.CreateBatch('b2', 'IMPORTED-IGLOO', 10, date(2011, 1, 3)),
+        commands.CreateBatch('b3', 'NEW-NEST', 10, None),
+    ]))
+
+    session = sqlite_session_factory()
+    assert session.execute('SELECT count(*) FROM batches').scalar() == 0
+    assert views.sku_for_batchref('b3', bus.uow) == 'NEW-NEST'
+    assert views.sku_for_batchref('nosuchbatch', bus.uow) is None
+
+    bus.handle(commands.AllocateMany('IMPORTED-IGLOO', [('o1', 5), ('o2', 10)]))
+    assert views.allocations('o2', bus.uow) == [{'sku': 'IMPORTED-IGLOO', 'batchref': 'b1'}]
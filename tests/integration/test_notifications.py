@@ -0,0 +1,165 @@
+# pylint: disable=redefined-outer-name
+import socketserver
+import threading
+import time
+from typing import List
+import pytest
+from allocation import metrics
+from allocation.adapters.notifications import (
+    AbstractNotifications, CoalescingNotifications, EmailNotifications,
+)
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    # speaks just enough SMTP for smtplib to send mail. drop_after closes
+    # each connection once it has delivered that many messages
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=None):
+        super().__init__(('127.0.0.1', 0), SmtpHandler)
+        self.drop_after = drop_after
+        self.messages = []  # type: List[str]
+        self.connections = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        delivered = 0
+        self.reply('220 fake smtp')
+        for raw in self.rfile:
+            command = raw.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 fake smtp')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(line.decode())
+                self.server.release.wait()
+                self.server.messages.append(''.join(data))
+                self.reply('250 ok')
+                delivered += 1
+                if delivered == self.server.drop_after:
+                    return
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    yield from run_server(FakeSmtpServer())
+
+
+@pytest.fixture
+def flaky_smtp_server():
+    yield from run_server(FakeSmtpServer(drop_after=1))
+
+
+def run_server(server):
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_email_notifications_reconnect_when_the_server_drops_the_connection(flaky_smtp_server):
+    email = EmailNotifications('127.0.0.1', flaky_smtp_server.port)
+    for i in range(3):
+        email.send('stock@made.com', f'Out of stock for SKU-{i}')
+
+    assert len(flaky_smtp_server.messages) == 3
+    assert flaky_smtp_server.connections == 3
+
+
+def test_coalesces_repeated_notifications_within_the_window(smtp_server):
+    now = [0.0]
+    notifications = CoalescingNotifications(
+        EmailNotifications('127.0.0.1', smtp_server.port), window=60, clock=lambda: now[0],
+    )
+    metrics.reset()
+    for _ in range(20):
+        notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-SOFA')
+    notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-STOOL')
+    now[0] = 61
+    notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-SOFA')
+    notifications.join()
+
+    assert len([m for m in smtp_server.messages if 'SOLD-OUT-SOFA' in m]) == 2
+    assert len([m for m in smtp_server.messages if 'SOLD-OUT-STOOL' in m]) == 1
+    assert metrics.counter('notifications_coalesced').value == 19
+    assert metrics.counter('notifications_sent').value == 3
+    assert smtp_server.connections == 1
+
+
+def test_send_does_not_wait_for_the_mail_server(smtp_server):
+    smtp_server.release.clear()  # the server sits on every message
+    notifications = CoalescingNotifications(
+        EmailNotifications('127.0.0.1', smtp_server.port), max_queue=2,
+    )
+    metrics.reset()
+    notifications.send('stock@made.com', 'Out of stock for SKU-0')
+    while notifications._queue.qsize():  # pylint: disable=protected-access
+        time.sleep(0.001)
+    for i in range(1, 5):
+        notifications.send('stock@made.com', f'Out of stock for SKU-{i}')
+
+    # one being sent, two queued, the rest dropped
+    assert smtp_server.messages == []
+    assert metrics.counter('notifications_dropped').value == 2
+    smtp_server.release.set()
+    notifications.join()
+    assert len(smtp_server.messages) == 3
+
+    # dropped notifications weren't sent, so they aren't coalesced either
+    notifications.send('stock@made.com', 'Out of stock for SKU-4')
+    notifications.join()
+    assert len(smtp_server.messages) == 4
+    assert metrics.counter('notifications_coalesced').value == 0
+
+
+class FailingNotifications(AbstractNotifications):
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []  # type: List[str]
+
+    def send(self, destination, message):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('mail server is down')
+        self.sent.append(message)
+
+
+def test_a_notification_that_failed_to_send_is_not_coalesced():
+    sender = FailingNotifications(failures=1)
+    notifications = CoalescingNotifications(sender, window=60, clock=lambda: 0.0)
+    metrics.reset()
+    notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-SOFA')
+    notifications.join()
+    notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-SOFA')
+    notifications.join()
+    notifications.send('stock@made.com', 'Out of stock for SOLD-OUT-SOFA')
+    notifications.join()
+
+    assert sender.sent == ['Out of stock for SOLD-OUT-SOFA']
+    assert metrics.counter('notifications_failed').value == 1
+    assert metrics.counter('notifications_coalesced').value == 1
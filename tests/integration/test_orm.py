@@ -0,0 +1,32 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+from allocation.adapters import orm
+
+
+def test_ensure_indexes_adds_missing_indexes_to_an_existing_database():
+    engine = create_engine('sqlite://')
+    orm.metadata.create_all(engine)
+    for index in orm.allocations_view.indexes | orm.batches.indexes:
+        index.drop(engine)
+
+    assert sorted(orm.ensure_indexes(engine)) == [
+        'ix_allocations_view_batchref_keyset', 'ix_allocations_view_orderid_sku',
+        'ix_allocations_view_sku_keyset', 'ix_batches_reference', 'ix_batches_sku',
+    ]
+    assert {i['name'] for i in inspect(engine).get_indexes('batches')} == {
+        'ix_batches_reference', 'ix_batches_sku',
+    }
+    assert orm.ensure_indexes(engine) == []
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+    session = sqlite_session_factory()
+    session.execute("INSERT INTO products (sku, version_number) VALUES ('TWIN-TABLE', 0)")
+    insert = (
+        'INSERT INTO batches (reference, sku, _purchased_quantity)'
+        " VALUES ('batch1', 'TWIN-TABLE', 10)"
+    )
+    session.execute(insert)
+    with pytest.raises(IntegrityError):
+        session.execute(insert)
@@ -0,0 +1,110 @@
+import pytest
+from sqlalchemy import event
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+pytestmark = pytest.mark.usefixtures('mappers')
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(
+        engine, 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+def test_a_cached_product_is_loaded_with_just_a_version_probe(sqlite_session_factory):
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    handlers.add_batch(commands.CreateBatch('batch1', 'CACHED-COUCH', 100, None), uow)
+    handlers.allocate(commands.Allocate('o1', 'CACHED-COUCH', 10), uow)
+
+    statements = count_statements(sqlite_session_factory.kw['bind'])
+    with uow:
+        product = uow.products.get(sku='CACHED-COUCH')
+        [batch] = product.batches
+        assert batch.available_quantity == 90
+    assert len(statements) == 1
+    assert cache.stats()['hits'] == 2  # the allocate was a hit too
+
+    with uow:
+        assert uow.products.get_by_batchref('batch1') is not None
+    assert cache.stats()['hits'] == 3
+
+
+def test_a_stale_product_is_reloaded(sqlite_session_factory):
+    cache = repository.ProductCache()
+    cached_uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch('batch1', 'STALE-SETTEE', 100, None), cached_uow)
+
+    handlers.allocate(commands.Allocate('o1', 'STALE-SETTEE', 10), other_uow)
+
+    with cached_uow:
+        product = cached_uow.products.get(sku='STALE-SETTEE')
+        assert product.batches[0].available_quantity == 90
+    assert cache.stats()['misses'] == 1
+
+
+def test_changes_to_a_cached_product_are_saved(sqlite_session_factory):
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, product_cache=cache,
+        concurrency_control=unit_of_work.OPTIMISTIC,
+    )
+    handlers.add_batch(commands.CreateBatch('batch1', 'SAVED-SOFA', 100, None), uow)
+    handlers.allocate(commands.Allocate('o1', 'SAVED-SOFA', 10), uow)
+    handlers.allocate(commands.Allocate('o2', 'SAVED-SOFA', 10), uow)
+
+    assert cache.stats()['hits'] == 2
+    session = sqlite_session_factory()
+    [[version]] = session.execute(
+        'SELECT version_number FROM products WHERE sku = :sku', dict(sku='SAVED-SOFA'),
+    )
+    assert version == 3
+    [[allocated]] = session.execute(
+        'SELECT COUNT(*) FROM allocations JOIN order_lines AS ol ON orderline_id = ol.id'
+        ' WHERE ol.sku = :sku', dict(sku='SAVED-SOFA'),
+    )
+    assert allocated == 2
+
+
+def test_changes_after_a_commit_are_still_tracked(sqlite_session_factory):
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    handlers.add_batch(commands.CreateBatch('batch1', 'TWICE-TABLE', 100, None), uow)
+
+    with uow:
+        product = uow.products.get(sku='TWICE-TABLE')
+        product.allocate(model.OrderLine('o1', 'TWICE-TABLE', 10))
+        uow.commit()
+        product.allocate(model.OrderLine('o2', 'TWICE-TABLE', 10))
+        uow.commit()
+
+    session = sqlite_session_factory()
+    [[version]] = session.execute(
+        'SELECT version_number FROM products WHERE sku = :sku', dict(sku='TWICE-TABLE'),
+    )
+    assert version == 3
+    with uow:
+        assert uow.products.get(sku='TWICE-TABLE').batches[0].available_quantity == 80
+
+
+def test_a_product_changed_after_its_commit_is_not_cached(sqlite_session_factory):
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    handlers.add_batch(commands.CreateBatch('batch1', 'DIVERGED-DESK', 100, None), uow)
+    assert cache.stats()['size'] == 1
+
+    with uow:
+        product = uow.products.get(sku='DIVERGED-DESK')
+        product.allocate(model.OrderLine('o1', 'DIVERGED-DESK', 10))
+        uow.commit()
+        product.allocate(model.OrderLine('o2', 'DIVERGED-DESK', 10))  # never committed
+    assert cache.stats()['size'] == 0
+
+    with uow:
+        assert uow.products.get(sku='DIVERGED-DESK').batches[0].available_quantity == 90
@@ -0,0 +1,62 @@
+# pylint: disable=redefined-outer-name
+from contextlib import contextmanager
+from datetime import date
+from typing import List
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import clear_mappers
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+
+
+@pytest.fixture(params=['selectin', 'joined'])
+def loading(request):
+    orm.start_mappers(loading=request.param)
+    yield request.param
+    clear_mappers()
+
+
+@contextmanager
+def recorded_selects(engine):
+    statements = []  # type: List[str]
+
+    def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+# a product is loaded in a fixed number of round trips, whatever the number
+# of batches and allocations it has
+SELECTS_PER_PRODUCT = {'selectin': 3, 'joined': 1}
+
+
+@pytest.mark.parametrize('number_of_batches', [1, 10])
+@pytest.mark.parametrize('handler, cmd', [
+    (handlers.add_batch, commands.CreateBatch('new-batch', 'N-PLUS-ONE-NIGHTSTAND', 10, None)),
+    (handlers.allocate, commands.Allocate('new-order', 'N-PLUS-ONE-NIGHTSTAND', 1)),
+    (handlers.allocate_many, commands.AllocateMany(
+        'N-PLUS-ONE-NIGHTSTAND', [('new-order1', 1), ('new-order2', 1)],
+    )),
+    (handlers.change_batch_quantity, commands.ChangeBatchQuantity('batch0', 1)),
+])
+def test_queries_per_handler_do_not_grow_with_batches(
+        sqlite_session_factory, loading, number_of_batches, handler, cmd,
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    for i in range(number_of_batches):
+        handlers.add_batch(commands.CreateBatch(
+            f'batch{i}', 'N-PLUS-ONE-NIGHTSTAND', 10, date(2011, 1, i + 1),
+        ), uow)
+        handlers.allocate(commands.Allocate(f'order{i}', 'N-PLUS-ONE-NIGHTSTAND', 5), uow)
+
+    with recorded_selects(sqlite_session_factory.kw['bind']) as selects:
+        handler(cmd, uow)
+
+    assert len(selects) == SELECTS_PER_PRODUCT[loading]
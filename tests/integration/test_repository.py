@@ -17,3 +17,18 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref('b2') == p1
     assert repo.get_by_batchref('b3') == p2
+
+
+def test_loaded_batches_know_their_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref='b1', sku='sku1', qty=100, eta=None)
+    batch.allocate(model.OrderLine('o1', 'sku1', 10))
+    batch.allocate(model.OrderLine('o2', 'sku1', 20))
+    session.add(model.Product(sku='sku1', batches=[batch]))
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    [loaded_batch] = repo.get('sku1').batches
+    assert loaded_batch.available_quantity == 70
+    loaded_batch.allocate(model.OrderLine('o3', 'sku1', 5))
+    assert loaded_batch.available_quantity == 65
@@ -5,8 +5,9 @@ import traceback
 from typing import List
 from unittest.mock import Mock
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from sqlalchemy import event
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
 pytestmark = pytest.mark.usefixtures('mappers')
@@ -91,6 +92,61 @@ def try_to_allocate(orderid, sku, exceptions, session_factory):
         exceptions.append(e)
 
 
+def test_a_quantity_change_older_than_the_last_one_applied_is_ignored(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'LATE-LAMP', 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 30, '1700000000000-1'), uow)
+    # redelivered late, eg claimed from a consumer that died
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 80, '1700000000000-0'), uow)
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 30, '1700000000000-1'), uow)
+    with uow:
+        [batch] = uow.products.get(sku='LATE-LAMP').batches
+        assert batch.available_quantity == 30
+        assert uow.products.get(sku='LATE-LAMP').version_number == 2
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 50, '1700000000001-0'), uow)
+    # with no sequence (eg from pubsub) a change always applies
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity('batch1', 60), uow)
+    with uow:
+        [batch] = uow.products.get(sku='LATE-LAMP').batches
+        assert batch.available_quantity == 60
+
+
+def test_quantity_changes_racing_for_a_new_batch_are_a_concurrency_conflict(
+        file_sqlite_session_factory,
+):
+    session = file_sqlite_session_factory()
+    insert_batch(session, 'batch1', 'RACED-RUG', 100, None)
+    session.commit()
+    slow = unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory)
+    fast = unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory)
+
+    # as soon as slow has read that no change has been applied yet, fast
+    # applies (and commits) a later one
+    raced = []
+
+    def race(conn, cursor, statement, *args):
+        if statement.startswith('SELECT sequence') and not raced:
+            raced.append(statement)
+            handlers.change_batch_quantity(
+                commands.ChangeBatchQuantity('batch1', 50, '1700000000000-2'), fast,
+            )
+    event.listen(file_sqlite_session_factory.kw['bind'], 'after_cursor_execute', race)
+
+    slow_change = commands.ChangeBatchQuantity('batch1', 30, '1700000000000-1')
+    with pytest.raises(unit_of_work.ConcurrencyConflict):
+        handlers.change_batch_quantity(slow_change, slow)
+    # which the bus would retry, and then it's stale
+    handlers.change_batch_quantity(slow_change, slow)
+
+    with slow:
+        [batch] = slow.products.get(sku='RACED-RUG').batches
+        assert batch.available_quantity == 50
+
+
 def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory):
     sku, batch = random_sku(), random_batchref()
     session = postgres_session_factory()
@@ -130,3 +186,36 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert len(orders) == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         uow.session.execute('select 1')
+
+
+def test_optimistic_uow_rejects_a_stale_version(file_sqlite_session_factory):
+    session = file_sqlite_session_factory()
+    insert_batch(session, 'batch1', 'STALE-STOOL', 100, None, product_version=1)
+    session.commit()
+
+    slow = unit_of_work.SqlAlchemyUnitOfWork(
+        file_sqlite_session_factory, concurrency_control=unit_of_work.OPTIMISTIC,
+    )
+    fast = unit_of_work.SqlAlchemyUnitOfWork(
+        file_sqlite_session_factory, concurrency_control=unit_of_work.OPTIMISTIC,
+    )
+    with slow:
+        slow_product = slow.products.get(sku='STALE-STOOL')
+        with fast:
+            fast.products.get(sku='STALE-STOOL').allocate(
+                model.OrderLine('o1', 'STALE-STOOL', 10)
+            )
+            fast.commit()
+
+        slow_product.allocate(model.OrderLine('o2', 'STALE-STOOL', 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict, match='STALE-STOOL'):
+            slow.commit()
+
+    [[version]] = session.execute(
+        'SELECT version_number FROM products WHERE sku=:sku', dict(sku='STALE-STOOL'),
+    )
+    assert version == 2
+    assert get_allocated_batch_ref(session, 'o1', 'STALE-STOOL') == 'batch1'
+    assert list(session.execute(
+        'SELECT * FROM order_lines WHERE orderid=:orderid', dict(orderid='o2'),
+    )) == []
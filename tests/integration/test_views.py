@@ -1,9 +1,11 @@
 # pylint: disable=redefined-outer-name
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from sqlalchemy.orm import clear_mappers
 from unittest import mock
 import pytest
-from allocation import bootstrap, views
+from allocation import bootstrap, metrics, views
+from allocation.adapters.view_cache import InMemoryViewCache
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 
@@ -46,3 +48,121 @@ def test_deallocation(sqlite_bus):
     assert views.allocations('o1', sqlite_bus.uow) == [
         {'sku': 'sku1', 'batchref': 'b2'},
     ]
+
+
+def test_allocate_many(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+    sqlite_bus.handle(commands.AllocateMany('sku1', [('o1', 40), ('o2', 20)]))
+
+    assert views.allocations('o1', sqlite_bus.uow) == [
+        {'sku': 'sku1', 'batchref': 'b1'},
+    ]
+    assert views.allocations('o2', sqlite_bus.uow) == [
+        {'sku': 'sku1', 'batchref': 'b2'},
+    ]
+
+
+
+def test_allocations_view_with_concurrent_event_handlers(file_sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        executor=ThreadPoolExecutor(max_workers=2),
+    )
+    try:
+        bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+        bus.handle(commands.Allocate('o1', 'sku1', 20))
+        assert views.allocations('o1', bus.uow) == [
+            {'sku': 'sku1', 'batchref': 'b1'},
+        ]
+    finally:
+        clear_mappers()
+
+
+def test_read_model_changes_are_written_once_per_message(sqlite_bus):
+    metrics.reset()
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+    sqlite_bus.handle(commands.AllocateMany('sku1', [(f'o{i}', 1) for i in range(50)]))
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 0))
+
+    assert views.allocations('o7', sqlite_bus.uow) == [{'sku': 'sku1', 'batchref': 'b2'}]
+    flushes = metrics.summary('read_model_rows_per_flush')
+    assert flushes.count == 2
+    assert flushes.max == 100  # 50 deletes and 50 inserts
+
+
+def test_cached_allocations_view_is_invalidated_by_allocations(sqlite_session_factory):
+    cache = InMemoryViewCache()
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        view_cache=cache,
+    )
+    try:
+        bus.handle(commands.CreateBatch('sku1batch', 'sku1', 50, None))
+        bus.handle(commands.CreateBatch('sku2batch', 'sku2', 50, None))
+        bus.handle(commands.Allocate('order1', 'sku1', 20))
+        assert views.allocations('order1', bus.uow, cache=cache) == [
+            {'sku': 'sku1', 'batchref': 'sku1batch'},
+        ]
+
+        metrics.reset()
+        for _ in range(3):
+            assert len(views.allocations('order1', bus.uow, cache=cache)) == 1
+        assert metrics.counter('view_cache_hits').value == 3
+        assert metrics.counter('view_cache_misses').value == 0
+
+        bus.handle(commands.Allocate('order1', 'sku2', 20))
+        assert views.allocations('order1', bus.uow, cache=cache) == [
+            {'sku': 'sku1', 'batchref': 'sku1batch'},
+            {'sku': 'sku2', 'batchref': 'sku2batch'},
+        ]
+    finally:
+        clear_mappers()
+
+
+def test_streaming_views_page_through_allocations_in_keyset_order(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku2', 100, None))
+    sqlite_bus.handle(commands.AllocateMany('sku1', [(f'o{i}', 1) for i in range(7)]))
+    sqlite_bus.handle(commands.AllocateMany('sku2', [(f'o{i}', 1) for i in range(0, 7, 2)]))
+
+    expected = sorted(
+        [dict(orderid=f'o{i}', sku='sku1', batchref='b1') for i in range(7)]
+        + [dict(orderid=f'o{i}', sku='sku2', batchref='b2') for i in range(0, 7, 2)],
+        key=lambda row: (row['orderid'], row['sku']),
+    )
+    assert list(views.all_allocations(sqlite_bus.uow, page_size=3)) == expected
+    assert list(views.allocations_for_sku('sku2', sqlite_bus.uow, page_size=2)) == [
+        row for row in expected if row['sku'] == 'sku2'
+    ]
+    assert list(views.allocations_for_batch('b1', sqlite_bus.uow, page_size=7)) == [
+        row for row in expected if row['batchref'] == 'b1'
+    ]
+
+
+def test_streaming_views_resume_after_the_last_row_seen(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+    sqlite_bus.handle(commands.AllocateMany('sku1', [(f'o{i}', 1) for i in range(5)]))
+
+    rows = views.allocations_for_sku('sku1', sqlite_bus.uow, after=('o2', 'sku1', 'b1'))
+    assert [row['orderid'] for row in rows] == ['o3', 'o4']
+    assert list(views.allocations_for_sku('nosuchsku', sqlite_bus.uow)) == []
+    # keys are compared whole, commas and all
+    sqlite_bus.handle(commands.CreateBatch('b,2', 'sku,2', 100, None))
+    sqlite_bus.handle(commands.AllocateMany('sku,2', [('o,1', 1), ('o,2', 1)]))
+    rows = views.allocations_for_sku('sku,2', sqlite_bus.uow, after=('o,1', 'sku,2', 'b,2'))
+    assert [row['orderid'] for row in rows] == ['o,2']
+
+
+@pytest.mark.parametrize('page_size', [0, -1])
+def test_streaming_views_reject_empty_pages(sqlite_bus, page_size):
+    with pytest.raises(ValueError):
+        list(views.all_allocations(sqlite_bus.uow, page_size=page_size))
@@ -0,0 +1,142 @@
+# pylint: disable=no-self-use
+from __future__ import annotations
+import asyncio
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.adapters import notifications, repository
+from allocation.service_layer import unit_of_work
+
+
+class FakeAsyncRepository(repository.AbstractAsyncRepository):
+
+    def __init__(self, products):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku):
+        await asyncio.sleep(0)
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref):
+        await asyncio.sleep(0)
+        return next((
+            p for p in self._products for b in p.batches
+            if b.reference == batchref
+        ), None)
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+
+    def __init__(self):
+        self.products = FakeAsyncRepository([])
+        self.committed = False
+
+    async def _commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeAsyncNotifications(notifications.AbstractAsyncNotifications):
+
+    def __init__(self):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+
+    async def send(self, destination, message):
+        self.sent[destination].append(message)
+
+
+async def noop_publish(*args):
+    pass
+
+
+def bootstrap_test_app(notifs=None):
+    return bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=notifs or FakeAsyncNotifications(),
+        publish=noop_publish,
+    )
+
+
+def handle_all(bus, *messages):
+    async def handle_in_order():
+        for message in messages:
+            await bus.handle(message)
+    asyncio.run(handle_in_order())
+
+
+class TestAllocate:
+
+    def test_allocates(self):
+        bus = bootstrap_test_app()
+        handle_all(
+            bus,
+            commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None),
+            commands.Allocate("o1", "COMPLICATED-LAMP", 10),
+        )
+        [batch] = bus.uow.products._products.pop().batches
+        assert batch.available_quantity == 90
+        assert bus.uow.committed
+
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            handle_all(bus, commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+
+    def test_sends_email_on_out_of_stock_error(self):
+        fake_notifs = FakeAsyncNotifications()
+        bus = bootstrap_test_app(fake_notifs)
+        handle_all(
+            bus,
+            commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None),
+            commands.Allocate("o1", "POPULAR-CURTAINS", 10),
+        )
+        assert fake_notifs.sent['stock@made.com'] == [
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+
+
+    def test_handles_many_commands_concurrently(self):
+        bus = bootstrap_test_app()
+
+        async def allocate_concurrently():
+            await bus.handle(commands.CreateBatch("b1", "SPIKY-CACTUS", 1000, None))
+            await asyncio.gather(*(
+                bus.handle(commands.Allocate(f"o{i}", "SPIKY-CACTUS", 1))
+                for i in range(200)
+            ))
+
+        asyncio.run(allocate_concurrently())
+        [batch] = bus.uow.products._products.pop().batches
+        assert batch.available_quantity == 800
+
+
+
+class TestChangeBatchQuantity:
+
+    def test_reallocates_if_necessary(self):
+        bus = bootstrap_test_app()
+        handle_all(
+            bus,
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+            commands.ChangeBatchQuantity("batch1", 25),
+        )
+        [product] = bus.uow.products._products
+        batch1, batch2 = product.batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 30
@@ -0,0 +1,29 @@
+import queue
+import threading
+import time
+import pytest
+from allocation.adapters.background import BackgroundQueue
+
+
+def test_hands_items_over_in_batches_and_survives_errors():
+    handled = []
+    release = threading.Event()
+
+    def handle(items):
+        release.wait()
+        if 'bad' in items:
+            raise ValueError('bad item')
+        handled.append(items)
+
+    background = BackgroundQueue(handle, name='test', max_size=3, batch_size=2)
+    background.put('bad')
+    while background.qsize():
+        time.sleep(0.001)  # until the worker has taken it
+    for item in ['a', 'b', 'c']:
+        background.put(item)
+    with pytest.raises(queue.Full):
+        background.put('d')
+
+    release.set()
+    background.join()
+    assert handled == [['a', 'b'], ['c']]
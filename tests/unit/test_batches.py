@@ -39,3 +39,9 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+def test_deallocating_one_increases_the_available_quantity():
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.available_quantity == 20
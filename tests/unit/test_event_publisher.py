@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from typing import List, Tuple
+import pytest
+from allocation import bootstrap, metrics
+from allocation.adapters import redis_eventpublisher
+from allocation.adapters.redis_eventpublisher import BLOCK, DROP, BufferedPublisher
+from allocation.domain import commands, events
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class FakeRedis:
+    # records what each pipeline published; a test can hold pipelines up
+
+    def __init__(self):
+        self.pipelines = []  # type: List[List[Tuple[str, dict]]]
+        self.release = threading.Event()
+        self.release.set()
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.published = []  # type: List[Tuple[str, dict]]
+
+    def publish(self, channel, data):
+        self.published.append((channel, json.loads(data)))
+
+    def execute(self):
+        self.client.release.wait()
+        self.client.pipelines.append(self.published)
+
+
+def allocated(orderid):
+    return events.Allocated(orderid, 'SKU', 1, 'b1')
+
+
+def test_events_raised_while_handling_a_message_go_out_in_one_pipeline():
+    fake_redis = FakeRedis()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=BufferedPublisher(get_redis=lambda: fake_redis),
+    )
+    bus.handle(commands.CreateBatch('b1', 'POPULAR-POUFFE', 100, None))
+    assert fake_redis.pipelines == []
+
+    metrics.reset()
+    bus.handle(commands.AllocateMany('POPULAR-POUFFE', [(f'o{i}', 1) for i in range(50)]))
+
+    [pipeline] = fake_redis.pipelines
+    assert [data['orderid'] for _, data in pipeline] == [f'o{i}' for i in range(50)]
+    assert {channel for channel, _ in pipeline} == {'line_allocated'}
+    assert metrics.summary('event_publish_flush_size').max == 50
+    assert metrics.summary('event_publish_flush_seconds').count == 1
+
+
+def test_flushing_nothing_sends_nothing():
+    fake_redis = FakeRedis()
+    publisher = BufferedPublisher(get_redis=lambda: fake_redis)
+    publisher.flush()
+    assert fake_redis.pipelines == []
+
+
+def test_background_mode_publishes_from_a_worker_thread():
+    fake_redis = FakeRedis()
+    publisher = BufferedPublisher(get_redis=lambda: fake_redis, background=True)
+    for i in range(3):
+        publisher('line_allocated', allocated(f'o{i}'))
+    publisher.flush()
+    publisher.join()
+
+    published = [data['orderid'] for pipeline in fake_redis.pipelines for _, data in pipeline]
+    assert published == ['o0', 'o1', 'o2']
+
+
+@pytest.mark.parametrize('when_full', [BLOCK, DROP])
+def test_a_full_queue_drops_events_and_counts_them(when_full):
+    fake_redis = FakeRedis()
+    fake_redis.release.clear()  # the worker's first pipeline won't finish
+    publisher = BufferedPublisher(
+        get_redis=lambda: fake_redis, background=True,
+        max_queue=2, when_full=when_full, block_timeout=0.01,
+    )
+    metrics.reset()
+    publisher('line_allocated', allocated('o0'))
+    publisher.flush()
+    # wait until the worker has taken o0 and is stuck sending it
+    while publisher._queue.qsize():  # pylint: disable=protected-access
+        time.sleep(0.001)
+    for i in range(1, 6):
+        publisher('line_allocated', allocated(f'o{i}'))
+    publisher.flush()
+
+    assert metrics.counter('events_dropped').value == 3
+    fake_redis.release.set()
+    publisher.join()
+    published = [data['orderid'] for pipeline in fake_redis.pipelines for _, data in pipeline]
+    assert published == ['o0', 'o1', 'o2']
+
+
+def test_rejects_unknown_policies():
+    with pytest.raises(ValueError):
+        BufferedPublisher(when_full='shrug')
+
+
+def test_immediate_mode_publishes_each_event(monkeypatch):
+    monkeypatch.setenv('EVENT_PUBLISHING', 'immediate')
+    assert redis_eventpublisher.from_config() is redis_eventpublisher.publish
+    monkeypatch.setenv('EVENT_PUBLISHING', 'background')
+    assert redis_eventpublisher.from_config().background
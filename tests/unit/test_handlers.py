@@ -1,12 +1,14 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from typing import Dict, List
 import pytest
-from allocation import bootstrap
-from allocation.domain import commands
-from allocation.service_layer import handlers
+from allocation import bootstrap, metrics
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus
 from allocation.adapters import notifications, repository
 from allocation.service_layer import unit_of_work
 
@@ -103,6 +105,28 @@ class TestAllocate:
         assert bus.uow.committed
 
 
+    def test_allocate_many_allocates_all_lines_in_one_commit(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "STACKABLE-STOOL", 10, None))
+        bus.uow.committed = False
+        bus.handle(commands.AllocateMany("STACKABLE-STOOL", [("o1", 3), ("o2", 4)]))
+        [batch] = bus.uow.products.get("STACKABLE-STOOL").batches
+        assert batch.available_quantity == 3
+        assert bus.uow.committed
+
+    def test_allocate_many_returns_a_batchref_per_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "STACKABLE-STOOL", 5, None))
+        assert bus.handle(commands.AllocateMany(
+            "STACKABLE-STOOL", [("o1", 3), ("o2", 4), ("o3", 2)],
+        )) == ["b1", None, "b1"]
+
+    def test_allocate_many_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(commands.AllocateMany("NONEXISTENTSKU", [("o1", 10)]))
+
+
     def test_sends_email_on_out_of_stock_error(self):
         fake_notifs = FakeNotifications()
         bus = bootstrap.bootstrap(
@@ -151,3 +175,110 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+    def test_records_lines_evicted_per_change(self):
+        metrics.reset()
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "FLIMSY-DESK", 50, None))
+        bus.handle(commands.Allocate("order1", "FLIMSY-DESK", 20))
+        bus.handle(commands.Allocate("order2", "FLIMSY-DESK", 20))
+        bus.handle(commands.ChangeBatchQuantity("batch1", 5))
+
+        evicted = metrics.snapshot()['lines_evicted_per_batch_quantity_change']
+        assert evicted == {'count': 1, 'total': 2, 'max': 2}
+
+
+
+class TestMessageBus:
+
+    def test_rejects_things_that_are_not_messages(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(Exception, match="was not an Event or Command"):
+            bus.handle("allocate please")
+
+
+    def test_processes_long_reallocation_cascades(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "POPULAR-POUF", 500, None))
+        bus.handle(commands.CreateBatch("batch2", "POPULAR-POUF", 500, date.today()))
+        bus.handle(commands.AllocateMany(
+            "POPULAR-POUF", [(f"o{i}", 1) for i in range(500)]
+        ))
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 0))
+
+        batch1, batch2 = bus.uow.products.get("POPULAR-POUF").batches
+        assert batch1.available_quantity == 0
+        assert batch2.available_quantity == 0
+
+
+    def test_runs_parallel_safe_event_handlers_concurrently_and_in_declared_order(self):
+        both_started = threading.Barrier(2, timeout=1)
+        calls = []
+
+        @handlers.parallel_safe
+        def slow_publish(event):
+            both_started.wait()
+            calls.append('publish')
+
+        @handlers.parallel_safe
+        def slow_read_model(event):
+            both_started.wait()
+            raise Exception('read model is down')
+
+        def afterwards(event):
+            calls.append('afterwards')
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={
+                events.OutOfStock: [slow_publish, slow_read_model, afterwards],
+            },
+            command_handlers={},
+            executor=ThreadPoolExecutor(max_workers=2),
+        )
+        bus.handle(events.OutOfStock("SOLD-OUT-SOFA"))
+
+        assert calls == ['publish', 'afterwards']
+
+
+    def test_retries_commands_that_lose_a_concurrency_race(self):
+        metrics.reset()
+        attempts = []
+
+        def flaky_handler(command):
+            attempts.append(command)
+            if len(attempts) < 3:
+                raise unit_of_work.ConcurrencyConflict('version changed')
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={},
+            command_handlers={commands.Allocate: flaky_handler},
+            retry_policy=messagebus.RetryPolicy(max_attempts=3, base_delay=0),
+        )
+        bus.handle(commands.Allocate("o1", "RACY-RUG", 1))
+
+        assert len(attempts) == 3
+        assert metrics.counter('concurrency_conflicts').value == 2
+        assert metrics.counter('command_retries').value == 2
+
+
+    def test_gives_up_after_max_attempts(self):
+        metrics.reset()
+
+        def always_conflicts(command):
+            raise unit_of_work.ConcurrencyConflict('version changed')
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={},
+            command_handlers={commands.Allocate: always_conflicts},
+            retry_policy=messagebus.RetryPolicy(max_attempts=2, base_delay=0),
+        )
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            bus.handle(commands.Allocate("o1", "RACY-RUG", 1))
+
+        assert metrics.counter('concurrency_conflicts').value == 2
+        assert metrics.counter('command_retries').value == 1
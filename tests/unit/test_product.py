@@ -1,6 +1,6 @@
 from datetime import date, timedelta
 from allocation.domain import events
-from allocation.domain.model import Product, OrderLine, Batch
+from allocation.domain.model import Product, OrderLine, Batch, fewest_lines
 
 
 today = date.today()
@@ -69,3 +69,78 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_add_batch_keeps_eta_ordering():
+    product = Product(sku="TINY-VASE", batches=[])
+    product.allocate(OrderLine("o0", "TINY-VASE", 1))
+    product.add_batch(Batch("slow-batch", "TINY-VASE", 100, eta=later))
+    product.add_batch(Batch("speedy-batch", "TINY-VASE", 100, eta=tomorrow))
+    product.add_batch(Batch("in-stock-batch", "TINY-VASE", 100, eta=None))
+
+    assert product.allocate(OrderLine("o1", "TINY-VASE", 10)) == "in-stock-batch"
+    assert product.get_batch("speedy-batch").available_quantity == 100
+
+
+def test_batches_appended_directly_are_still_considered():
+    product = Product(sku="SHY-SOFA", batches=[Batch('b1', "SHY-SOFA", 5, eta=later)])
+    product.allocate(OrderLine("o1", "SHY-SOFA", 5))
+    product.batches.append(Batch('b2', "SHY-SOFA", 5, eta=today))
+    assert product.allocate(OrderLine("o2", "SHY-SOFA", 5)) == 'b2'
+    assert product.get_batch('b2').available_quantity == 0
+
+
+def test_allocate_many_matches_allocating_one_line_at_a_time():
+    def make_product():
+        return Product(sku="BUSY-SHELF", batches=[
+            Batch('in-stock', "BUSY-SHELF", 10, eta=None),
+            Batch('shipment', "BUSY-SHELF", 20, eta=tomorrow),
+            Batch('later', "BUSY-SHELF", 5, eta=later),
+        ])
+    lines = [
+        OrderLine(f'o{i}', "BUSY-SHELF", qty)
+        for i, qty in enumerate([4, 7, 5, 12, 5, 9, 1, 6, 3])
+    ]
+    one_at_a_time, in_bulk = make_product(), make_product()
+
+    expected = [one_at_a_time.allocate(line) for line in lines]
+
+    assert in_bulk.allocate_many(lines) == expected
+    assert in_bulk.events == one_at_a_time.events
+    assert in_bulk.version_number == one_at_a_time.version_number
+    assert [b.available_quantity for b in in_bulk.batches] == [
+        b.available_quantity for b in one_at_a_time.batches
+    ]
+
+
+def test_change_batch_quantity_evicts_the_fewest_lines_by_default():
+    batch = Batch('b1', 'TALL-LAMP', 20, eta=None)
+    product = Product(sku='TALL-LAMP', batches=[batch])
+    for orderid, qty in [('o1', 2), ('o2', 3), ('o3', 6), ('o4', 9)]:
+        product.allocate(OrderLine(orderid, 'TALL-LAMP', qty))
+
+    evicted = product.change_batch_quantity('b1', 15)
+
+    assert evicted == [OrderLine('o3', 'TALL-LAMP', 6)]
+    assert product.events[-1] == events.Deallocated('o3', 'TALL-LAMP', 6)
+    assert batch.available_quantity == 1
+
+
+def test_change_batch_quantity_accepts_a_deallocation_policy():
+    batch = Batch('b1', 'SHORT-LAMP', 10, eta=None)
+    product = Product(sku='SHORT-LAMP', batches=[batch])
+    product.allocate(OrderLine('o1', 'SHORT-LAMP', 4))
+    product.allocate(OrderLine('o2', 'SHORT-LAMP', 4))
+
+    def evict_everything(lines, excess):
+        return list(lines)
+
+    evicted = product.change_batch_quantity('b1', 6, policy=evict_everything)
+    assert len(evicted) == 2
+    assert batch.available_quantity == 6
+
+
+def test_fewest_lines_takes_largest_lines_when_no_single_line_is_enough():
+    lines = {OrderLine(f'o{qty}', 'SKU', qty) for qty in [1, 2, 5, 6, 7]}
+    evicted = fewest_lines(lines, excess=12)
+    assert sorted(l.qty for l in evicted) == [5, 7]
@@ -0,0 +1,37 @@
+from allocation import metrics
+from allocation.adapters.repository import ProductCache
+from allocation.domain.model import Product
+
+
+def test_hit_only_while_versions_match():
+    cache = ProductCache()
+    cache.put(Product('SNUG-SOFA', batches=[], version_number=3))
+
+    assert cache.get('SNUG-SOFA', 3).sku == 'SNUG-SOFA'
+    assert cache.get('SNUG-SOFA', 4) is None
+    assert cache.get('SNUG-SOFA', 3) is None  # the stale entry was dropped
+    assert cache.stats() == dict(hits=1, misses=2, evictions=0, size=0)
+
+
+def test_evicts_least_recently_used():
+    cache = ProductCache(max_size=2)
+    cache.put(Product('RED-CHAIR', batches=[]))
+    cache.put(Product('BLUE-CHAIR', batches=[]))
+    cache.get('RED-CHAIR', 0)
+    cache.put(Product('GREEN-CHAIR', batches=[]))
+
+    assert cache.get('BLUE-CHAIR', 0) is None
+    assert cache.get('RED-CHAIR', 0) is not None
+    assert cache.get('GREEN-CHAIR', 0) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size'] == 2
+
+
+def test_size_is_reported_as_a_gauge():
+    metrics.reset()
+    cache = ProductCache(max_size=2)
+    for sku in ['RED-CHAIR', 'BLUE-CHAIR', 'GREEN-CHAIR']:
+        cache.put(Product(sku, batches=[]))
+    assert metrics.gauge('product_cache_size').value == 2
+    cache.discard('GREEN-CHAIR')
+    assert metrics.gauge('product_cache_size').value == 1
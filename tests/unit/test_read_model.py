@@ -0,0 +1,65 @@
+from typing import List
+from allocation.service_layer.read_model import AllocationsViewWriter
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.executed = []  # type: List[tuple]
+
+    def execute(self, statement, params):
+        self.executed.append((statement.split()[0], params))
+
+
+class FakeViewUnitOfWork:
+
+    def __init__(self):
+        self.session = FakeSession()
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_buffers_changes_until_flushed():
+    uow = FakeViewUnitOfWork()
+    writer = AllocationsViewWriter(uow)
+    writer.add('o1', 'LAMP', 'b1')
+    writer.add('o2', 'LAMP', 'b1')
+    assert uow.session.executed == []
+
+    writer.flush()
+
+    assert uow.session.executed == [('INSERT', [
+        dict(orderid='o1', sku='LAMP', batchref='b1'),
+        dict(orderid='o2', sku='LAMP', batchref='b1'),
+    ])]
+    assert uow.commits == 1
+
+
+def test_a_delete_cancels_earlier_inserts_for_the_same_line():
+    uow = FakeViewUnitOfWork()
+    writer = AllocationsViewWriter(uow)
+    writer.add('o1', 'LAMP', 'b1')
+    writer.remove('o1', 'LAMP')
+    writer.remove('o2', 'LAMP')
+    writer.add('o2', 'LAMP', 'b2')
+
+    writer.flush()
+
+    assert uow.session.executed == [
+        ('DELETE', [dict(orderid='o1', sku='LAMP'), dict(orderid='o2', sku='LAMP')]),
+        ('INSERT', [dict(orderid='o2', sku='LAMP', batchref='b2')]),
+    ]
+
+
+def test_flushing_nothing_does_not_open_a_transaction():
+    uow = FakeViewUnitOfWork()
+    AllocationsViewWriter(uow).flush()
+    assert uow.commits == 0
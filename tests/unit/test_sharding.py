@@ -0,0 +1,79 @@
+from concurrent.futures import Future
+import pytest
+from allocation.domain import commands
+from allocation.service_layer import sharding
+from .test_handlers import bootstrap_test_app
+
+
+def test_shards_are_stable_and_in_range():
+    assert sharding.shard_for('GREEN-SOFA', 4) == sharding.shard_for('GREEN-SOFA', 4)
+    assert {sharding.shard_for(f'sku{i}', 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_commands_for_a_sku_always_reach_the_same_worker():
+    skus = [f'SHARDED-SKU-{i}' for i in range(20)]
+    batchrefs = {f'batch-{sku}': sku for sku in skus}
+    pool = sharding.ShardedWorkerPool(
+        bus_factory=bootstrap_test_app,
+        n_workers=4,
+        sku_for_batchref=batchrefs.get,
+    )
+    with pool:
+        for batchref, sku in batchrefs.items():
+            pool.submit(commands.CreateBatch(batchref, sku, 10, None))
+        # each worker has its own fake uow, so these only succeed if they are
+        # routed to the worker that created the batch
+        futures = [pool.submit(commands.Allocate('o1', sku, 5)) for sku in skus]
+        futures += [
+            pool.submit(commands.ChangeBatchQuantity(batchref, 7))
+            for batchref in batchrefs
+        ]
+        for future in futures:
+            future.result()
+
+
+def test_create_batches_is_split_between_the_workers_for_its_skus():
+    skus = [f'SHARDED-SKU-{i}' for i in range(20)]
+    pool = sharding.ShardedWorkerPool(
+        bus_factory=bootstrap_test_app,
+        n_workers=4,
+        sku_for_batchref={}.get,
+    )
+    with pool:
+        assert pool.submit(commands.CreateBatches([
+            commands.CreateBatch(f'batch-{sku}', sku, 10, None) for sku in skus
+        ])).result() is None
+        # each only succeeds on the worker that created the sku's batch
+        for sku in skus:
+            pool.submit(commands.Allocate('o1', sku, 5)).result()
+
+
+def test_a_split_command_fails_if_any_part_does():
+    parts = [Future(), Future()]
+    combined = sharding._all_done(parts)  # pylint: disable=protected-access
+    parts[1].set_exception(ValueError('no'))
+    assert not combined.done()
+    parts[0].set_result(None)
+    with pytest.raises(ValueError):
+        combined.result()
+
+
+def test_a_batchref_that_is_not_found_yet_is_not_cached():
+    batchrefs = {}
+    pool = sharding.ShardedWorkerPool(
+        bus_factory=bootstrap_test_app,
+        n_workers=4,
+        sku_for_batchref=batchrefs.get,
+        max_cached_batchrefs=2,
+    )
+    with pool:
+        assert pool.routing_key(commands.ChangeBatchQuantity('batch1', 7)) == ''
+        batchrefs['batch1'] = 'LATE-LOUNGER'
+        assert pool.routing_key(commands.ChangeBatchQuantity('batch1', 7)) == 'LATE-LOUNGER'
+        # found skus are cached, up to max_cached_batchrefs
+        batchrefs['batch1'] = 'MOVED'
+        assert pool.routing_key(commands.ChangeBatchQuantity('batch1', 7)) == 'LATE-LOUNGER'
+        batchrefs.update(batch2='B2', batch3='B3')
+        pool.routing_key(commands.ChangeBatchQuantity('batch2', 7))
+        pool.routing_key(commands.ChangeBatchQuantity('batch3', 7))
+        assert pool.routing_key(commands.ChangeBatchQuantity('batch1', 7)) == 'MOVED'
@@ -0,0 +1,48 @@
+# pylint: disable=redefined-outer-name
+import importlib
+import smtplib
+import socket
+import sys
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.adapters import notifications
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def test_email_notifications_do_not_connect_until_first_send():
+    email = notifications.EmailNotifications('localhost', unused_port())
+    assert email._server is None  # pylint: disable=protected-access
+
+
+@pytest.fixture
+def no_io(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise AssertionError(f'tried to connect: {args!r}')
+
+    # redis and psycopg2 go through socket.connect, smtplib (and anything
+    # else) may use create_connection
+    monkeypatch.setattr(socket, 'create_connection', refuse)
+    monkeypatch.setattr(socket.socket, 'connect', refuse)
+    monkeypatch.setattr(socket.socket, 'connect_ex', refuse)
+    monkeypatch.setattr(smtplib, 'SMTP', refuse)
+    yield
+    clear_mappers()
+
+
+@pytest.mark.usefixtures('no_io')
+def test_bootstrap_with_defaults_does_no_io():
+    bus = bootstrap.bootstrap()
+    assert bus.uow.session_factory is not None
+
+
+@pytest.mark.usefixtures('no_io')
+def test_importing_the_flask_app_does_no_io(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'allocation.entrypoints.flask_app', raising=False)
+    flask_app = importlib.import_module('allocation.entrypoints.flask_app')
+    assert flask_app.bus.uow.session_factory is not None
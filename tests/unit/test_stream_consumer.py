@@ -0,0 +1,219 @@
+# pylint: disable=redefined-outer-name
+import json
+from collections import OrderedDict
+from typing import Dict, List
+import pytest
+from allocation.domain import commands
+from allocation.entrypoints.redis_stream_consumer import StreamConsumer
+
+
+class FakeStreamRedis:
+    # just enough of redis.Redis's stream commands for StreamConsumer, for one
+    # group, on a clock the test moves. replies are shaped like redis-py's
+
+    def __init__(self):
+        self.now = 0.0
+        self.streams = {}  # type: Dict[str, OrderedDict]
+        self.last_delivered = {}  # type: Dict[str, int]
+        # message id -> [consumer, delivered at, times delivered]
+        self.pending = OrderedDict()  # type: OrderedDict[bytes, List]
+        self.calls = []  # type: List[str]
+        self.claimed_from = []  # type: List[bytes]
+        self._next_id = 1
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):  # pylint: disable=redefined-builtin,unused-argument
+        self.calls.append('xgroup_create')
+        if name in self.last_delivered:
+            raise Exception('BUSYGROUP Consumer Group name already exists')
+        self.streams.setdefault(name, OrderedDict())
+        self.last_delivered[name] = 0
+
+    def xadd(self, name, fields):
+        message_id = f'{self._next_id}-0'.encode()
+        self._next_id += 1
+        self.streams.setdefault(name, OrderedDict())[message_id] = {
+            k.encode() if isinstance(k, str) else k: v.encode() if isinstance(v, str) else v
+            for k, v in fields.items()
+        }
+        return message_id
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None):  # pylint: disable=unused-argument
+        self.calls.append('xreadgroup')
+        [name] = streams
+        new = [
+            (message_id, fields) for message_id, fields in self.streams[name].items()
+            if int(message_id.split(b'-')[0]) > self.last_delivered[name]
+        ][:count]
+        for message_id, _ in new:
+            self.pending[message_id] = [consumername, self.now, 1]
+            self.last_delivered[name] = int(message_id.split(b'-')[0])
+        return [[name.encode(), new]] if new else []
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id, count):  # pylint: disable=unused-argument
+        # scans the pending list from start_id, and returns the id to carry
+        # on from, or 0-0 once it has reached the end
+        self.calls.append('xautoclaim')
+        self.claimed_from.append(start_id)
+        claimed = []
+        for message_id in sorted(self.pending, key=id_key):
+            if id_key(message_id) < id_key(start_id):
+                continue
+            if len(claimed) == count:
+                return [message_id, claimed, []]
+            entry = self.pending[message_id]
+            if self.now - entry[1] >= min_idle_time / 1000:
+                entry[:] = [consumername, self.now, entry[2] + 1]
+                claimed.append((message_id, self.streams[name][message_id]))
+        return [b'0-0', claimed, []]
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):  # pylint: disable=redefined-builtin,unused-argument
+        self.calls.append('xpending_range')
+        return [
+            dict(message_id=message_id, consumer=entry[0].encode(),
+                 time_since_delivered=0, times_delivered=entry[2])
+            for message_id, entry in self.pending.items()
+            if min <= message_id <= max and entry[0] == consumername
+        ][:count]
+
+    def xack(self, name, groupname, *message_ids):  # pylint: disable=unused-argument
+        for message_id in message_ids:
+            self.pending.pop(message_id, None)
+        return len(message_ids)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+
+def id_key(message_id):
+    if isinstance(message_id, bytes):
+        message_id = message_id.decode()
+    return tuple(int(part) for part in message_id.split('-'))
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.queued = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.queued.append((name, args, kwargs))
+
+    def execute(self):
+        self.client.calls.append('pipeline:' + ','.join(name for name, _, _ in self.queued))
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.queued]
+
+
+class FakeBus:
+
+    def __init__(self, failing=()):
+        self.handled = []  # type: List[commands.Command]
+        self.failing = set(failing)
+
+    def handle(self, cmd):
+        if cmd.ref in self.failing:
+            raise Exception(f'cannot handle {cmd}')
+        self.handled.append(cmd)
+
+
+@pytest.fixture
+def redis_client():
+    return FakeStreamRedis()
+
+
+def add_message(client, batchref, qty):
+    return client.xadd('change_batch_quantity', {'data': json.dumps(dict(batchref=batchref, qty=qty))})
+
+
+def consumer_for(client, bus, name, **kwargs):
+    return StreamConsumer(
+        client, bus, name, count=10, claim_idle_ms=1000, clock=lambda: client.now, **kwargs,
+    )
+
+
+def test_handles_a_batch_of_messages_and_acks_them_in_one_round_trip(redis_client):
+    for i in range(3):
+        add_message(redis_client, f'b{i}', i)
+    bus = FakeBus()
+    consumer = consumer_for(redis_client, bus, 'c1')
+
+    assert consumer.run_once() == 3
+    assert bus.handled == [
+        commands.ChangeBatchQuantity(f'b{i}', i, sequence=f'{i + 1}-0') for i in range(3)
+    ]
+    assert not redis_client.pending
+    assert redis_client.calls.count('pipeline:xack') == 1
+
+    # the group already exists, and now there's nothing to read
+    redis_client.calls.clear()
+    assert consumer.run_once() == 0
+    assert 'xgroup_create' not in redis_client.calls
+
+
+def test_consumers_in_a_group_share_messages(redis_client):
+    for i in range(15):
+        add_message(redis_client, f'b{i}', i)
+    bus1, bus2 = FakeBus(), FakeBus()
+    consumer1 = consumer_for(redis_client, bus1, 'c1')
+    consumer2 = consumer_for(redis_client, bus2, 'c2')
+
+    consumer1.run_once()
+    consumer2.run_once()
+    assert len(bus1.handled) == 10
+    assert len(bus2.handled) == 5
+    assert not {c.ref for c in bus1.handled} & {c.ref for c in bus2.handled}
+
+
+def test_reclaims_messages_left_pending_by_a_dead_consumer(redis_client):
+    add_message(redis_client, 'b1', 10)
+    add_message(redis_client, 'b2', 20)
+    # c1 reads the messages and dies before handling them
+    redis_client.xgroup_create('change_batch_quantity', 'allocation', id='0')
+    redis_client.xreadgroup('allocation', 'c1', {'change_batch_quantity': '>'}, count=10)
+    bus = FakeBus()
+    consumer = consumer_for(redis_client, bus, 'c2')
+
+    assert consumer.run_once() == 0
+    redis_client.now += 2
+    assert consumer.run_once() == 2
+    assert bus.handled == [
+        commands.ChangeBatchQuantity('b1', 10, sequence='1-0'),
+        commands.ChangeBatchQuantity('b2', 20, sequence='2-0'),
+    ]
+    assert not redis_client.pending
+
+
+def test_claims_a_long_pending_list_a_page_at_a_time(redis_client):
+    for i in range(15):
+        add_message(redis_client, f'b{i}', i)
+    redis_client.xgroup_create('change_batch_quantity', 'allocation', id='0')
+    redis_client.xreadgroup('allocation', 'c1', {'change_batch_quantity': '>'}, count=15)
+    redis_client.now += 2
+    bus = FakeBus()
+    consumer = consumer_for(redis_client, bus, 'c2')
+
+    assert consumer.run_once() == 10
+    assert consumer.run_once() == 5
+    assert redis_client.claimed_from == [b'0-0', b'11-0']
+    assert [c.ref for c in bus.handled] == [f'b{i}' for i in range(15)]
+    # back at the start of the list, so it waits before claiming again
+    assert consumer.run_once() == 0
+    assert redis_client.claimed_from == [b'0-0', b'11-0']
+
+
+def test_failed_messages_are_retried_then_dead_lettered(redis_client):
+    add_message(redis_client, 'poison', 1)
+    add_message(redis_client, 'fine', 2)
+    bus = FakeBus(failing={'poison'})
+    consumer = consumer_for(redis_client, bus, 'c1', max_deliveries=3)
+
+    consumer.run_once()
+    assert bus.handled == [commands.ChangeBatchQuantity('fine', 2, sequence='2-0')]
+    assert list(redis_client.pending) == [b'1-0']
+
+    for _ in range(3):
+        redis_client.now += 2
+        consumer.run_once()
+    assert not redis_client.pending
+    [dead] = redis_client.streams['change_batch_quantity:dead'].values()
+    assert json.loads(dead[b'data']) == dict(batchref='poison', qty=1)
@@ -0,0 +1,109 @@
+# pylint: disable=redefined-outer-name
+from typing import Dict
+import pytest
+from allocation.adapters import view_cache
+from allocation.adapters.view_cache import InMemoryViewCache, RedisViewCache
+
+
+class FakeRedis:
+    # just enough of redis.Redis for RedisViewCache; ignores expiry
+
+    def __init__(self):
+        self.data = {}  # type: Dict[str, bytes]
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        self.data[key] = value.encode() if isinstance(value, str) else value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def cache(request):
+    if request.param == 'memory':
+        return InMemoryViewCache()
+    return RedisViewCache(FakeRedis())
+
+
+ROWS = [{'sku': 'TALL-TABLE', 'batchref': 'b1'}]
+
+
+def test_caches_rows_until_invalidated(cache):
+    assert cache.get('o1')[0] is None
+    _, version = cache.get('o1')
+    cache.set('o1', ROWS, version)
+    assert cache.get('o1')[0] == ROWS
+
+    cache.invalidate(['o1'])
+
+    assert cache.get('o1')[0] is None
+
+
+def test_a_read_that_overlaps_an_invalidation_is_not_cached(cache):
+    _, version = cache.get('o1')
+    cache.invalidate(['o1'])  # eg the read model changed while we were reading it
+    cache.set('o1', ROWS, version)
+
+    assert cache.get('o1')[0] is None
+
+
+def test_in_memory_entries_expire():
+    now = [0.0]
+    cache = InMemoryViewCache(ttl=10, clock=lambda: now[0])
+    cache.set('o1', ROWS, cache.get('o1')[1])
+    now[0] = 9
+    assert cache.get('o1')[0] == ROWS
+    now[0] = 10
+    assert cache.get('o1')[0] is None
+
+
+def test_in_memory_cache_is_bounded_and_forgetting_versions_stays_safe():
+    cache = InMemoryViewCache(max_size=2)
+    _, stale_version = cache.get('o1')
+    cache.invalidate(['o1', 'o2', 'o3'])  # o1's version is forgotten
+
+    cache.set('o1', ROWS, stale_version)
+    assert cache.get('o1')[0] is None
+
+    for orderid in ['o1', 'o2', 'o3']:
+        cache.set(orderid, ROWS, cache.get(orderid)[1])
+    assert [cache.get(orderid)[0] for orderid in ['o1', 'o2', 'o3']] == [None, ROWS, ROWS]
+
+
+def test_processes_sharing_the_read_model_refuse_an_in_memory_cache(monkeypatch):
+    monkeypatch.setenv('VIEW_CACHE', 'memory')
+    assert isinstance(view_cache.from_config(), InMemoryViewCache)
+    with pytest.raises(ValueError):
+        view_cache.from_config(shared=True)
+    monkeypatch.setenv('VIEW_CACHE', '')
+    assert view_cache.from_config(shared=True) is None